@@ -0,0 +1,59 @@
+import contextlib
+import io
+import pickle
+import sys
+import time
+
+from joblib import Parallel, delayed
+
+from simulator import MockSimulator
+
+
+# Measures the cost of dispatching simulations to the workers of Simulator.run as the memo grows. With only a RunSpec
+# sent to the workers, the time per call and the size of each task must stay flat.
+def grow_memo(simulator: MockSimulator, entries: int):
+    for i in range(len(simulator.memo), entries):
+        simulator.memo[(3, 1000.0 + i, '', simulator.simulation_duration, 0)] = MockSimulator.worst_response()
+
+
+def measure(simulator: MockSimulator, calls: int) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(calls):
+            # A new speed every call, so that every simulation is missing from the memo
+            simulator.run(3, 1.0 + i / 1000 + time.perf_counter() % 1, [(9, 11)])
+    return (time.perf_counter() - start) / calls
+
+
+def pickled_task_size(simulator: MockSimulator) -> int:
+    spec = simulator.make_run_spec(3, 5.0, '09:00-11:00', [2, 3, 3], 0, 0)
+    return len(pickle.dumps((MockSimulator, spec)))
+
+
+def pickled_simulator_size(simulator: MockSimulator) -> int:
+    # What each task used to carry when the bound method run_single_simulation was dispatched
+    return len(pickle.dumps(simulator))
+
+
+def main(memo_sizes=(0, 10000, 100000, 300000), calls: int = 20, threads: int = 4):
+    simulator = MockSimulator(10, 20, 5, 3, threads=threads, number_of_simulations=threads)
+    # The first call starts the workers, it is not part of the measurements
+    measure(simulator, 1)
+    print("memo_size,seconds_per_call,task_bytes,simulator_bytes,new_parallel_seconds_per_call")
+    for memo_size in memo_sizes:
+        grow_memo(simulator, memo_size)
+        per_call = measure(simulator, calls)
+        # Baseline: a new Parallel per call with the whole simulator in every task
+        start = time.perf_counter()
+        for _ in range(calls):
+            Parallel(n_jobs=threads)(delayed(simulator.run_single_simulation)(3, 5.0, '09:00-11:00', [2, 3, 3],
+                                                                             sim_id, 0)
+                                     for sim_id in range(threads))
+        baseline_per_call = (time.perf_counter() - start) / calls
+        print(f"{memo_size},{per_call:.6f},{pickled_task_size(simulator)},{pickled_simulator_size(simulator)},"
+              f"{baseline_per_call:.6f}", flush=True)
+    simulator.close()
+
+
+if __name__ == '__main__':
+    main(calls=int(sys.argv[1]) if len(sys.argv) > 1 else 20)
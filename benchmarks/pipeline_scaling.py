@@ -0,0 +1,270 @@
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import os
+import random
+import shutil
+import tempfile
+import timeit
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas
+
+from metamorphic.AddRequestRule import AddRequestRule
+from metamorphic.AddSystematicRequestRule import AddSystematicRequestRule
+from metamorphic.ChangeServiceTimeRule import ChangeServiceTimeRule
+from metamorphic.ChangeUtilizationTimeRule import ChangeUtilizationTimeRule
+from metamorphic.RemoveRequestRule import RemoveRequestRule
+from metamorphic.RemoveSystematicServedRequestRule import RemoveSystematicServedRequestRule
+from metamorphic.RemoveSystematicUnservedRequestRule import RemoveSystematicUnservedRequestRule
+from metamorphic.ServedCloserMax import ServedCloserMax
+from metamorphic.ServedCloserMid import ServedCloserMid
+from metamorphic.ServedCloserMin import ServedCloserMin
+from metamorphic.ServedFurtherMax import ServedFurtherMax
+from metamorphic.ServedFurtherMid import ServedFurtherMid
+from metamorphic.ServedFurtherMin import ServedFurtherMin
+from metamorphic.UnservedCloserMax import UnservedCloserMax
+from metamorphic.UnservedCloserMid import UnservedCloserMid
+from metamorphic.UnservedCloserMin import UnservedCloserMin
+from metamorphic.UnservedFurtherMax import UnservedFurtherMax
+from metamorphic.UnservedFurtherMid import UnservedFurtherMid
+from metamorphic.UnservedFurtherMin import UnservedFurtherMin
+from metamorphic import experiments_zip_to_csv
+from metamorphic.Request import Request
+from simulator.fake_simulator import TARGETS, TIMEZONE
+from simulator.simulator_v2 import SimulatorV2
+from simulator.standin import Scenario, StandinEngine
+
+SERVICE_START_TIME = datetime.datetime(2021, 1, 1, 9, tzinfo=TIMEZONE)
+SERVICE_END_TIME = datetime.datetime(2021, 1, 1, 21, tzinfo=TIMEZONE)
+# Default sizes, small enough to run in a few minutes. The curves go up to 10k requests and 1M zips with larger sizes
+# on the command line.
+REQUEST_SIZES = [25, 50, 100, 200, 400, 800, 1600, 3200, 6400, 10000]
+RULE_SIZES = [1000, 4000, 16000, 64000, 256000]
+ROBOT_SIZES = [5, 10, 20, 40, 80, 160, 320]
+CORPUS_SIZES = [1000, 2000, 4000]
+# Largest scaling exponent (slope of log seconds against log size) accepted for each curve. Everything the pipeline
+# does outside the binary is expected to be linear in the number of requests, robots and zips.
+MAX_EXPONENTS = {"read_test_from_csv_file": 1.0,
+                 "write_test_to_csv": 1.0,
+                 "zip_to_results_dict": 1.0,
+                 "zip_to_results_dict_robots": 1.0,
+                 "generate_followup_inputs": 1.0,
+                 "generate_followup_inputs_robots": 1.0,
+                 # One follow-up per robot, each with the shifts of every robot
+                 "generate_followup_inputs_robots:ChangeUtilizationTime30": 2.0,
+                 "zip_to_csv": 1.0}
+
+
+# Measures how the Python side of the metamorphic pipeline scales with the number of requests, of robots and of result
+# zips, on synthetic corpora simulated by the stand-in engine. Prints the time and throughput at every size, then the
+# scaling exponent of every curve, and fails when an exponent exceeds MAX_EXPONENTS by more than the tolerance.
+def synthetic_requests(num_requests: int, seed: int = 0) -> List[Request]:
+    random_generator = random.Random(seed)
+    requests = [Request.random(i, SERVICE_START_TIME, SERVICE_END_TIME, TARGETS, TARGETS, random_generator)
+                for i in range(num_requests)]
+    for request in requests:
+        request.order_time = request.order_time.replace(microsecond=0)
+    return requests
+
+
+def robot_windows(num_robots: int) -> List[Tuple[datetime.time, datetime.time]]:
+    # Staggered shifts, so that ChangeUtilizationTimeRule has a follow-up for every robot
+    return [(datetime.time(9 + i % 6), datetime.time(15 + i % 6)) for i in range(num_robots)]
+
+
+def synthetic_zip(zip_path: Path, num_requests: int, num_robots: int, seed: int = 0) -> Path:
+    # Result zip of a stand-in simulation, laid out as SimulatorV2 archives the result directory of the binary
+    windows = [(datetime.datetime.combine(SERVICE_START_TIME.date(), start, TIMEZONE),
+                datetime.datetime.combine(SERVICE_START_TIME.date(), end, TIMEZONE))
+               for start, end in robot_windows(num_robots)]
+    engine = StandinEngine(Scenario(requests=synthetic_requests(num_requests, seed),
+                                    service_start_time=SERVICE_START_TIME,
+                                    service_end_time=SERVICE_END_TIME,
+                                    num_robots=num_robots,
+                                    robot_speed_kmph=5.0,
+                                    robot_loading_capacity=5,
+                                    num_operators=2,
+                                    windows=windows)).run()
+    with tempfile.TemporaryDirectory() as result_dir:
+        engine.write_results(Path(result_dir, zip_path.stem))
+        shutil.make_archive(str(zip_path.with_suffix("")), "zip", result_dir)
+    return zip_path
+
+
+def rules() -> list:
+    # One rule of every kind, with the parameters of experiments.py
+    operation_start_time = datetime.datetime.fromisoformat("2021-01-01T09:00:00")
+    operation_end_time = datetime.datetime.fromisoformat("2021-01-01T12:00:00")
+    return [ChangeServiceTimeRule(None, datetime.timedelta(minutes=30)),
+            ChangeUtilizationTimeRule(None, datetime.timedelta(minutes=30)),
+            AddRequestRule(None, operation_start_time, operation_end_time, 5),
+            AddSystematicRequestRule(None, operation_start_time, operation_end_time, 5),
+            RemoveRequestRule(None, 5),
+            RemoveSystematicServedRequestRule(None, 5),
+            RemoveSystematicUnservedRequestRule(None, 5)] + \
+        [rule(None, 5) for rule in [ServedCloserMax, ServedCloserMid, ServedCloserMin,
+                                    ServedFurtherMax, ServedFurtherMid, ServedFurtherMin,
+                                    UnservedCloserMax, UnservedCloserMid, UnservedCloserMin,
+                                    UnservedFurtherMax, UnservedFurtherMid, UnservedFurtherMin]]
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    # Seconds per call, the best of repeat measurements of enough calls to last 0.2 seconds
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def scaling_exponent(sizes: Sequence[int], seconds: Sequence[float]) -> float:
+    # Slope of the log-log fit over the larger half of the sizes, 1 for a linear curve and 2 for a quadratic one. The
+    # smaller sizes are dominated by fixed costs (opening files, building data frames) that flatten the curve.
+    tail = min(len(sizes) // 2, len(sizes) - 2)
+    return float(np.polyfit(np.log(sizes[tail:]), np.log(seconds[tail:]), 1)[0])
+
+
+def request_curves(work_dir: Path, request_sizes: Sequence[int], requests_per_robot: int,
+                   repeat: int) -> Dict[str, List[Tuple[int, float]]]:
+    # The fleet grows with the requests, so that the results have a realistic number of robots and deliveries
+    curves = {name: [] for name in ["read_test_from_csv_file", "write_test_to_csv", "zip_to_results_dict"]}
+    for num_requests in request_sizes:
+        requests = synthetic_requests(num_requests)
+        csv_path = str(work_dir.joinpath(f"customer_request_{num_requests}.csv"))
+        curves["write_test_to_csv"].append(
+            (num_requests, best_time(lambda: Request.write_test_to_csv(csv_path, requests), repeat)))
+
+        def read():
+            with open(csv_path) as requests_file:
+                return Request.read_test_from_csv_file(requests_file)
+        curves["read_test_from_csv_file"].append((num_requests, best_time(read, repeat)))
+
+        num_robots = max(1, num_requests // requests_per_robot)
+        zip_path = synthetic_zip(work_dir.joinpath(f"original_{num_requests}_{num_robots}_2_0.zip"),
+                                 num_requests, num_robots)
+        curves["zip_to_results_dict"].append((num_requests, best_time(lambda: read_zip(zip_path), repeat)))
+    return curves
+
+
+def rule_curves(rule_sizes: Sequence[int], num_robots: int, repeat: int) -> Dict[str, List[Tuple[int, float]]]:
+    # The rules go through the served or unserved requests of the original for every request, they are measured on
+    # larger inputs, where a quadratic path stands out from the time spent per request
+    curves = {}
+    for num_requests in rule_sizes:
+        for rule_name, followups in followups_of(synthetic_requests(num_requests), num_robots).items():
+            curves.setdefault("generate_followup_inputs:" + rule_name, []).append(
+                (num_requests, best_time(followups, repeat)))
+    return curves
+
+
+def robot_curves(work_dir: Path, robot_sizes: Sequence[int], num_requests: int,
+                 repeat: int) -> Dict[str, List[Tuple[int, float]]]:
+    curves = {"zip_to_results_dict_robots": []}
+    for num_robots in robot_sizes:
+        zip_path = synthetic_zip(work_dir.joinpath(f"original_{num_requests}_{num_robots}_2_0.zip"),
+                                 num_requests, num_robots)
+        curves["zip_to_results_dict_robots"].append((num_robots, best_time(lambda: read_zip(zip_path), repeat)))
+        for rule_name, followups in followups_of(synthetic_requests(num_requests), num_robots).items():
+            curves.setdefault("generate_followup_inputs_robots:" + rule_name, []).append(
+                (num_robots, best_time(followups, repeat)))
+    return curves
+
+
+def read_zip(zip_path: Path) -> Dict:
+    with zipfile.ZipFile(zip_path) as result_zip:
+        return SimulatorV2.zip_to_results_dict(result_zip)
+
+
+def followups_of(original_input: List[Request], num_robots: int) -> Dict[str, Callable[[], list]]:
+    # Generation of the follow-up inputs of every rule, by rule name. Half of the requests are served and half are not,
+    # the most the rules on served or unserved requests can be given to go through, whatever the simulation did.
+    original_result = {"robot_requests_db": pandas.DataFrame(
+        {"customer_request_id": [request.customer_request_id for request in original_input],
+         "request_type": "DELIVERY",
+         "status": ["COMPLETED" if i % 2 == 0 else "NEW" for i in range(len(original_input))]})}
+    simulator_config = {"service_start_time": SERVICE_START_TIME.replace(tzinfo=None),
+                        "service_end_time": SERVICE_END_TIME.replace(tzinfo=None),
+                        "num_customer_requests": len(original_input),
+                        "num_robots": num_robots,
+                        "robot_speed_kmph": 5,
+                        "robot_loading_capacity": 5,
+                        "num_operators": 2,
+                        "utilization_time_period": robot_windows(num_robots),
+                        "seed": 0}
+    return {rule.name: functools.partial(rule._generate_followup_inputs, original_input, original_result,
+                                         simulator_config)
+            for rule in rules()}
+
+
+def corpus_curve(work_dir: Path, corpus_sizes: Sequence[int], num_requests: int,
+                 num_robots: int) -> Dict[str, List[Tuple[int, float]]]:
+    # zip_to_csv over a folder of original and follow-up zips, half of each. The zips are links to the same two
+    # simulations, only their number changes.
+    original_zip = synthetic_zip(work_dir.joinpath("original.zip"), num_requests, num_robots)
+    followup_zip = synthetic_zip(work_dir.joinpath("followup.zip"), num_requests, num_robots, seed=1)
+    # The first call starts the workers of zip_to_csv, it is not part of the measurements
+    warm_up_dir = work_dir.joinpath("warm_up")
+    warm_up_dir.mkdir()
+    # zip_to_csv runs 30 workers, give each of them something to do
+    for i in range(60):
+        os.link(original_zip, warm_up_dir.joinpath(f"original_{num_requests}_{num_robots}_2_{i}.zip"))
+    with contextlib.redirect_stderr(io.StringIO()):
+        experiments_zip_to_csv.zip_to_csv(warm_up_dir, warm_up_dir)
+    curve = []
+    for corpus_size in corpus_sizes:
+        corpus_dir = work_dir.joinpath(f"corpus_{corpus_size}")
+        output_dir = work_dir.joinpath(f"csv_{corpus_size}")
+        corpus_dir.mkdir()
+        output_dir.mkdir()
+        for i in range(corpus_size // 2):
+            os.link(original_zip, corpus_dir.joinpath(f"original_{num_requests}_{num_robots}_2_{i}.zip"))
+            os.link(followup_zip,
+                    corpus_dir.joinpath(f"followup_RemoveRandomRequest_{num_requests}_{num_robots}_2_{i}_0.zip"))
+        with contextlib.redirect_stderr(io.StringIO()):
+            curve.append((corpus_size, best_time(lambda: experiments_zip_to_csv.zip_to_csv(corpus_dir, output_dir),
+                                                 1)))
+        shutil.rmtree(corpus_dir)
+    return {"zip_to_csv": curve}
+
+
+def main(request_sizes=REQUEST_SIZES, rule_sizes=RULE_SIZES, robot_sizes=ROBOT_SIZES, corpus_sizes=CORPUS_SIZES,
+         repeat: int = 3, tolerance: float = 0.35) -> int:
+    with tempfile.TemporaryDirectory() as work_dir:
+        curves = request_curves(Path(work_dir), request_sizes, 40, repeat)
+        curves.update(rule_curves(rule_sizes, 10, repeat))
+        curves.update(robot_curves(Path(work_dir), robot_sizes, 400, repeat))
+        if len(corpus_sizes) > 0:
+            curves.update(corpus_curve(Path(work_dir), corpus_sizes, 100, 10))
+
+    print("benchmark,size,seconds,per_second")
+    for name, curve in curves.items():
+        for size, seconds in curve:
+            print(f"{name},{size},{seconds:.6f},{size / seconds:.1f}")
+    print()
+    print("benchmark,exponent,max_exponent,regressed")
+    regressions = 0
+    for name, curve in curves.items():
+        if len(curve) < 2:
+            continue
+        exponent = scaling_exponent(*zip(*curve))
+        max_exponent = MAX_EXPONENTS.get(name, MAX_EXPONENTS[name.split(":")[0]])
+        regressed = exponent > max_exponent + tolerance
+        regressions += regressed
+        print(f"{name},{exponent:.3f},{max_exponent},{regressed}")
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="pipeline_scaling")
+    parser.add_argument("--request_sizes", type=int, nargs="+", default=REQUEST_SIZES)
+    parser.add_argument("--rule_sizes", type=int, nargs="*", default=RULE_SIZES)
+    parser.add_argument("--robot_sizes", type=int, nargs="*", default=ROBOT_SIZES)
+    parser.add_argument("--corpus_sizes", type=int, nargs="*", default=CORPUS_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.35)
+    args = parser.parse_args()
+    exit(main(args.request_sizes, args.rule_sizes, args.robot_sizes, args.corpus_sizes, args.repeat, args.tolerance))
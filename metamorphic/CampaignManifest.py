@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from metamorphic.MetamorphicRule import MetamorphicRule
+
+PLANNED = "planned"
+RUNNING = "running"
+DONE = "done"
+CRASHED = "crashed"
+# Rule and index of the row of an original run
+ORIGINAL_RULE = ""
+ORIGINAL_IDX = -1
+
+
+# Status of every original run and follow-up of a campaign, by (seed, config, rule, followup_idx), kept in an SQLite
+# database shared by the workers. A run is only recorded as done once its zip is complete, so resuming a campaign
+# looks its results up here instead of probing bin/result. The row of an original run is complete once the
+# results of all its follow-ups were recorded, after the rows of the seed were written to the result sink if there is
+# one; outstanding lists the (seed, config) pairs that still have work. Every start of an original run and every
+# recorded follow-up counts as an attempt, a run that is not done after max_attempts of them is given up on instead of
+# crashing again on every resume.
+class CampaignManifest:
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+        self._connection = None
+        self._connection_pid = None
+        with self._lock:
+            self._execute("CREATE TABLE IF NOT EXISTS runs ("
+                          "seed TEXT NOT NULL, "
+                          "config TEXT NOT NULL, "
+                          "rule TEXT NOT NULL, "
+                          "followup_idx INTEGER NOT NULL, "
+                          "status TEXT NOT NULL, "
+                          "zip_name TEXT, "
+                          "attempts INTEGER NOT NULL DEFAULT 0, "
+                          "complete INTEGER NOT NULL DEFAULT 0, "
+                          "updated REAL NOT NULL, "
+                          "PRIMARY KEY (seed, config, rule, followup_idx))")
+            self._execute("CREATE INDEX IF NOT EXISTS runs_zip_name ON runs (zip_name)")
+            self._execute("CREATE INDEX IF NOT EXISTS runs_outstanding ON runs (status, complete)")
+
+    def __getstate__(self):
+        # Connections are not shared between processes, each process opens its own
+        state = dict(self.__dict__)
+        state["_connection"] = None
+        state["_connection_pid"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.connection.execute(sql, parameters)
+
+    @staticmethod
+    def config_key(simulator_config: Dict) -> str:
+        # The configuration as it appears in the names of the zips, without the seed
+        _simulator_config, utilization_time_period_str = MetamorphicRule._prepare_config(simulator_config)
+        return (str(_simulator_config["num_customer_requests"])
+                + "_" + str(_simulator_config["num_robots"])
+                + "_" + str(_simulator_config["num_operators"])
+                + utilization_time_period_str)
+
+    def plan(self, seed_configs: Iterable[Tuple[str, str]]):
+        # Adds the original runs of a campaign that are not in the manifest yet, in a single transaction
+        now = time.time()
+        with self._lock:
+            self._execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO runs (seed, config, rule, followup_idx, status, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(str(seed), config, ORIGINAL_RULE, ORIGINAL_IDX, PLANNED, now) for seed, config in seed_configs])
+                self._execute("COMMIT")
+            except BaseException:
+                self._execute("ROLLBACK")
+                raise
+
+    def start(self, seed: str, config: str):
+        # The original run of (seed, config) is starting, its follow-ups will be recorded again
+        with self._lock:
+            self._execute("INSERT INTO runs (seed, config, rule, followup_idx, status, attempts, updated) "
+                          "VALUES (?, ?, ?, ?, ?, 1, ?) "
+                          "ON CONFLICT (seed, config, rule, followup_idx) DO UPDATE SET "
+                          "status = CASE WHEN status = ? THEN status ELSE ? END, "
+                          "attempts = attempts + 1, complete = 0, updated = excluded.updated",
+                          (str(seed), config, ORIGINAL_RULE, ORIGINAL_IDX, RUNNING, time.time(), DONE, RUNNING))
+
+    def finish_original(self, seed: str, config: str, status: str, zip_name: Optional[str]):
+        with self._lock:
+            self._execute("UPDATE runs SET status = ?, zip_name = ?, updated = ? "
+                          "WHERE seed = ? AND config = ? AND rule = ? AND followup_idx = ?",
+                          (status, zip_name, time.time(), str(seed), config, ORIGINAL_RULE, ORIGINAL_IDX))
+
+    def finish_followups(self, seed: str, config: str, followups: List[Tuple[str, int, str, Optional[str]]]):
+        # Records the rule, index, status and zip name of every follow-up of (seed, config) and completes its original
+        # run, in a single transaction. zip_name is None for a crashed follow-up.
+        now = time.time()
+        with self._lock:
+            self._execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT INTO runs "
+                    "(seed, config, rule, followup_idx, status, zip_name, attempts, complete, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 1, 1, ?) "
+                    "ON CONFLICT (seed, config, rule, followup_idx) DO UPDATE SET "
+                    "status = excluded.status, zip_name = excluded.zip_name, attempts = attempts + 1, "
+                    "updated = excluded.updated",
+                    [(str(seed), config, rule, followup_idx, status, zip_name, now)
+                     for rule, followup_idx, status, zip_name in followups])
+                self._execute("UPDATE runs SET complete = 1, updated = ? "
+                              "WHERE seed = ? AND config = ? AND rule = ? AND followup_idx = ?",
+                              (now, str(seed), config, ORIGINAL_RULE, ORIGINAL_IDX))
+                self._execute("COMMIT")
+            except BaseException:
+                self._execute("ROLLBACK")
+                raise
+
+    def has_zip(self, zip_name: str) -> bool:
+        # True if a run recorded as done has this complete zip
+        with self._lock:
+            return self._execute("SELECT 1 FROM runs WHERE zip_name = ? AND status = ? LIMIT 1",
+                                 (zip_name, DONE)).fetchone() is not None
+
+    def outstanding(self) -> List[Tuple[str, str]]:
+        # (seed, config) pairs whose original run or one of its follow-ups is not done: planned, running in a worker
+        # that died, crashed, or done without the results of every follow-up, in fewer than max_attempts attempts
+        with self._lock:
+            return self._execute("SELECT DISTINCT seed, config FROM runs "
+                                 "WHERE (status != ? OR complete = 0) AND attempts < ? "
+                                 "ORDER BY seed, config", (DONE, self.max_attempts)).fetchall()
+
+    def given_up(self) -> List[Tuple[str, str]]:
+        # (seed, config) pairs with a run that is still not done after max_attempts attempts
+        with self._lock:
+            return self._execute("SELECT DISTINCT seed, config FROM runs "
+                                 "WHERE (status != ? OR complete = 0) AND attempts >= ? "
+                                 "ORDER BY seed, config", (DONE, self.max_attempts)).fetchall()
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._execute("SELECT status, COUNT(*) FROM runs GROUP BY status").fetchall())
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Need to provide path to the manifest of a campaign")
+        exit(1)
+    manifest = CampaignManifest(sys.argv[1])
+    print(", ".join(status + ": " + str(count) for status, count in sorted(manifest.counts().items())))
+    for seed, config in manifest.outstanding():
+        print(seed, config)
+    for seed, config in manifest.given_up():
+        print(seed, config, "given up")
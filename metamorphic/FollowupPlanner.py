@@ -0,0 +1,146 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Callable
+
+from metamorphic.MetamorphicRule import MetamorphicRule
+from simulator.result_cache import canonical_simulation_input, link_or_copy
+from simulator.timing import span
+from Request import Request
+
+
+# Collects the follow-ups of every rule for one source test case before running any of them, so that follow-ups with
+# the same content are simulated once and follow-ups identical to the original reuse the original result.
+class FollowupPlanner:
+
+    def __init__(self, rules: List[MetamorphicRule]):
+        self.rules = rules
+        self.planned_followups = 0
+        self.simulated_followups = 0
+
+    @property
+    def saved_simulations(self) -> int:
+        return self.planned_followups - self.simulated_followups
+
+    @staticmethod
+    def _content(simulator_config: Dict, requests: List[Request]) -> str:
+        return canonical_simulation_input(dict(simulator_config, demand_mode="file"),
+                                          [request.to_csv() for request in requests])
+
+    def is_followed(self,
+                    simulator_config: Dict,
+                    original_input: List[Request],
+                    original_result: Dict,
+                    on_result: Callable[[MetamorphicRule, int, Optional[Dict], Optional[bool]], None] = None
+                    ) -> List[List[Optional[bool]]]:
+        # Same as calling is_followed on every rule, returns one list of verdicts per rule. on_result is called for
+        # every follow-up of every rule, including those sharing the result of another one.
+        original_config, utilization_time_period_str = MetamorphicRule._prepare_config(simulator_config)
+        original_content = self._content(original_config, original_input)
+        original_zip_name = ("original_" + str(original_config["num_customer_requests"])
+                             + "_" + str(original_config["num_robots"])
+                             + "_" + str(original_config["num_operators"])
+                             + utilization_time_period_str
+                             + "_" + str(original_config["seed"]) + ".zip")
+
+        # Follow-ups grouped by content, in the order they are first planned
+        groups: Dict[str, List[Tuple[int, int, str, Dict, List[Request]]]] = {}
+        number_of_followups = []
+        for rule_idx, rule in enumerate(self.rules):
+            followups = rule._plan_followups(simulator_config, original_input, original_result)
+            number_of_followups.append(len(followups))
+            for followup_idx, (followup_sim_id, followup_conf, followup_reqs) in enumerate(followups):
+                groups.setdefault(self._content(followup_conf, followup_reqs), []) \
+                    .append((rule_idx, followup_idx, followup_sim_id, followup_conf, followup_reqs))
+
+        verdicts: List[List[Optional[bool]]] = [[None] * n for n in number_of_followups]
+        results = self._run_groups(groups, original_content, original_result)
+        aliases = []
+        for (content, group), followup_result in zip(groups.items(), results):
+            self.planned_followups += len(group)
+            if content == original_content:
+                aliases.extend((original_zip_name, sim_id) for _, _, sim_id, _, _ in group)
+            else:
+                self.simulated_followups += 1
+                aliases.extend(("followup_" + group[0][2] + ".zip", sim_id) for _, _, sim_id, _, _ in group[1:])
+            for rule_idx, followup_idx, _, _, _ in group:
+                if followup_result is not None:
+                    with span("verdict", rule=self.rules[rule_idx].name, followup=followup_idx):
+                        verdicts[rule_idx][followup_idx] = self.rules[rule_idx]._is_followed(original_result,
+                                                                                             followup_result)
+                if on_result is not None:
+                    on_result(self.rules[rule_idx], followup_idx, followup_result, verdicts[rule_idx][followup_idx])
+
+        self._link_aliases(aliases)
+        return verdicts
+
+    def _run_groups(self,
+                    groups: Dict[str, List[Tuple[int, int, str, Dict, List[Request]]]],
+                    original_content: str,
+                    original_result: Dict) -> List[Optional[Dict]]:
+        # One result per group, None if its simulation crashed. A simulator with run_all (the batched stand-in, the
+        # asyncio simulator) gets every follow-up that was not simulated before in a single call.
+        simulator = self.rules[0].simulator
+        if not hasattr(simulator, "run_all"):
+            results = []
+            for content, group in groups.items():
+                rule_idx, followup_idx = group[0][:2]
+                if content == original_content:
+                    results.append(original_result)
+                    continue
+                with span("followup", rule=self.rules[rule_idx].name, followup=followup_idx):
+                    results.append(self.rules[rule_idx]._run_followup(*group[0][2:],
+                                                                      self._stop(group, original_result)))
+            return results
+
+        results: List[Optional[Dict]] = []
+        simulations, indices, paths = [], [], []
+        for content, group in groups.items():
+            rule_idx, followup_idx, followup_sim_id, followup_conf, followup_reqs = group[0]
+            if content == original_content:
+                results.append(original_result)
+                continue
+            results.append(self.rules[rule_idx]._lookup_followup(followup_sim_id, followup_conf, followup_reqs))
+            if results[-1] is None:
+                with span("write_csv", rule=self.rules[rule_idx].name, followup=followup_idx):
+                    followup_file_descriptor, followup_path = tempfile.mkstemp(".csv")
+                    os.close(followup_file_descriptor)
+                    Request.write_test_to_csv(followup_path, followup_reqs, version=2)
+                simulations.append(dict(followup_conf, sim_name="followup", sim_id=followup_sim_id,
+                                        demand_file=followup_path, demand_mode="file"))
+                stop = self._stop(group, original_result)
+                if stop is not None and simulator.supports_early_termination:
+                    simulations[-1]["stop"] = stop
+                indices.append(len(results) - 1)
+                paths.append(followup_path)
+        try:
+            with span("run_all"):
+                all_results = simulator.run_all(simulations) if simulations else []
+            for i, followup_result in zip(indices, all_results):
+                results[i] = followup_result
+        finally:
+            for path in paths:
+                os.remove(path)
+        return results
+
+    def _stop(self,
+              group: List[Tuple[int, int, str, Dict, List[Request]]],
+              original_result: Dict) -> Optional[Callable[[int, int], bool]]:
+        # A follow-up shared by several rules can only stop once the verdict of every one of them is known
+        stops = [self.rules[rule_idx]._verdict_settled(original_result) for rule_idx, _, _, _, _ in group]
+        if any(stop is None for stop in stops):
+            return None
+        return lambda delivered, deliverable: all(stop(delivered, deliverable) for stop in stops)
+
+    def _link_aliases(self, aliases: List[Tuple[str, str]]):
+        # Follow-ups that were not simulated get the zip of the run they share their result with, another follow-up or
+        # the original, so that every follow-up still has a result under its own name
+        if len(aliases) == 0:
+            return
+        simulator = self.rules[0].simulator
+        simulator.wait_for_archives()
+        result_dir = Path(simulator.simulator_dir).joinpath("bin", "result")
+        for simulated_zip_name, alias_sim_id in aliases:
+            simulated_zip = result_dir.joinpath(simulated_zip_name)
+            if simulated_zip.is_file():
+                link_or_copy(simulated_zip, result_dir.joinpath("followup_" + alias_sim_id + ".zip"))
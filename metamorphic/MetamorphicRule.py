@@ -4,18 +4,25 @@ import zipfile
 from abc import ABC, abstractmethod
 from pathlib import Path
 from subprocess import CalledProcessError
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, Callable
 
+from simulator import Simulator
 from simulator.simulator_v2 import SimulatorV2
+from simulator.timing import span
 from Request import Request
 
 
 class MetamorphicRule(ABC):
+    # _is_followed only compares Simulator.NUM_DELIVERED of both results, and its verdict cannot change back once the
+    # follow-up delivered more (or less). Rules comparing anything else must set this to False.
+    monotone_in_delivered = True
     points_by_distance = ['T21', 'T19', 'T29', 'T01', 'T23', 'T17', 'T18', 'T27', 'T24', 'T43', 'T14', 'T26', 'T15',
                           'T05', 'T22', 'T20', 'T16', 'T08', 'T42', 'T06', 'T28', 'T12', 'T04', 'T25', 'T40', 'T35',
                           'T70', 'T38', 'T36', 'T02', 'T10', 'T34', 'T09', 'T03', 'T41', 'T11', 'T50', 'T37', 'T61',
                           'T33', 'T74', 'T39', 'T52', 'T48', 'T63', 'T31', 'T75', 'T73', 'T49', 'T46', 'T54', 'T72',
                           'T71', 'T76', 'T51', 'T47', 'T60', 'T45', 'T53', 'T64', 'T67', 'T62', 'T65', 'T66']
+    # Position of every target in points_by_distance
+    distance_rank = {target: i for i, target in enumerate(points_by_distance)}
 
     def __init__(self,
                  failure_direction: bool,  # True if breaking the rule means the original result is not optimal
@@ -23,6 +30,8 @@ class MetamorphicRule(ABC):
         self.failure_direction = failure_direction
         self.simulator = simulator
         self.name = "dummy"
+        # CampaignManifest recording the complete zips of the campaign, looked up instead of bin/result when set
+        self.manifest = None
 
     @abstractmethod
     def _generate_followup_inputs(self,
@@ -37,11 +46,25 @@ class MetamorphicRule(ABC):
                      followup_result) -> bool:
         pass
 
-    def is_followed(self,
-                    simulator_config: Dict,
-                    original_input: List[Request],
-                    original_result=None) -> Optional[List[Optional[bool]]]:
-        # We set the demand mode and file in this method
+    @staticmethod
+    def _requests_with_status(original_input: List[Request], original_result: Dict, status: str) -> List[Request]:
+        # Requests of the original input whose delivery ended with the given status, in input order
+        robot_requests_db = original_result["robot_requests_db"]
+        ids = set(robot_requests_db.loc[(robot_requests_db["request_type"] == "DELIVERY")
+                                        & (robot_requests_db["status"] == status)]["customer_request_id"].values)
+        return [r for r in original_input if r.customer_request_id in ids]
+
+    @staticmethod
+    def _first_positions(requests: List[Request]) -> Dict[Request, int]:
+        # Position of the first request equal to each request, what list.index and list.remove look for
+        positions = {}
+        for i, request in enumerate(requests):
+            positions.setdefault(request, i)
+        return positions
+
+    @staticmethod
+    def _prepare_config(simulator_config: Dict) -> Tuple[Dict, str]:
+        # We set the demand mode and file when running the simulations
         _simulator_config = dict(simulator_config)
         if "demand_mode" in _simulator_config:
             _simulator_config.pop("demand_mode")
@@ -51,77 +74,139 @@ class MetamorphicRule(ABC):
                                                                        + tup[1].isoformat("minutes"),
                                                            _simulator_config["utilization_time_period"])))
                                        if "utilization_time_period" in _simulator_config else "").replace(":", "")
+        return _simulator_config, utilization_time_period_str
+
+    def _followup_sim_id(self, simulator_config: Dict, utilization_time_period_str: str, followup_idx: int) -> str:
+        return (self.name + "_"
+                + str(simulator_config["num_customer_requests"])
+                + "_" + str(simulator_config["num_robots"])
+                + "_" + str(simulator_config["num_operators"])
+                + utilization_time_period_str
+                + "_" + str(simulator_config["seed"])
+                + "_" + str(followup_idx))
+
+    def _plan_followups(self,
+                        simulator_config: Dict,
+                        original_input: List[Request],
+                        original_result: Dict) -> List[Tuple[str, Dict, List[Request]]]:
+        # Returns the sim_id, simulator configuration and requests of every follow-up, without running them
+        _simulator_config, utilization_time_period_str = self._prepare_config(simulator_config)
+        followups = []
+        with span("generate_followups", rule=self.name):
+            followup_inputs = self._generate_followup_inputs(original_input, original_result, _simulator_config)
+        for i, (followup_conf, followup_reqs) in enumerate(followup_inputs):
+            if not followup_conf:
+                followup_conf = _simulator_config
+            if "demand_file" in followup_conf:
+                followup_conf.pop("demand_file")
+            followups.append((self._followup_sim_id(_simulator_config, utilization_time_period_str, i),
+                              followup_conf,
+                              followup_reqs))
+        return followups
+
+    def _verdict_settled(self, original_result: Dict) -> Optional[Callable[[int, int], bool]]:
+        # Stop predicate for a follow-up run: the verdict is known once it is the same for the fewest and the most
+        # baggage the follow-up can still end up delivering
+        if not self.monotone_in_delivered:
+            return None
+        return lambda delivered, deliverable: \
+            self._is_followed(original_result, {Simulator.NUM_DELIVERED: delivered}) == \
+            self._is_followed(original_result, {Simulator.NUM_DELIVERED: deliverable})
+
+    def _lookup_followup(self,
+                         followup_sim_id: str,
+                         followup_conf: Dict,
+                         followup_reqs: List[Request]) -> Optional[Dict]:
+        # Returns the result of a follow-up that was already simulated, or None
+        if self.simulator.result_cache is not None:
+            # Results are found by the content of the follow-up, whatever name they were first simulated under
+            return self.simulator.lookup_result("followup",
+                                                followup_sim_id,
+                                                dict(followup_conf, demand_mode="file"),
+                                                followup_reqs)
+        elif (self.manifest.has_zip("followup_" + followup_sim_id + ".zip") if self.manifest is not None
+              else Path(self.simulator.simulator_dir).joinpath("bin", "result",
+                                                               "followup_" + followup_sim_id + ".zip").is_file()):
+            with span("parse_zip"):
+                with zipfile.ZipFile(Path(self.simulator.simulator_dir).joinpath("bin", "result",
+                                                                                 "followup_" + followup_sim_id + ".zip")
+                                     ) as followup_zip:
+                    return SimulatorV2.zip_to_results_dict(followup_zip)
+        return None
+
+    def _run_followup(self,
+                      followup_sim_id: str,
+                      followup_conf: Dict,
+                      followup_reqs: List[Request],
+                      stop: Callable[[int, int], bool] = None) -> Optional[Dict]:
+        # Returns None if the simulation crashed. A simulator that supports early termination stops the run once stop
+        # holds, and flags the result as truncated.
+        followup_result = self._lookup_followup(followup_sim_id, followup_conf, followup_reqs)
+        if followup_result is not None:
+            return followup_result
+        with span("write_csv"):
+            followup_file_descriptor, followup_path = tempfile.mkstemp(".csv")
+            os.close(followup_file_descriptor)
+            Request.write_test_to_csv(followup_path, followup_reqs, version=2)
+        if stop is not None and self.simulator.supports_early_termination:
+            followup_conf = dict(followup_conf, stop=stop)
+        try:
+            return self.simulator.run_simulation("followup",
+                                                 followup_sim_id,
+                                                 demand_file=followup_path,
+                                                 demand_mode="file",
+                                                 **followup_conf)
+        except CalledProcessError:
+            return None
+        finally:
+            os.remove(followup_path)
+
+    def is_followed(self,
+                    simulator_config: Dict,
+                    original_input: List[Request],
+                    original_result=None,
+                    on_result: Callable[["MetamorphicRule", int, Optional[Dict], Optional[bool]], None] = None
+                    ) -> Optional[List[Optional[bool]]]:
+        # on_result is called with the rule, index, result and verdict of every follow-up as soon as it is known
+        _simulator_config, utilization_time_period_str = self._prepare_config(simulator_config)
         if not original_result:
-            original_file_descriptor, original_path = tempfile.mkstemp(".csv")
-            os.close(original_file_descriptor)
-            Request.write_test_to_csv(original_path, original_input, version=2)
+            original_sim_id = (str(simulator_config["num_customer_requests"]) +
+                               "_" + str(simulator_config["num_robots"]) +
+                               "_" + str(simulator_config["num_operators"]) +
+                               utilization_time_period_str +
+                               "_" + str(_simulator_config["seed"]))
+            original_result = self.simulator.lookup_result("original",
+                                                           original_sim_id,
+                                                           dict(_simulator_config, demand_mode="file"),
+                                                           original_input)
+        if not original_result:
+            with span("write_csv", rule=self.name):
+                original_file_descriptor, original_path = tempfile.mkstemp(".csv")
+                os.close(original_file_descriptor)
+                Request.write_test_to_csv(original_path, original_input, version=2)
             try:
-                original_result = self.simulator.run_simulation("original",
-                                                                str(simulator_config["num_customer_requests"]) +
-                                                                "_" + str(simulator_config["num_robots"]) +
-                                                                "_" + str(simulator_config["num_operators"]) +
-                                                                utilization_time_period_str +
-                                                                "_" + str(_simulator_config["seed"]),
-                                                                demand_file=original_path,
-                                                                demand_mode="file",
-                                                                **_simulator_config)
+                with span("original", rule=self.name):
+                    original_result = self.simulator.run_simulation("original",
+                                                                    original_sim_id,
+                                                                    demand_file=original_path,
+                                                                    demand_mode="file",
+                                                                    **_simulator_config)
             except CalledProcessError:
                 return None  # Simulation crashed, we don't know if the rule is followed
             finally:
                 os.remove(original_path)
 
-        followup_inputs = self._generate_followup_inputs(original_input, original_result, _simulator_config)
         ret = []
-
-        for i, followup_input in enumerate(followup_inputs):
-            if Path(self.simulator.simulator_dir).joinpath("bin", "result", "followup"
-                                                                            + "_" + self.name
-                                                                            + "_" + str(_simulator_config["num_customer_requests"])
-                                                                            + "_" + str(_simulator_config["num_robots"])
-                                                                            + "_" + str(_simulator_config["num_operators"])
-                                                                            + utilization_time_period_str
-                                                                            + "_" + str(_simulator_config["seed"])
-                                                                            + "_" + str(i)
-                                                                            + ".zip"
-                                                           ).is_file():
-                with zipfile.ZipFile(Path(self.simulator.simulator_dir)
-                                             .joinpath("bin", "result", "followup"
-                                                                        + "_" + self.name
-                                                                        + "_" + str(_simulator_config["num_customer_requests"])
-                                                                        + "_" + str(_simulator_config["num_robots"])
-                                                                        + "_" + str(_simulator_config["num_operators"])
-                                                                        + utilization_time_period_str
-                                                                        + "_" + str(_simulator_config["seed"])
-                                                                        + "_" + str(i)
-                                                                        + ".zip"
-                                                       )
-                                     ) as followup_zip:
-                    followup_result = SimulatorV2.zip_to_results_dict(followup_zip)
-            else:
-                followup_conf, followup_reqs = followup_input
-                if not followup_conf:
-                    followup_conf = _simulator_config
-                if "demand_file" in followup_conf:
-                    followup_conf.pop("demand_file")
-                followup_file_descriptor, followup_path = tempfile.mkstemp(".csv")
-                os.close(followup_file_descriptor)
-                Request.write_test_to_csv(followup_path, followup_reqs, version=2)
-                try:
-                    followup_result = self.simulator.run_simulation("followup",
-                                                                    (self.name + "_"
-                                                                     + str(simulator_config["num_customer_requests"])
-                                                                     + "_" + str(simulator_config["num_robots"])
-                                                                     + "_" + str(simulator_config["num_operators"])
-                                                                     + utilization_time_period_str
-                                                                     + "_" + str(_simulator_config["seed"])
-                                                                     + "_" + str(i)),
-                                                                    demand_file=followup_path,
-                                                                    demand_mode="file",
-                                                                    **followup_conf)
-                except CalledProcessError:
+        for followup_idx, (followup_sim_id, followup_conf, followup_reqs) in enumerate(
+                self._plan_followups(simulator_config, original_input, original_result)):
+            with span("followup", rule=self.name, followup=followup_idx):
+                followup_result = self._run_followup(followup_sim_id, followup_conf, followup_reqs,
+                                                     self._verdict_settled(original_result))
+                if followup_result is None:
                     ret.append(None)  # Simulation crashed, we don't know if the rule is followed
-                    continue
-                finally:
-                    os.remove(followup_path)
-            ret.append(self._is_followed(original_result, followup_result))
+                else:
+                    with span("verdict"):
+                        ret.append(self._is_followed(original_result, followup_result))
+            if on_result is not None:
+                on_result(self, followup_idx, followup_result, ret[-1])
         return ret
@@ -23,25 +23,20 @@ class RemoveSystematicUnservedRequestRule(MetamorphicRule):
                                   simulator_configuration: Dict):
         followup_inputs = []
 
-        original_robot_requests_db = original_result["robot_requests_db"]
-        unserved_requests_ids = \
-            original_robot_requests_db.loc[(original_robot_requests_db["request_type"] == "DELIVERY")
-                                           & (original_robot_requests_db["status"] == "NEW")][
-                "customer_request_id"]
-        unserved_requests = list(
-            filter(lambda r: r.customer_request_id in unserved_requests_ids.values, original_input))
+        unserved_requests = self._requests_with_status(original_input, original_result, "NEW")
         unserved_requests = sorted(unserved_requests,
-                                   key=lambda r: self.points_by_distance.index(r.delivery_target))
+                                   key=lambda r: self.distance_rank[r.delivery_target])
 
         number_followups = min(self.number_followups, len(unserved_requests))
 
+        positions = self._first_positions(original_input)
         for i in range(number_followups):
             index_to_remove = math.floor(i * (len(unserved_requests) - 1)
                                          / (number_followups - 1)) if number_followups > 1 else 0
             request_to_remove = unserved_requests[index_to_remove]
             followup_input = []
             followup_input.extend(original_input)
-            followup_input.remove(request_to_remove)
+            del followup_input[positions[request_to_remove]]
             followup_inputs.append((None, followup_input))
 
         return followup_inputs
@@ -0,0 +1,151 @@
+import atexit
+import os
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas
+
+from simulator import Simulator
+
+ORIGINAL_COLUMNS = ["seed", "num_customer_requests", "num_robots", "num_operators", "utilization_time_period",
+                    Simulator.NUM_DELIVERED, Simulator.DELIVERY_RATE, Simulator.UTILIZATION_RATE, Simulator.NUM_RISKS]
+FOLLOWUP_COLUMNS = ["rule", "followup_idx"] + ORIGINAL_COLUMNS + ["followed", "truncated"]
+# Rows with the same key describe the same run, the last one written wins
+KEYS = {"original": ["seed", "num_customer_requests", "num_robots", "num_operators", "utilization_time_period"],
+        "followup": ["rule", "followup_idx", "seed", "num_customer_requests", "num_robots", "num_operators",
+                     "utilization_time_period"]}
+COLUMNS = {"original": ORIGINAL_COLUMNS, "followup": FOLLOWUP_COLUMNS}
+
+_lock = threading.Lock()
+# Buffered rows of this process by sink directory, then table, then column
+_buffers: Dict[str, Dict[str, Dict[str, List]]] = {}
+_buffered_rows: Dict[str, int] = {}
+_first_row_time: Dict[str, float] = {}
+
+
+# Rows of the original and follow-up runs of a campaign, with the columns of experiments_zip_to_csv. Every process
+# buffers its rows by column and appends them to the sink directory as a new segment file on flush, which run_seed calls
+# at the end of every seed, and also when the buffer is full, is older than max_delay_seconds, or the process exits.
+# Segments are written under a temporary name and renamed, so a worker killed halfway loses the rows of its current
+# seed but never leaves a partial segment. collect merges the segments into original_results.csv and
+# followup_results.csv.
+class ResultSink:
+
+    def __init__(self, sink_dir: str, buffer_rows: int = 1000, max_delay_seconds: float = 60.0):
+        self.sink_dir = str(Path(sink_dir).absolute())
+        self.buffer_rows = buffer_rows
+        self.max_delay_seconds = max_delay_seconds
+        Path(self.sink_dir).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _metrics(result: Optional[Dict]) -> Dict:
+        if result is None:
+            return {Simulator.NUM_DELIVERED: None, Simulator.DELIVERY_RATE: None, Simulator.UTILIZATION_RATE: None,
+                    Simulator.NUM_RISKS: None}
+        return {Simulator.NUM_DELIVERED: result[Simulator.NUM_DELIVERED],
+                Simulator.DELIVERY_RATE: result[Simulator.DELIVERY_RATE],
+                Simulator.UTILIZATION_RATE: result[Simulator.UTILIZATION_RATE].values,
+                Simulator.NUM_RISKS: result[Simulator.NUM_RISKS]}
+
+    @staticmethod
+    def _config(simulator_config: Dict, utilization_time_period_str: str) -> Dict:
+        # The configuration as experiments_zip_to_csv reads it from the name of a zip
+        return {"seed": simulator_config["seed"],
+                "num_customer_requests": simulator_config["num_customer_requests"],
+                "num_robots": simulator_config["num_robots"],
+                "num_operators": simulator_config["num_operators"],
+                "utilization_time_period": utilization_time_period_str.split("_")[1:]}
+
+    def add_original(self, simulator_config: Dict, utilization_time_period_str: str, original_result: Dict):
+        self._add("original", dict(self._config(simulator_config, utilization_time_period_str),
+                                   **self._metrics(original_result)))
+
+    def add_followup(self,
+                     simulator_config: Dict,
+                     utilization_time_period_str: str,
+                     rule_name: str,
+                     followup_idx: int,
+                     followup_result: Optional[Dict],
+                     followed: Optional[bool]):
+        # A crashed follow-up has no result, its metrics and verdict are left empty
+        self._add("followup", dict(rule=rule_name, followup_idx=followup_idx,
+                                   **self._config(simulator_config, utilization_time_period_str),
+                                   **self._metrics(followup_result),
+                                   followed=followed,
+                                   truncated=bool(followup_result.get("truncated", False))
+                                   if followup_result is not None else None))
+
+    def _add(self, table: str, row: Dict):
+        with _lock:
+            buffer = _buffers.setdefault(self.sink_dir, {})
+            columns = buffer.setdefault(table, {column: [] for column in COLUMNS[table]})
+            for column in COLUMNS[table]:
+                columns[column].append(row[column])
+            _buffered_rows[self.sink_dir] = _buffered_rows.get(self.sink_dir, 0) + 1
+            _first_row_time.setdefault(self.sink_dir, time.monotonic())
+            full = (_buffered_rows[self.sink_dir] >= self.buffer_rows
+                    or time.monotonic() - _first_row_time[self.sink_dir] >= self.max_delay_seconds)
+        if full:
+            self.flush()
+
+    def flush(self):
+        _flush(self.sink_dir)
+
+    @staticmethod
+    def collect(sink_dir: str, output_folder_path: str):
+        # Merges the segments of every process into one CSV file per table, without the rows written again for a run
+        # that was resumed
+        for table in ["original", "followup"]:
+            segments = sorted(Path(sink_dir).glob(table + "_segment_*.csv"),
+                              key=lambda path: (path.stat().st_mtime, path.name))
+            if len(segments) == 0:
+                dataframe = pandas.DataFrame(columns=COLUMNS[table])
+            else:
+                dataframe = pandas.concat([pandas.read_csv(segment, dtype=str, keep_default_na=False)
+                                           for segment in segments], ignore_index=True)
+                dataframe = dataframe.drop_duplicates(subset=KEYS[table], keep="last")
+            dataframe.to_csv(Path(output_folder_path).joinpath(table + "_results.csv"), index=False)
+
+
+def _flush(sink_dir: str):
+    # Appends the buffered rows of this process as a new segment per table. Segments are named after the time they are
+    # written, so that a process of a resumed campaign with the same pid never replaces one. They are synced to disk
+    # before returning, so that the manifest may record their seed as complete once this returns.
+    with _lock:
+        buffer = _buffers.pop(sink_dir, {})
+        _buffered_rows.pop(sink_dir, None)
+        _first_row_time.pop(sink_dir, None)
+    if len(buffer) == 0:
+        return
+    for table, columns in buffer.items():
+        segment_path = Path(sink_dir, f"{table}_segment_{socket.gethostname()}_{os.getpid()}_{time.time_ns()}.csv")
+        temporary_path = segment_path.with_suffix(".tmp")
+        with open(temporary_path, "w", newline="") as segment_file:
+            pandas.DataFrame(columns).to_csv(segment_file, index=False)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        os.replace(temporary_path, segment_path)
+    directory = os.open(sink_dir, os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def _flush_all():
+    for sink_dir in list(_buffers):
+        _flush(sink_dir)
+
+
+atexit.register(_flush_all)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Need to provide the result sink directory of a campaign and path to output folder")
+        exit(1)
+    ResultSink.collect(sys.argv[1], sys.argv[2])
@@ -23,26 +23,24 @@ class ServedCloserMax(MetamorphicRule):
                                   simulator_configuration: Dict):
         followup_inputs = []
 
-        original_robot_requests_db = original_result["robot_requests_db"]
-        served_requests_ids = original_robot_requests_db.loc[(original_robot_requests_db["request_type"] == "DELIVERY")
-                                                             & (original_robot_requests_db["status"] == "COMPLETED")]["customer_request_id"]
-        served_requests = list(filter(lambda r: r.customer_request_id in served_requests_ids.values, original_input))
+        served_requests = self._requests_with_status(original_input, original_result, "COMPLETED")
         served_requests = sorted(served_requests,
-                                 key=lambda r: self.points_by_distance.index(r.delivery_target))
+                                 key=lambda r: self.distance_rank[r.delivery_target])
 
         number_followups = min(len(served_requests), self.number_followups)
 
+        positions = self._first_positions(original_input)
         for i in range(number_followups):
             followup_requests = []
             followup_requests.extend(original_input)
             index_to_modify = math.floor(i * (len(served_requests) - 1)
                                          / (number_followups - 1)) if number_followups > 1 else 0
             request_to_modify = served_requests[index_to_modify]
-            points_closer = self.points_by_distance[:self.points_by_distance.index(request_to_modify.delivery_target)]
+            points_closer = self.points_by_distance[:self.distance_rank[request_to_modify.delivery_target]]
             if len(points_closer) > 0:
                 changed_request = copy.copy(request_to_modify)
                 changed_request.delivery_target = points_closer[0]
-                followup_requests[followup_requests.index(request_to_modify)] = changed_request
+                followup_requests[positions[request_to_modify]] = changed_request
                 followup_inputs.append((None, followup_requests))
 
         return followup_inputs
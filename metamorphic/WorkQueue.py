@@ -0,0 +1,226 @@
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+# A (seed, config) pair of a campaign leased by a runner
+class WorkItem(NamedTuple):
+    seed: str
+    config: str
+    attempts: int
+
+
+def worker_name() -> str:
+    return socket.gethostname() + "_" + str(os.getpid())
+
+
+# Work shared by the runners of a campaign, which may join or leave at any time. A runner leases an item for
+# lease_seconds and keeps the lease with heartbeats while it works on it. The item of a runner that stops
+# heartbeating is leased again once its lease expires, and an item is failed after max_attempts leases. Once nothing
+# is queued, an idle runner may also steal an item leased for more than steal_after_seconds by a slow runner. Both
+# then run it, which is safe since runs are found again by name or in the manifest, and the first to finish completes
+# it.
+class WorkQueue(ABC):
+
+    def __init__(self,
+                 lease_seconds: float = 300.0,
+                 max_attempts: int = 3,
+                 steal_after_seconds: Optional[float] = None):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.steal_after_seconds = steal_after_seconds
+
+    @abstractmethod
+    def put(self, items: Iterable[Tuple[str, str]]):
+        # Queues the (seed, config) pairs that are not in the queue yet
+        pass
+
+    @abstractmethod
+    def lease(self, worker: str) -> Optional[WorkItem]:
+        # The next item for the worker, None if there is nothing to lease now
+        pass
+
+    @abstractmethod
+    def heartbeat(self, worker: str, item: WorkItem) -> bool:
+        # Extends the lease of the worker on the item, False if the lease was lost
+        pass
+
+    @abstractmethod
+    def complete(self, worker: str, item: WorkItem):
+        pass
+
+    @abstractmethod
+    def fail(self, worker: str, item: WorkItem):
+        # Queues the item again, unless it was leased max_attempts times
+        pass
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        # Number of items by status
+        pass
+
+    def unfinished(self) -> int:
+        counts = self.counts()
+        return counts.get(QUEUED, 0) + counts.get(LEASED, 0)
+
+
+# WorkQueue in an SQLite database, for the runners of one host or of hosts sharing a file system with working locks
+class SQLiteWorkQueue(WorkQueue):
+
+    def __init__(self,
+                 path: str,
+                 lease_seconds: float = 300.0,
+                 max_attempts: int = 3,
+                 steal_after_seconds: Optional[float] = None):
+        super().__init__(lease_seconds, max_attempts, steal_after_seconds)
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection = None
+        self._connection_pid = None
+        with self._lock:
+            self._execute("CREATE TABLE IF NOT EXISTS items ("
+                          "seed TEXT NOT NULL, "
+                          "config TEXT NOT NULL, "
+                          "status TEXT NOT NULL, "
+                          "worker TEXT, "
+                          "leased_at REAL, "
+                          "lease_expires REAL, "
+                          "attempts INTEGER NOT NULL DEFAULT 0, "
+                          "stolen INTEGER NOT NULL DEFAULT 0, "
+                          "PRIMARY KEY (seed, config))")
+            self._execute("CREATE INDEX IF NOT EXISTS items_status ON items (status, lease_expires)")
+
+    def __getstate__(self):
+        # Connections are not shared between processes, each process opens its own
+        state = dict(self.__dict__)
+        state["_connection"] = None
+        state["_connection_pid"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.connection.execute(sql, parameters)
+
+    def put(self, items: Iterable[Tuple[str, str]]):
+        with self._lock:
+            self._execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany("INSERT OR IGNORE INTO items (seed, config, status) VALUES (?, ?, ?)",
+                                            [(str(seed), config, QUEUED) for seed, config in items])
+                self._execute("COMMIT")
+            except BaseException:
+                self._execute("ROLLBACK")
+                raise
+
+    def lease(self, worker: str) -> Optional[WorkItem]:
+        now = time.time()
+        with self._lock:
+            self._execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases of items that used all their attempts are failed, the others can be leased again
+                self._execute("UPDATE items SET status = ?, worker = NULL "
+                              "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                              (FAILED, LEASED, now, self.max_attempts))
+                row = self._execute("SELECT seed, config, attempts FROM items "
+                                    "WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                                    "ORDER BY status = ?, attempts LIMIT 1",
+                                    (QUEUED, LEASED, now, LEASED)).fetchone()
+                stolen = 0
+                if row is None and self.steal_after_seconds is not None:
+                    row = self._execute("SELECT seed, config, attempts FROM items "
+                                        "WHERE status = ? AND stolen = 0 AND leased_at < ? AND worker != ? "
+                                        "ORDER BY leased_at LIMIT 1",
+                                        (LEASED, now - self.steal_after_seconds, worker)).fetchone()
+                    stolen = 1
+                if row is None:
+                    self._execute("COMMIT")
+                    return None
+                seed, config, attempts = row
+                self._execute("UPDATE items SET status = ?, worker = ?, leased_at = ?, lease_expires = ?, "
+                              "attempts = ?, stolen = stolen + ? WHERE seed = ? AND config = ?",
+                              (LEASED, worker, now, now + self.lease_seconds, attempts + 1, stolen, seed, config))
+                self._execute("COMMIT")
+            except BaseException:
+                self._execute("ROLLBACK")
+                raise
+        return WorkItem(seed, config, attempts + 1)
+
+    def heartbeat(self, worker: str, item: WorkItem) -> bool:
+        with self._lock:
+            return self._execute("UPDATE items SET lease_expires = ? "
+                                 "WHERE seed = ? AND config = ? AND status = ? AND worker = ?",
+                                 (time.time() + self.lease_seconds, item.seed, item.config, LEASED,
+                                  worker)).rowcount == 1
+
+    def complete(self, worker: str, item: WorkItem):
+        # Whoever finishes an item first completes it, also the runner it was stolen from
+        with self._lock:
+            self._execute("UPDATE items SET status = ?, worker = ? WHERE seed = ? AND config = ? AND status != ?",
+                          (DONE, worker, item.seed, item.config, DONE))
+
+    def fail(self, worker: str, item: WorkItem):
+        # Does nothing if the item was stolen since, the other runner may still finish it
+        with self._lock:
+            self._execute("UPDATE items SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL "
+                          "WHERE seed = ? AND config = ? AND status = ? AND worker = ?",
+                          (self.max_attempts, FAILED, QUEUED, item.seed, item.config, LEASED, worker))
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+# Keeps the lease of a worker on an item while it works on it
+class Heartbeat(threading.Thread):
+
+    def __init__(self, queue: WorkQueue, worker: str, item: WorkItem):
+        super().__init__(name="Heartbeat", daemon=True)
+        self.queue = queue
+        self.worker = worker
+        self.item = item
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.worker, self.item):
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Need to provide path to the work queue of a campaign")
+        exit(1)
+    print(", ".join(status + ": " + str(count)
+                    for status, count in sorted(SQLiteWorkQueue(sys.argv[1]).counts().items())))
@@ -1,19 +1,24 @@
+import argparse
 import sys
 import zipfile
 from pathlib import Path
 from itertools import product
 from datetime import datetime, timedelta, time
 from subprocess import CalledProcessError
-from typing import Dict, List
+from time import sleep
+from typing import Dict, List, Optional
 
 from metamorphic.AddRequestRule import AddRequestRule
 from metamorphic.AddSystematicRequestRule import AddSystematicRequestRule
 from metamorphic.ChangeServiceTimeRule import ChangeServiceTimeRule
+from metamorphic.CampaignManifest import CampaignManifest, CRASHED, DONE
 from metamorphic.ChangeUtilizationTimeRule import ChangeUtilizationTimeRule
+from metamorphic.FollowupPlanner import FollowupPlanner
 from metamorphic.RemoveRequestRule import RemoveRequestRule
 from metamorphic.MetamorphicRule import MetamorphicRule
 from metamorphic.RemoveSystematicServedRequestRule import RemoveSystematicServedRequestRule
 from metamorphic.RemoveSystematicUnservedRequestRule import RemoveSystematicUnservedRequestRule
+from metamorphic.ResultSink import ResultSink
 from metamorphic.ServedCloserMax import ServedCloserMax
 from metamorphic.ServedCloserMid import ServedCloserMid
 from metamorphic.ServedCloserMin import ServedCloserMin
@@ -26,15 +31,44 @@ from metamorphic.UnservedCloserMin import UnservedCloserMin
 from metamorphic.UnservedFurtherMax import UnservedFurtherMax
 from metamorphic.UnservedFurtherMid import UnservedFurtherMid
 from metamorphic.UnservedFurtherMin import UnservedFurtherMin
+from metamorphic.WorkQueue import Heartbeat, SQLiteWorkQueue, WorkQueue, worker_name
+from simulator import profiling, timing
 from simulator.simulator_v2 import SimulatorV2
+from simulator.timing import span
 
 from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
 
 
 def run_seed(simulator: SimulatorV2,
              simulator_config: Dict,
              seed: int,
-             rules: List[MetamorphicRule]):
+             rules: List[MetamorphicRule],
+             deduplicate_followups: bool = False,
+             result_sink: Optional[ResultSink] = None,
+             manifest: Optional[CampaignManifest] = None):
+    # With deduplicate_followups (--deduplicate_followups), FollowupPlanner simulates follow-ups of any rule that have
+    # the same content only once. Stages are timed with --timing or when METAMORPHIC_TIMING_DIR is set, the histograms
+    # of the worker are written after each seed. Workers are profiled when METAMORPHIC_PROFILE_DIR is set. With a result
+    # sink, a row is written for the original run and every follow-up. With a manifest, the status of every run is
+    # recorded there. Every zip of the seed is written when it returns, also with background archiving.
+    profiling.start()
+    try:
+        with span("run_seed"):
+            _run_seed(simulator, simulator_config, seed, rules, deduplicate_followups, result_sink, manifest)
+            simulator.wait_for_archives()
+    finally:
+        timing.flush()
+        profiling.checkpoint()
+
+
+def _run_seed(simulator: SimulatorV2,
+              simulator_config: Dict,
+              seed: int,
+              rules: List[MetamorphicRule],
+              deduplicate_followups: bool,
+              result_sink: Optional[ResultSink],
+              manifest: Optional[CampaignManifest]):
     _simulator_config = dict(simulator_config)
     _simulator_config["seed"] = seed
 
@@ -42,21 +76,27 @@ def run_seed(simulator: SimulatorV2,
                                                                    + tup[1].isoformat("minutes"),
                                                        _simulator_config["utilization_time_period"])))
                                    if "utilization_time_period" in _simulator_config else "").replace(":", "")
-    original_zip_path = Path(sys.argv[1]).joinpath("bin",
-                                                   "result",
-                                                   "original"
-                                                   + "_"
-                                                   + str(_simulator_config["num_customer_requests"])
-                                                   + "_"
-                                                   + str(_simulator_config["num_robots"])
-                                                   + "_"
-                                                   + str(_simulator_config["num_operators"])
-                                                   + utilization_time_period_str
-                                                   + "_"
-                                                   + str(seed)
-                                                   + ".zip")
+    original_zip_path = Path(simulator.simulator_dir).joinpath("bin",
+                                                               "result",
+                                                               "original"
+                                                               + "_"
+                                                               + str(_simulator_config["num_customer_requests"])
+                                                               + "_"
+                                                               + str(_simulator_config["num_robots"])
+                                                               + "_"
+                                                               + str(_simulator_config["num_operators"])
+                                                               + utilization_time_period_str
+                                                               + "_"
+                                                               + str(seed)
+                                                               + ".zip")
+    config = CampaignManifest.config_key(_simulator_config)
+    if manifest is not None:
+        manifest.start(seed, config)
     try:
-        if original_zip_path.is_file():
+        # With a result cache, results are found by content in run_simulation rather than by file name. With a
+        # manifest, only the zips it records as complete are reused.
+        if simulator.result_cache is None and (manifest.has_zip(original_zip_path.name) if manifest is not None
+                                               else original_zip_path.is_file()):
             print("Found original results for seed " + str(seed) +
                   " num_customer_requests " + str(_simulator_config["num_customer_requests"]) +
                   " num_robots " + str(_simulator_config["num_robots"]) +
@@ -64,8 +104,9 @@ def run_seed(simulator: SimulatorV2,
                   + " utilization_time_period " + utilization_time_period_str,
                   flush=True
                   )
-            with zipfile.ZipFile(original_zip_path) as original_zip:
+            with span("parse_zip"), zipfile.ZipFile(original_zip_path) as original_zip:
                 original_result = SimulatorV2.zip_to_results_dict(original_zip)
+                original_requests = SimulatorV2.zip_to_requests(original_zip)
         else:
             print("Running original test for seed " + str(seed) +
                   " num_customer_requests " + str(_simulator_config["num_customer_requests"]) +
@@ -74,13 +115,22 @@ def run_seed(simulator: SimulatorV2,
                   + " utilization_time_period " + utilization_time_period_str,
                   flush=True
                   )
-            original_result = simulator.run_simulation("original", str(_simulator_config["num_customer_requests"])
-                                                       + "_" + str(_simulator_config["num_robots"])
-                                                       + "_" + str(_simulator_config["num_operators"])
-                                                       + utilization_time_period_str
-                                                       + "_" + str(seed),
-                                                       **_simulator_config)
+            with span("original"):
+                original_result = simulator.run_simulation("original",
+                                                           str(_simulator_config["num_customer_requests"])
+                                                           + "_" + str(_simulator_config["num_robots"])
+                                                           + "_" + str(_simulator_config["num_operators"])
+                                                           + utilization_time_period_str
+                                                           + "_" + str(seed),
+                                                           **_simulator_config)
+            original_requests = original_result["customer_requests"]
+            if manifest is not None:
+                # The zip is only complete once archived
+                simulator.wait_for_archives()
+                manifest.finish_original(seed, config, DONE, original_zip_path.name)
     except CalledProcessError:
+        if manifest is not None:
+            manifest.finish_original(seed, config, CRASHED, None)
         print("Original run on seed " + str(seed) +
               " num_customer_requests " + str(_simulator_config["num_customer_requests"]) +
               " num_robots " + str(_simulator_config["num_robots"]) +
@@ -89,8 +139,25 @@ def run_seed(simulator: SimulatorV2,
               + " crashed",
               flush=True)
         return
-    with zipfile.ZipFile(original_zip_path) as original_zip_file:
-        original_requests = SimulatorV2.zip_to_requests(original_zip_file)
+
+    if result_sink is not None:
+        result_sink.add_original(_simulator_config, utilization_time_period_str, original_result)
+    # Rule, index, status and zip name of every follow-up, recorded in the manifest once they are all known
+    followups = []
+
+    def on_result(rule, followup_idx, followup_result, followed):
+        if result_sink is not None:
+            result_sink.add_followup(_simulator_config, utilization_time_period_str, rule.name, followup_idx,
+                                     followup_result, followed)
+        if manifest is None:
+            return
+        if followup_result is None:
+            followups.append((rule.name, followup_idx, CRASHED, None))
+        else:
+            # Also follow-ups identical to the original, which get a link to its zip
+            followups.append((rule.name, followup_idx, DONE,
+                              "followup_" + rule._followup_sim_id(_simulator_config, utilization_time_period_str,
+                                                                  followup_idx) + ".zip"))
 
     print("Running followup test for seed " + str(seed) +
           " num_customer_requests " + str(_simulator_config["num_customer_requests"]) +
@@ -98,12 +165,73 @@ def run_seed(simulator: SimulatorV2,
           " num_operators " + str(_simulator_config["num_operators"])
           + " utilization_time_period " + utilization_time_period_str,
           flush=True)
-    for rule in rules:
-        followed_all = rule.is_followed(_simulator_config,
-                                        original_input=original_requests,
-                                        original_result=original_result)
-        for followup_idx, followed in enumerate(followed_all):
-            print_result(_simulator_config, followed, followup_idx, rule, seed)
+    if deduplicate_followups:
+        planner = FollowupPlanner(rules)
+        with span("followups"):
+            followed_by_rule = planner.is_followed(_simulator_config,
+                                                   original_input=original_requests,
+                                                   original_result=original_result,
+                                                   on_result=on_result)
+        for rule, followed_all in zip(rules, followed_by_rule):
+            for followup_idx, followed in enumerate(followed_all):
+                print_result(_simulator_config, followed, followup_idx, rule, seed)
+        print("Deduplicated followups for seed " + str(seed) +
+              " num_customer_requests " + str(_simulator_config["num_customer_requests"]) +
+              " num_robots " + str(_simulator_config["num_robots"]) +
+              " num_operators " + str(_simulator_config["num_operators"])
+              + " utilization_time_period " + utilization_time_period_str
+              + ": " + str(planner.planned_followups) + " planned, "
+              + str(planner.simulated_followups) + " simulated, "
+              + str(planner.saved_simulations) + " saved",
+              flush=True)
+    else:
+        for rule in rules:
+            with span("followups", rule=rule.name):
+                followed_all = rule.is_followed(_simulator_config,
+                                                original_input=original_requests,
+                                                original_result=original_result,
+                                                on_result=on_result)
+            for followup_idx, followed in enumerate(followed_all):
+                print_result(_simulator_config, followed, followup_idx, rule, seed)
+
+    if result_sink is not None:
+        # The rows of the seed are on disk before the manifest records it as complete, a worker killed later loses none
+        result_sink.flush()
+    if manifest is not None:
+        simulator.wait_for_archives()
+        manifest.finish_followups(seed, config, followups)
+
+
+def run_queue(queue: WorkQueue,
+              simulator: SimulatorV2,
+              configs: Dict[str, Dict],
+              rules: List[MetamorphicRule],
+              deduplicate_followups: bool = False,
+              result_sink: Optional[ResultSink] = None,
+              manifest: Optional[CampaignManifest] = None,
+              poll_seconds: float = 10.0):
+    # Runs the seeds leased from the queue, configs maps the config of the items to the simulator configuration. Returns
+    # once nothing is queued or leased by another runner, waiting meanwhile for leases to expire or to be stolen.
+    worker = worker_name()
+    while True:
+        item = queue.lease(worker)
+        if item is None:
+            if queue.unfinished() == 0:
+                return
+            sleep(poll_seconds)
+            continue
+        heartbeat = Heartbeat(queue, worker, item)
+        heartbeat.start()
+        try:
+            run_seed(simulator, configs[item.config], item.seed, rules, deduplicate_followups, result_sink, manifest)
+        except Exception as e:
+            heartbeat.stop()
+            print("Seed " + item.seed + " configuration " + item.config + " failed on attempt " + str(item.attempts)
+                  + ": " + repr(e), file=sys.stderr, flush=True)
+            queue.fail(worker, item)
+        else:
+            heartbeat.stop()
+            queue.complete(worker, item)
 
 
 def print_result(_simulator_config, followed, followup_idx, rule, seed):
@@ -136,14 +264,47 @@ def print_result(_simulator_config, followed, followup_idx, rule, seed):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print("Need to provide path to simulator and path to list of seeds.", file=sys.stderr)
-        exit(1)
-
-    simulator = SimulatorV2(sys.argv[1])
+    parser = argparse.ArgumentParser(description="Runs every metamorphic rule on every seed and configuration")
+    parser.add_argument("simulator_dir", help="Path to the simulator")
+    parser.add_argument("seeds_file", help="Path to the list of seeds, one per line")
+    parser.add_argument("n_jobs", type=int, nargs="?", default=16)
+    parser.add_argument("--profile", action="store_true",
+                        help="Sample the Python stacks and allocations of every worker")
+    parser.add_argument("--profile_rate", type=float, default=100.0, help="Stack samples per second")
+    parser.add_argument("--profile_dir", default="profile",
+                        help="Directory of the per-worker and merged profiles")
+    parser.add_argument("--timing", action="store_true",
+                        help="Record the wall and CPU time of every stage in every worker")
+    parser.add_argument("--timing_dir", default="timing",
+                        help="Directory of the per-worker and merged timing histograms")
+    parser.add_argument("--results_dir",
+                        help="Write the metrics and verdict of every run to original_results.csv and "
+                             "followup_results.csv in this directory, as experiments_zip_to_csv does")
+    parser.add_argument("--deduplicate_followups", action="store_true",
+                        help="Simulate the follow-ups of all the rules that have the same content only once per seed")
+    parser.add_argument("--manifest",
+                        help="SQLite database recording the status of every run, only the seeds and configurations "
+                             "with outstanding work are run")
+    parser.add_argument("--queue",
+                        help="SQLite work queue shared by the runners of the campaign. Each of the n_jobs runners "
+                             "leases seeds from it until none are left, more runners can join with the same command")
+    parser.add_argument("--lease_seconds", type=float, default=300.0)
+    parser.add_argument("--max_attempts", type=int, default=3,
+                        help="Attempts at a seed in the queue, or at a run in the manifest, before it is given up on")
+    parser.add_argument("--steal_after", type=float,
+                        help="Once the queue is empty, also run seeds leased for longer than this many seconds")
+    args = parser.parse_args()
+
+    if args.timing:
+        timing.enable(args.timing_dir)
+    if args.profile:
+        profiling.enable(args.profile_dir, args.profile_rate)
+
+    simulator = SimulatorV2(args.simulator_dir)
+    result_sink = ResultSink(args.results_dir) if args.results_dir else None
 
     seeds = set()
-    with open(sys.argv[2], "r") as seeds_files:
+    with open(args.seeds_file, "r") as seeds_files:
         for seed in seeds_files:
             seeds.add(seed.rstrip())
 
@@ -239,11 +400,51 @@ if __name__ == '__main__':
                                                                 (time(hour=10), time(hour=11, minute=30)),
                                                                 (time(hour=10, minute=30), time(hour=12))]
 
-    n_jobs = int(sys.argv[3]) if len(sys.argv) >= 4 else 16
+    seed_configs = list(product(seeds, configs_to_run))
+    manifest = None
+    if args.manifest:
+        manifest = CampaignManifest(args.manifest, args.max_attempts)
+        for rule in rules:
+            rule.manifest = manifest
+        manifest.plan((seed, CampaignManifest.config_key(config)) for seed, config in seed_configs)
+        outstanding = set(manifest.outstanding())
+        seed_configs = [(seed, config) for seed, config in seed_configs
+                        if (seed, CampaignManifest.config_key(config)) in outstanding]
+        print(str(len(seed_configs)) + " seeds and configurations with outstanding work, "
+              + str(len(manifest.given_up())) + " given up on, runs "
+              + ", ".join(status + ": " + str(count) for status, count in sorted(manifest.counts().items())),
+              flush=True)
 
-    Parallel(n_jobs=n_jobs
-             # , backend="multiprocessing"
-             )(
-        delayed(run_seed)(simulator, simulator_config, seed, rules)
-        for (seed, simulator_config) in product(seeds, configs_to_run)
-    )
+    if args.queue:
+        queue = SQLiteWorkQueue(args.queue, args.lease_seconds, args.max_attempts, args.steal_after)
+        queue.put((seed, CampaignManifest.config_key(config)) for seed, config in seed_configs)
+        configs = {CampaignManifest.config_key(config): config for config in configs_to_run}
+        Parallel(n_jobs=args.n_jobs)(
+            delayed(run_queue)(queue, simulator, configs, rules, args.deduplicate_followups, result_sink, manifest)
+            for _ in range(args.n_jobs)
+        )
+        print("Work queue " + ", ".join(status + ": " + str(count)
+                                        for status, count in sorted(queue.counts().items())), flush=True)
+    else:
+        Parallel(n_jobs=args.n_jobs
+                 # , backend="multiprocessing"
+                 )(
+            delayed(run_seed)(simulator, simulator_config, seed, rules, args.deduplicate_followups, result_sink,
+                              manifest)
+            for (seed, simulator_config) in seed_configs
+        )
+
+    if result_sink is not None:
+        # Workers write their last rows when they exit
+        get_reusable_executor().shutdown(wait=True)
+        result_sink.flush()
+        ResultSink.collect(args.results_dir, args.results_dir)
+
+    if timing.enabled():
+        # Histograms of every worker, added up for the whole campaign
+        timing.flush()
+        timing.print_summary(timing.merge(timing.timing_dir()))
+
+    if profiling.enabled():
+        # Stacks and allocations of every worker, added up for the whole campaign
+        profiling.finish()
@@ -1,17 +1,18 @@
+import argparse
 import glob
 import os
-import sys
 import zipfile
 from pathlib import Path
 import pandas
 import tqdm
 from joblib import Parallel, delayed
 
-from simulator import Simulator
+from simulator import Simulator, profiling
 from simulator.simulator_v2 import SimulatorV2
 
 
 def original_to_dict(original_zip_path):
+    profiling.checkpoint()
     original_zip_split = os.path.basename(original_zip_path).split("_")
     row = dict()
     row["seed"] = original_zip_split[-1].replace(".zip", "")
@@ -34,6 +35,7 @@ def original_to_dict(original_zip_path):
 
 
 def followup_to_dict(followup_zip_path):
+    profiling.checkpoint()
     followup_zip_split = os.path.basename(followup_zip_path).split("_")
     row = dict()
     row["rule"] = followup_zip_split[1]
@@ -53,6 +55,8 @@ def followup_to_dict(followup_zip_path):
     row[Simulator.DELIVERY_RATE] = followup_results[Simulator.DELIVERY_RATE]
     row[Simulator.UTILIZATION_RATE] = followup_results[Simulator.UTILIZATION_RATE].values
     row[Simulator.NUM_RISKS] = followup_results[Simulator.NUM_RISKS]
+    # A run stopped once its verdict was known, its metrics are only good for that verdict
+    row["truncated"] = followup_results["truncated"]
 
     return row
 
@@ -78,11 +82,17 @@ def zip_to_csv(zip_folder_path, output_folder_path):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print("Need to provide path to folder with zips and path to output folder")
-        exit(1)
-    zip_folder_path = sys.argv[1]
-    output_folder_path = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Collects the results of the zips of a campaign into CSV files")
+    parser.add_argument("zip_folder_path", help="Path to folder with zips")
+    parser.add_argument("output_folder_path", help="Path to output folder")
+    parser.add_argument("--profile", action="store_true",
+                        help="Sample the Python stacks and allocations of every worker")
+    parser.add_argument("--profile_rate", type=float, default=100.0, help="Stack samples per second")
+    parser.add_argument("--profile_dir", default="profile",
+                        help="Directory of the per-worker and merged profiles")
+    args = parser.parse_args()
+    zip_folder_path = args.zip_folder_path
+    output_folder_path = args.output_folder_path
     if not Path(zip_folder_path).is_dir():
         print("Directory", zip_folder_path, "does not exist")
         exit(1)
@@ -90,4 +100,10 @@ if __name__ == '__main__':
         print("Directory", output_folder_path, "does not exist")
         exit(1)
 
+    if args.profile:
+        profiling.enable(args.profile_dir, args.profile_rate)
+
     zip_to_csv(zip_folder_path, output_folder_path)
+
+    if profiling.enabled():
+        profiling.finish()
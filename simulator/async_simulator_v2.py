@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+import multiprocessing
+import subprocess
+from datetime import datetime, time
+from typing import Literal, List, Tuple, Dict, Iterable, AsyncIterator, Optional, Union
+
+from simulator.result_cache import ResultCache
+from simulator.simulator_v2 import SimulatorV2
+
+
+# Runs simulations as asyncio subprocesses, so that a single driver process can keep every core busy with simulator
+# children. The number of simulators running at the same time is bounded by max_concurrent_simulations.
+class AsyncSimulatorV2(SimulatorV2):
+    def __init__(self, simulator_dir, max_concurrent_simulations: int = None,
+                 archive_mode: Literal["sync", "background", "none"] = "sync", archive_threads: int = 1,
+                 result_cache: ResultCache = None):
+        super().__init__(simulator_dir, archive_mode=archive_mode, archive_threads=archive_threads,
+                         result_cache=result_cache)
+        self.max_concurrent_simulations = max_concurrent_simulations if max_concurrent_simulations \
+            else multiprocessing.cpu_count()
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_semaphore"] = None
+        state["_semaphore_loop"] = None
+        return state
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # A semaphore belongs to the event loop it is first used in, a new one is needed for every asyncio.run
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_simulations)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def run_simulation_async(self,
+                                   sim_name: str,
+                                   sim_id: str,
+                                   service_start_time: datetime,
+                                   service_end_time: datetime,
+                                   num_customer_requests: int,
+                                   num_robots: int,
+                                   robot_speed_kmph: float,
+                                   robot_loading_capacity: int,
+                                   area_name: str = "FujisawaSST",
+                                   seed: int = 0,
+                                   demand_mode: Literal["uniform", "distance", "file"] = "uniform",
+                                   demand_file: str = None,
+                                   utilization_time_period: List[Tuple[time, time]] = None,
+                                   num_operators: int = 1
+                                   ):
+        # Coroutine version of run_simulation, which is kept synchronous for the callers of SimulatorV2
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self._simulation_cache_key(service_start_time, service_end_time, num_customer_requests,
+                                                   num_robots, robot_speed_kmph, robot_loading_capacity, area_name,
+                                                   seed, demand_mode, demand_file, utilization_time_period,
+                                                   num_operators)
+            sim_result = self._restore_cached_result(cache_key, sim_name, sim_id)
+            if sim_result is not None:
+                return sim_result
+
+        command = self._build_command(sim_name, sim_id, service_start_time, service_end_time, num_customer_requests,
+                                      num_robots, robot_speed_kmph, robot_loading_capacity, area_name, seed,
+                                      demand_mode, demand_file, utilization_time_period, num_operators)
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(*command,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE,
+                                                           cwd=self.simulator_dir.joinpath("bin"))
+            stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            e = subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+            self._print_failure(command, e)
+            raise e
+
+        # Archiving and parsing the results is blocking, it is moved out of the event loop with the timing labels of
+        # the run
+        return await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run,
+                                                                self._collect_result, sim_name, sim_id, cache_key)
+
+    async def _run_tagged(self, simulation: Dict) -> Tuple[Dict, Union[Dict, subprocess.CalledProcessError]]:
+        try:
+            return simulation, await self.run_simulation_async(**simulation)
+        except subprocess.CalledProcessError as e:
+            return simulation, e
+
+    async def run_simulations(self, simulations: Iterable[Dict]) \
+            -> AsyncIterator[Tuple[Dict, Union[Dict, subprocess.CalledProcessError]]]:
+        # Yields (keyword arguments of run_simulation_async, result) pairs as soon as each simulation finishes. A crashed
+        # simulation is yielded with its CalledProcessError instead of a result.
+        tasks = [asyncio.ensure_future(self._run_tagged(simulation)) for simulation in simulations]
+        try:
+            for next_finished in asyncio.as_completed(tasks):
+                yield await next_finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def run_all(self, simulations: Iterable[Dict]) -> List[Optional[Dict]]:
+        # Blocking helper that runs every simulation in one event loop and returns the results in the input order,
+        # with None for crashed simulations
+        async def gather():
+            results = await asyncio.gather(*(self._run_tagged(simulation) for simulation in simulations))
+            return [None if isinstance(result, subprocess.CalledProcessError) else result for _, result in results]
+
+        return asyncio.run(gather())
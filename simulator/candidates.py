@@ -0,0 +1,151 @@
+import logging as log
+import time
+from typing import List, Tuple, Optional, NamedTuple
+
+import numpy as np
+
+from simulator.simulator import Simulator
+
+NUM_ROBOTS = 'num_robots'
+# Metrics that an optimiser should maximise, the others and the number of robots are minimised
+MAXIMISED_METRICS = {Simulator.NUM_DELIVERED, Simulator.UTILIZATION_RATE, Simulator.DELIVERY_RATE}
+DEFAULT_OBJECTIVES = (Simulator.NUM_DELIVERED, Simulator.NUM_RISKS, NUM_ROBOTS)
+
+
+# Decision vectors of the optimisation problems over Simulator: [num_robots, robot_speed_kmh] followed, when windows
+# is set, by a (start hour, working hours) pair per robot. Only the pairs of the first num_robots robots are used.
+# Speeds are rounded to speed_step so that close candidates share the results in Simulator.memo.
+class CandidateEncoding:
+
+    def __init__(self, simulator: Simulator, max_robots: int, min_robots: int = 1,
+                 speed_bounds: Tuple[float, float] = (1.0, 10.0), speed_step: float = 0.1,
+                 windows: bool = False, min_working_hours: int = 1,
+                 objectives: Tuple[str, ...] = DEFAULT_OBJECTIVES):
+        assert 0 < min_robots <= max_robots, "The number of robots must be a positive range."
+        assert 0.0 < speed_bounds[0] <= speed_bounds[1], "The speed must be a positive range."
+        self.max_robots = max_robots
+        self.min_robots = min_robots
+        self.speed_bounds = speed_bounds
+        self.speed_step = speed_step
+        self.windows = windows
+        self.first_hour = simulator.start_time.hour
+        self.last_hour = min(self.first_hour + simulator.simulation_duration, 23)
+        assert self.last_hour - self.first_hour >= min_working_hours, "The simulation is shorter than a shift."
+        self.min_working_hours = min_working_hours
+        for objective in objectives:
+            assert objective == NUM_ROBOTS or objective in Simulator.METRICS, f"Unknown objective {objective}"
+        self.objectives = tuple(objectives)
+
+    @property
+    def lower_bounds(self) -> np.ndarray:
+        bounds = [self.min_robots, self.speed_bounds[0]]
+        if self.windows:
+            bounds += [self.first_hour, self.min_working_hours] * self.max_robots
+        return np.array(bounds, dtype=float)
+
+    @property
+    def upper_bounds(self) -> np.ndarray:
+        bounds = [self.max_robots, self.speed_bounds[1]]
+        if self.windows:
+            bounds += [self.last_hour - self.min_working_hours, self.last_hour - self.first_hour] * self.max_robots
+        return np.array(bounds, dtype=float)
+
+    @property
+    def number_of_variables(self) -> int:
+        return 2 + (2 * self.max_robots if self.windows else 0)
+
+    def decode(self, x) -> Tuple[int, float, Optional[List[Tuple[int, int]]]]:
+        x = np.clip(np.asarray(x, dtype=float), self.lower_bounds, self.upper_bounds)
+        num_robots = int(round(x[0]))
+        robot_speed_kmh = float(round(round(x[1] / self.speed_step) * self.speed_step, 6))
+        robot_speed_kmh = min(max(robot_speed_kmh, self.speed_bounds[0]), self.speed_bounds[1])
+        if not self.windows:
+            return num_robots, robot_speed_kmh, None
+        utilization_time_period = []
+        for robot in range(num_robots):
+            start = int(round(x[2 + 2 * robot]))
+            end = min(start + int(round(x[3 + 2 * robot])), self.last_hour)
+            utilization_time_period.append((start, end))
+        return num_robots, robot_speed_kmh, utilization_time_period
+
+    def decode_population(self, X) -> List[Tuple]:
+        return [self.decode(x) for x in np.atleast_2d(X)]
+
+    def objective_values(self, candidate: Tuple, result) -> List[float]:
+        values = []
+        for objective in self.objectives:
+            if objective == NUM_ROBOTS:
+                values.append(float(candidate[0]))
+            elif objective in MAXIMISED_METRICS:
+                values.append(-float(result[objective]))
+            else:
+                values.append(float(result[objective]))
+        return values
+
+
+class GenerationStats(NamedTuple):
+    generation: int
+    candidates: int
+    unique_candidates: int
+    simulations: int
+    memo_hits: int
+    hit_rate: float
+    seconds: float
+    screened: int = 0
+
+
+# Evaluates whole populations with Simulator.run_many and keeps, per generation, how many simulations were run and
+# how many were found in the memo. With a surrogate (see simulator.surrogate), the candidates it screens out get
+# predicted objectives instead of being simulated.
+class PopulationEvaluator:
+
+    def __init__(self, simulator: Simulator, encoding: CandidateEncoding, surrogate=None):
+        self.simulator = simulator
+        self.encoding = encoding
+        self.surrogate = surrogate
+        self.history: List[GenerationStats] = []
+
+    def evaluate(self, X) -> np.ndarray:
+        start = time.time()
+        candidates = self.encoding.decode_population(X)
+        results = [None] * len(candidates)
+        if self.surrogate is not None:
+            mask, predictions = self.surrogate.select(candidates)
+            # Candidates whose simulations are all in the memo cost nothing, they are never screened out
+            mask |= np.array([self.simulator.is_memoised(*candidate) for candidate in candidates], dtype=bool)
+        else:
+            mask, predictions = np.ones(len(candidates), dtype=bool), None
+        simulated = [candidate for candidate, selected in zip(candidates, mask) if selected]
+
+        hits, misses = self.simulator.memo_hits, self.simulator.memo_misses
+        simulated_results = iter(self.simulator.run_many(simulated) if simulated else [])
+        hits, misses = self.simulator.memo_hits - hits, self.simulator.memo_misses - misses
+        for i, selected in enumerate(mask):
+            results[i] = next(simulated_results) if selected else predictions[i]
+        if self.surrogate is not None:
+            self.surrogate.update(simulated, [result for result, selected in zip(results, mask) if selected])
+
+        stats = GenerationStats(generation=len(self.history),
+                                candidates=len(candidates),
+                                unique_candidates=len(set(map(repr, candidates))),
+                                simulations=misses,
+                                memo_hits=hits,
+                                hit_rate=hits / (hits + misses) if hits + misses else 0.0,
+                                seconds=time.time() - start,
+                                screened=int(len(candidates) - mask.sum()))
+        self.history.append(stats)
+        log.getLogger().info(f'Generation {stats.generation}: {stats.candidates} candidates '
+                             f'({stats.unique_candidates} unique, {stats.screened} screened out), '
+                             f'{stats.simulations} simulations, memo hit rate {stats.hit_rate:.2f}, '
+                             f'{stats.seconds:.1f}s')
+        return np.array([self.encoding.objective_values(candidate, result)
+                         for candidate, result in zip(candidates, results)])
+
+    @property
+    def total_simulations(self) -> int:
+        return sum(stats.simulations for stats in self.history)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = sum(stats.simulations + stats.memo_hits for stats in self.history)
+        return sum(stats.memo_hits for stats in self.history) / lookups if lookups else 0.0
@@ -0,0 +1,153 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import stat
+import sys
+import traceback
+from pathlib import Path
+from typing import List, Tuple, Callable
+
+from metamorphic.Request import Request
+from simulator.standin import Scenario, Scheduler, StandinEngine
+from simulator.worker_pool import SERVE_FD_ENV
+
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=9))
+TARGETS = ['T01', 'T02', 'T03', 'T04', 'T05', 'T06', 'T08', 'T09', 'T10', 'T11', 'T12', 'T14', 'T15', 'T16', 'T17',
+           'T18', 'T19', 'T20', 'T21', 'T22', 'T23', 'T24', 'T25', 'T26', 'T27', 'T28', 'T29', 'T31', 'T33', 'T34',
+           'T35', 'T36', 'T37', 'T38', 'T39', 'T40', 'T41', 'T42', 'T43', 'T45', 'T46', 'T47', 'T48', 'T49', 'T50',
+           'T51', 'T52', 'T53', 'T54', 'T60', 'T61', 'T62', 'T63', 'T64', 'T65', 'T66', 'T67', 'T70', 'T71', 'T72',
+           'T73', 'T74', 'T75', 'T76']
+
+
+# Stand-in for bin/run/run that accepts the same arguments and writes the same result files, simulating the deliveries
+# with the open engine of simulator/standin.py. It is meant to exercise the Python pipeline (worker pool, archiving,
+# parsing, rules) without the private simulator.
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="fake_simulator")
+    parser.add_argument("--sim_name", required=True)
+    parser.add_argument("--sim_id", required=True)
+    parser.add_argument("--area_name", default="FujisawaSST")
+    parser.add_argument("--service_start_time", "--start_time", dest="service_start_time", required=True)
+    parser.add_argument("--service_end_time", "--end_time", dest="service_end_time", required=True)
+    parser.add_argument("--num_customer_requests", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--demand_mode", default="uniform")
+    parser.add_argument("--demand_file")
+    parser.add_argument("--num_robots", type=int, required=True)
+    parser.add_argument("--robot_speed_kmph", type=float, required=True)
+    parser.add_argument("--robot_loading_capacity", type=int, default=1)
+    parser.add_argument("--num_operators", type=int, default=1)
+    parser.add_argument("--utilization_time_period")
+    return parser.parse_args(argv)
+
+
+def parse_time(value: str) -> datetime.datetime:
+    parsed = datetime.datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=TIMEZONE)
+
+
+def robot_windows(args: argparse.Namespace,
+                  service_start_time: datetime.datetime,
+                  service_end_time: datetime.datetime) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+    windows = []
+    if args.utilization_time_period:
+        for period in args.utilization_time_period.split(",")[:args.num_robots]:
+            start, end = (datetime.time.fromisoformat(t) for t in period.split("-"))
+            windows.append((datetime.datetime.combine(service_start_time.date(), start, service_start_time.tzinfo),
+                            datetime.datetime.combine(service_start_time.date(), end, service_start_time.tzinfo)))
+    while len(windows) < args.num_robots:
+        windows.append((service_start_time, service_end_time))
+    return windows
+
+
+def generate_requests(args: argparse.Namespace,
+                      service_start_time: datetime.datetime,
+                      service_end_time: datetime.datetime) -> List[Request]:
+    if args.demand_mode == "file":
+        # Follow-up inputs may carry times without a UTC offset, they are read in the local time of the area
+        with open(args.demand_file) as demand_file:
+            reader = csv.reader(demand_file)
+            next(reader, None)
+            return [Request(int(row[0]), parse_time(row[1]), row[2], row[3], int(row[4]),
+                            parse_time(row[5]), parse_time(row[6]), parse_time(row[7]), parse_time(row[8]))
+                    for row in reader]
+    random_generator = random.Random(args.seed)
+    requests = [Request.random(i, service_start_time, service_end_time, TARGETS, TARGETS, random_generator)
+                for i in range(args.num_customer_requests)]
+    # Times are written to customer_request.csv in whole seconds, simulating them the same way makes the original
+    # identical to a follow-up that reads its requests back from that file
+    for request in requests:
+        request.order_time = request.order_time.replace(microsecond=0)
+    return requests
+
+
+def scenario(args: argparse.Namespace) -> Scenario:
+    service_start_time = parse_time(args.service_start_time)
+    service_end_time = parse_time(args.service_end_time)
+    return Scenario(requests=generate_requests(args, service_start_time, service_end_time),
+                    service_start_time=service_start_time,
+                    service_end_time=service_end_time,
+                    num_robots=args.num_robots,
+                    robot_speed_kmph=args.robot_speed_kmph,
+                    robot_loading_capacity=args.robot_loading_capacity,
+                    num_operators=args.num_operators,
+                    windows=robot_windows(args, service_start_time, service_end_time),
+                    area_name=args.area_name)
+
+
+def run(argv: List[str], result_root: Path = Path("result"), scheduler: Scheduler = None,
+        stop: Callable[[StandinEngine], bool] = None) -> int:
+    args = parse_args(argv)
+    engine = StandinEngine(scenario(args), scheduler).run(stop)
+    engine.write_results(Path(result_root, args.sim_name, args.sim_id))
+    return 0
+
+
+def serve():
+    # Crash on purpose after this many runs, to exercise worker recycling in the pool
+    crash_every = int(os.environ.get("FAKE_SIMULATOR_CRASH_EVERY", "0"))
+    runs = 0
+    # Answers go to the descriptor given by the pool, stdout only carries logs
+    responses = os.fdopen(int(os.environ[SERVE_FD_ENV]), "w", buffering=1)
+    print(json.dumps({"ready": True}), file=responses, flush=True)
+    for line in sys.stdin:
+        if crash_every and runs == crash_every:
+            os._exit(1)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                returncode = run(json.loads(line)["args"])
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+        runs += 1
+        print(json.dumps({"returncode": returncode, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}),
+              file=responses, flush=True)
+
+
+def install(simulator_dir: str):
+    # Lays out simulator_dir/bin/run/run so that SimulatorV2(simulator_dir) runs this fake simulator
+    run_path = Path(simulator_dir).joinpath("bin", "run", "run")
+    run_path.parent.mkdir(parents=True, exist_ok=True)
+    Path(simulator_dir).joinpath("bin", "result").mkdir(exist_ok=True)
+    repository_dir = Path(__file__).absolute().parent.parent
+    run_path.write_text("#!/bin/sh\n"
+                        f"PYTHONPATH=\"{repository_dir}${{PYTHONPATH:+:$PYTHONPATH}}\" "
+                        f"exec \"{sys.executable}\" -m simulator.fake_simulator \"$@\"\n")
+    run_path.chmod(run_path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "--install":
+        install(sys.argv[2])
+    elif len(sys.argv) == 2 and sys.argv[1] == "--serve":
+        serve()
+    else:
+        exit(run(sys.argv[1:]))
@@ -0,0 +1,49 @@
+from typing import List
+
+import numpy as np
+from jmetal.core.problem import FloatProblem
+from jmetal.core.solution import FloatSolution
+from jmetal.util.evaluator import Evaluator
+
+from simulator.candidates import CandidateEncoding, PopulationEvaluator
+from simulator.simulator import Simulator
+from simulator.surrogate import SurrogateScreen
+
+
+# jMetalPy problem over Simulator. evaluate handles one solution at a time, pass SimulatorEvaluator(problem) as the
+# evaluator of the algorithm so that a whole population is evaluated by a single Simulator.run_many.
+class SimulatorFloatProblem(FloatProblem):
+
+    def __init__(self, simulator: Simulator, max_robots: int, surrogate_options: dict = None, **encoding_options):
+        super().__init__()
+        self.encoding = CandidateEncoding(simulator, max_robots, **encoding_options)
+        # With surrogate_options (arguments of SurrogateScreen, {} for the defaults) candidates are screened first
+        surrogate = SurrogateScreen(self.encoding, **surrogate_options) if surrogate_options is not None else None
+        self.evaluator = PopulationEvaluator(simulator, self.encoding, surrogate)
+        self.lower_bound = list(self.encoding.lower_bounds)
+        self.upper_bound = list(self.encoding.upper_bounds)
+
+    def number_of_objectives(self) -> int:
+        return len(self.encoding.objectives)
+
+    def number_of_constraints(self) -> int:
+        return 0
+
+    def name(self) -> str:
+        return "SimulatorFloatProblem"
+
+    def evaluate(self, solution: FloatSolution) -> FloatSolution:
+        self.evaluate_population([solution])
+        return solution
+
+    def evaluate_population(self, solutions: List[FloatSolution]):
+        objectives = self.evaluator.evaluate(np.array([solution.variables for solution in solutions]))
+        for solution, values in zip(solutions, objectives):
+            solution.objectives = list(values)
+
+
+class SimulatorEvaluator(Evaluator[FloatSolution]):
+
+    def evaluate(self, solution_list: List[FloatSolution], problem: SimulatorFloatProblem) -> List[FloatSolution]:
+        problem.evaluate_population(solution_list)
+        return solution_list
@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+
+def _json_default(value):
+    # numpy scalars returned by pandas and numpy
+    return value.item()
+
+
+# Disk-backed replacement for the Simulator.memo dict. Results are kept in an SQLite database that several optimiser
+# processes on the same host can share, with a bounded in-memory LRU in front of it. Float components of the keys are
+# rounded to float_digits decimals so that speeds such as 5.0000000001 and 5.0 share results. The namespace separates
+# simulators whose sim_ids do not map to the same seeds and request rates.
+class PersistentMemo:
+    def __init__(self,
+                 path: str,
+                 namespace: str = "",
+                 cache_size: int = 10000,
+                 max_entries: int = None,
+                 max_age: float = None,
+                 float_digits: int = 3,
+                 eviction_interval: int = 1000):
+        self.path = path
+        self.namespace = namespace
+        self.cache_size = cache_size
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.float_digits = float_digits
+        self.eviction_interval = eviction_interval
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._connection = None
+        self._connection_pid = None
+        self._inserts_since_eviction = 0
+        with self._lock:
+            self._execute("CREATE TABLE IF NOT EXISTS memo ("
+                          "namespace TEXT NOT NULL, "
+                          "key TEXT NOT NULL, "
+                          "value TEXT NOT NULL, "
+                          "created REAL NOT NULL, "
+                          "accessed REAL NOT NULL, "
+                          "PRIMARY KEY (namespace, key))")
+            self._execute("CREATE INDEX IF NOT EXISTS memo_accessed ON memo (namespace, accessed)")
+        self.evict()
+
+    def __getstate__(self):
+        # Connections are not shared between processes, each process opens its own
+        state = dict(self.__dict__)
+        state["_connection"] = None
+        state["_connection_pid"] = None
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def _execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.connection.execute(sql, parameters)
+
+    def canonical_key(self, key: Hashable) -> str:
+        if not isinstance(key, tuple):
+            key = (key,)
+        return json.dumps([round(k, self.float_digits) if isinstance(k, float) else k for k in key],
+                          default=_json_default)
+
+    def _remember(self, canonical_key: str, value: Dict, created: float):
+        # The creation time is kept with the value, so that max_age also applies to results served from memory
+        self._cache[canonical_key] = (value, created)
+        self._cache.move_to_end(canonical_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, key: Hashable, default=None) -> Optional[Dict]:
+        canonical_key = self.canonical_key(key)
+        with self._lock:
+            now = time.time()
+            if canonical_key in self._cache:
+                value, created = self._cache[canonical_key]
+                if self.max_age is None or created >= now - self.max_age:
+                    self._cache.move_to_end(canonical_key)
+                    return value
+                # Too old, unless another process stored it again since
+                del self._cache[canonical_key]
+            row = self._execute("SELECT value, created FROM memo WHERE namespace = ? AND key = ?",
+                                (self.namespace, canonical_key)).fetchone()
+            if row is None or (self.max_age is not None and row[1] < now - self.max_age):
+                return default
+            self._execute("UPDATE memo SET accessed = ? WHERE namespace = ? AND key = ?",
+                          (now, self.namespace, canonical_key))
+            value = json.loads(row[0])
+            self._remember(canonical_key, value, row[1])
+            return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key: Hashable) -> Dict:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Dict):
+        canonical_key = self.canonical_key(key)
+        now = time.time()
+        with self._lock:
+            self._execute("INSERT OR REPLACE INTO memo (namespace, key, value, created, accessed) "
+                          "VALUES (?, ?, ?, ?, ?)",
+                          (self.namespace, canonical_key, json.dumps(value, default=_json_default), now, now))
+            self._remember(canonical_key, value, now)
+            self._inserts_since_eviction += 1
+            if self._inserts_since_eviction >= self.eviction_interval:
+                self.evict()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._execute("SELECT COUNT(*) FROM memo WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def evict(self):
+        # Drops results older than max_age, then the least recently accessed ones beyond max_entries. Only the dropped
+        # results leave the in-memory LRU.
+        with self._lock:
+            self._inserts_since_eviction = 0
+            if self.max_age is None and self.max_entries is None:
+                return
+            self._execute("BEGIN IMMEDIATE")
+            try:
+                evicted_keys = []
+                if self.max_age is not None:
+                    oldest_created = time.time() - self.max_age
+                    evicted_keys.extend(key for key, in self._execute(
+                        "SELECT key FROM memo WHERE namespace = ? AND created < ?",
+                        (self.namespace, oldest_created)).fetchall())
+                    self._execute("DELETE FROM memo WHERE namespace = ? AND created < ?",
+                                  (self.namespace, oldest_created))
+                if self.max_entries is not None:
+                    surplus_keys = [key for key, in self._execute(
+                        "SELECT key FROM memo WHERE namespace = ? ORDER BY accessed DESC LIMIT -1 OFFSET ?",
+                        (self.namespace, self.max_entries)).fetchall()]
+                    self.connection.executemany("DELETE FROM memo WHERE namespace = ? AND key = ?",
+                                                [(self.namespace, key) for key in surplus_keys])
+                    evicted_keys.extend(surplus_keys)
+                self._execute("COMMIT")
+            except BaseException:
+                self._execute("ROLLBACK")
+                raise
+            for key in evicted_keys:
+                self._cache.pop(key, None)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,169 @@
+import atexit
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Tuple
+
+# Workers sample their stacks when this variable names a directory, they inherit it from the campaign like
+# METAMORPHIC_TIMING_DIR (see simulator/timing.py)
+PROFILE_DIR_ENV = "METAMORPHIC_PROFILE_DIR"
+PROFILE_RATE_ENV = "METAMORPHIC_PROFILE_RATE"
+COLLAPSED_FILE = "profile.collapsed"
+ALLOCATIONS_FILE = "allocations.txt"
+# Workers write their profile at most this often, and when they exit
+FLUSH_SECONDS = 30.0
+TRACEMALLOC_FRAMES = 1
+TOP_ALLOCATIONS = 50
+
+_lock = threading.Lock()
+_stacks: Counter = Counter()
+_sampler = None
+_started_pid = None
+_last_flush = 0.0
+
+
+# Samples the Python stack of every other thread of the process rate times per second. Stacks are counted in the
+# collapsed format of flamegraph.pl, from the thread name down to the innermost frame.
+class StackSampler(threading.Thread):
+
+    def __init__(self, rate: float):
+        super().__init__(name="StackSampler", daemon=True)
+        self.interval = 1.0 / rate
+        self._stopped = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            if len(names) != len(frames):
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                with _lock:
+                    _stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+
+
+def enabled() -> bool:
+    return os.environ.get(PROFILE_DIR_ENV) is not None
+
+
+def enable(profile_dir: str, rate: float = 100.0):
+    # Profiles this process and the processes it starts from now on
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    os.environ[PROFILE_DIR_ENV] = str(Path(profile_dir).absolute())
+    os.environ[PROFILE_RATE_ENV] = str(rate)
+    start()
+
+
+def start():
+    # Starts the sampler and tracemalloc in this process if profiling is enabled and they are not running yet. Forked
+    # processes start their own.
+    global _sampler, _started_pid, _last_flush
+    if not enabled() or _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    _stacks.clear()
+    _last_flush = time.monotonic()
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    _sampler = StackSampler(float(os.environ.get(PROFILE_RATE_ENV, "100")))
+    _sampler.start()
+
+
+def checkpoint():
+    # Called by workers between tasks: starts profiling on the first task and writes the profile now and then
+    start()
+    if _started_pid == os.getpid() and time.monotonic() - _last_flush >= FLUSH_SECONDS:
+        flush()
+
+
+def flush():
+    # Replaces the stack and allocation files of this process. Allocations are those still live, with the peak of the
+    # traced memory.
+    global _last_flush
+    if _started_pid != os.getpid():
+        return
+    _last_flush = time.monotonic()
+    profile_dir = Path(os.environ[PROFILE_DIR_ENV])
+    worker = f"{socket.gethostname()}_{os.getpid()}"
+    with _lock:
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in _stacks.items())
+    # The samples and the snapshot of the profiler are left out
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                          tracemalloc.Filter(False, tracemalloc.__file__)])
+    statistics = snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+    allocations = {"peak_bytes": tracemalloc.get_traced_memory()[1],
+                   "allocations": [{"file": statistic.traceback[0].filename,
+                                    "line": statistic.traceback[0].lineno,
+                                    "bytes": statistic.size,
+                                    "count": statistic.count} for statistic in statistics]}
+    for path, content in [(profile_dir.joinpath(f"stacks_{worker}.collapsed"), collapsed),
+                          (profile_dir.joinpath(f"allocations_{worker}.json"), json.dumps(allocations))]:
+        temporary_path = path.with_suffix(".tmp")
+        temporary_path.write_text(content)
+        os.replace(temporary_path, path)
+
+
+atexit.register(flush)
+
+
+def merge(profile_dir: str) -> Tuple[Path, Path]:
+    # Adds up the stacks of every worker into COLLAPSED_FILE and their allocations, by line, into ALLOCATIONS_FILE
+    stacks: Counter = Counter()
+    for stacks_path in Path(profile_dir).glob("stacks_*.collapsed"):
+        for line in stacks_path.read_text().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            stacks[stack] += int(count)
+    collapsed_path = Path(profile_dir, COLLAPSED_FILE)
+    collapsed_path.write_text("".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items())))
+
+    allocations: Dict[Tuple[str, int], Tuple[int, int]] = {}
+    peaks = []
+    for allocations_path in sorted(Path(profile_dir).glob("allocations_*.json")):
+        worker_allocations = json.loads(allocations_path.read_text())
+        peaks.append((allocations_path.stem[len("allocations_"):], worker_allocations["peak_bytes"]))
+        for allocation in worker_allocations["allocations"]:
+            size, count = allocations.get((allocation["file"], allocation["line"]), (0, 0))
+            allocations[(allocation["file"], allocation["line"])] = (size + allocation["bytes"],
+                                                                     count + allocation["count"])
+    allocations_path = Path(profile_dir, ALLOCATIONS_FILE)
+    with open(allocations_path, "w") as report:
+        report.write(f"Live allocations of {len(peaks)} workers, largest first\n")
+        for (file, line), (size, count) in sorted(allocations.items(), key=lambda item: -item[1][0]):
+            report.write(f"{size / 1024:12.1f} KiB {count:10d} blocks  {file}:{line}\n")
+        report.write("\nPeak traced memory per worker\n")
+        for worker, peak_bytes in sorted(peaks, key=lambda peak: -peak[1]):
+            report.write(f"{peak_bytes / 1024 / 1024:12.1f} MiB  {worker}\n")
+    return collapsed_path, allocations_path
+
+
+def finish():
+    # Ends a profiled run in the main process: stops the joblib workers so that they write their profile, then merges
+    # the profiles of every process
+    from joblib.externals.loky import get_reusable_executor
+    get_reusable_executor().shutdown(wait=True)
+    flush()
+    collapsed_path, allocations_path = merge(os.environ[PROFILE_DIR_ENV])
+    print("Profile written to " + str(collapsed_path) + " and " + str(allocations_path), flush=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Need to provide the profile directory of a run")
+        exit(1)
+    merge(sys.argv[1])
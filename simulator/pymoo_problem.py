@@ -0,0 +1,23 @@
+from pymoo.core.problem import Problem
+
+from simulator.candidates import CandidateEncoding, PopulationEvaluator
+from simulator.simulator import Simulator
+from simulator.surrogate import SurrogateScreen
+
+
+# pymoo problem over Simulator: the whole population of a generation is evaluated by a single Simulator.run_many, and
+# Simulator.memo is reused across generations. evaluator.history keeps the simulations and hit rate of each generation.
+class SimulatorProblem(Problem):
+
+    def __init__(self, simulator: Simulator, max_robots: int, surrogate_options: dict = None, **encoding_options):
+        self.encoding = CandidateEncoding(simulator, max_robots, **encoding_options)
+        # With surrogate_options (arguments of SurrogateScreen, {} for the defaults) candidates are screened first
+        surrogate = SurrogateScreen(self.encoding, **surrogate_options) if surrogate_options is not None else None
+        self.evaluator = PopulationEvaluator(simulator, self.encoding, surrogate)
+        super().__init__(n_var=self.encoding.number_of_variables,
+                         n_obj=len(self.encoding.objectives),
+                         xl=self.encoding.lower_bounds,
+                         xu=self.encoding.upper_bounds)
+
+    def _evaluate(self, X, out, *args, **kwargs):
+        out["F"] = self.evaluator.evaluate(X)
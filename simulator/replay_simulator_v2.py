@@ -0,0 +1,216 @@
+import datetime
+import hashlib
+import json
+import os
+import random
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Literal, List, Tuple, Dict, Optional, Iterable, NamedTuple
+from zipfile import ZipFile
+
+from simulator.fake_simulator import parse_time
+from simulator.result_cache import link_or_copy
+from simulator.simulator_v2 import SimulatorV2
+
+# Result files that make up the recorded outcome of a simulation
+RESULT_FILES = ("cost.csv", "risk.csv", "value.csv", "robot_requests_db.csv")
+
+
+def normalise_request_line(line: str) -> str:
+    # Demand files and the customer_request.csv written by the simulator do not format times the same way, and times
+    # without an offset are in the simulator's time zone
+    fields = line.rstrip("\n").split(",")
+    for i in (1, 5, 6, 7, 8):
+        if i < len(fields):
+            fields[i] = parse_time(fields[i]).isoformat()
+    return ",".join(fields)
+
+
+def replay_key(num_customer_requests, num_robots, num_operators, seed,
+               request_lines: Optional[Iterable[str]]) -> str:
+    # What a recording is indexed by: the parts of the input that its name records, and the requests. Requests
+    # generated by the simulator (demand mode "uniform") are not part of the key, as callers do not know them.
+    requests = sorted(normalise_request_line(line) for line in request_lines) if request_lines is not None else None
+    return hashlib.sha256(json.dumps([int(num_customer_requests), int(num_robots), int(num_operators), int(seed),
+                                      requests]).encode()).hexdigest()
+
+
+class Recording(NamedTuple):
+    path: str
+    mtime_ns: int
+    size: int
+    # Key with the recorded requests, and key without them for originals (generated requests)
+    request_key: str
+    generated_key: Optional[str]
+    result_digest: str
+
+
+# Seconds a replayed simulation takes: base_seconds, plus per_request_seconds for each customer request and
+# per_robot_seconds for each robot, scaled by a log-normal factor with standard deviation jitter
+class LatencyModel:
+
+    def __init__(self, base_seconds: float = 0.0, per_request_seconds: float = 0.0, per_robot_seconds: float = 0.0,
+                 jitter: float = 0.0, seed: int = None):
+        self.base_seconds = base_seconds
+        self.per_request_seconds = per_request_seconds
+        self.per_robot_seconds = per_robot_seconds
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def seconds(self, num_requests: int, num_robots: int) -> float:
+        seconds = self.base_seconds + self.per_request_seconds * num_requests + self.per_robot_seconds * num_robots
+        return seconds * self.random.lognormvariate(0.0, self.jitter) if self.jitter > 0 else seconds
+
+
+# Serves run_simulation from a corpus of recorded original_*.zip/followup_*.zip results instead of running the
+# simulator. A simulation is replayed from the zip with its name when the inputs recorded in that zip match, otherwise
+# from any zip recorded for the same input. The number of requests, robots and operators and the seed come from the
+# name of the zip and the requests from its customer_request.csv; the rest of the configuration (speed, capacity,
+# service and utilization times) is assumed to be the one the corpus was recorded with. Inputs whose recordings
+# disagree, such as follow-ups that only change the utilization time, are therefore only replayed by name.
+# The corpus is indexed once and the index is kept in index_path, only new or changed zips are read again.
+class ReplaySimulatorV2(SimulatorV2):
+
+    def __init__(self, simulator_dir, corpus_dirs: Iterable = None, index_path=None,
+                 latency_model: LatencyModel = None, on_missing: Literal["error", "crash"] = "error",
+                 index_threads: int = 8):
+        super().__init__(simulator_dir, archive_mode="none")
+        self.corpus_dirs = [Path(corpus_dir) for corpus_dir in corpus_dirs] if corpus_dirs is not None \
+            else [self.simulator_dir.joinpath("bin", "result")]
+        self.index_path = Path(index_path) if index_path is not None \
+            else self.corpus_dirs[0].joinpath(".replay_index.json")
+        self.latency_model = latency_model if latency_model is not None else LatencyModel()
+        # "error" raises a RuntimeError for inputs without recording, "crash" reports them as a crashed simulation
+        assert on_missing in ("error", "crash"), f"Unknown on_missing {on_missing}"
+        self.on_missing = on_missing
+        self.index_threads = index_threads
+        self.replayed = 0
+        self.missing = 0
+        self.by_name: Dict[str, Recording] = {}
+        self.by_key: Dict[str, Optional[Recording]] = {}
+        self.load_index()
+
+    @staticmethod
+    def parse_name(name: str) -> Tuple[str, int, int, int, int]:
+        # original_<requests>_<robots>_<operators>[_<utilization>...]_<seed> or
+        # followup_<rule>_<requests>_<robots>_<operators>[_<utilization>...]_<seed>_<index>
+        fields = name.split("_")
+        if fields[0] == "followup":
+            return fields[0], int(fields[2]), int(fields[3]), int(fields[4]), int(fields[-2])
+        return fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[-1])
+
+    @staticmethod
+    def record(path: Path) -> Recording:
+        sim_name, num_customer_requests, num_robots, num_operators, seed = ReplaySimulatorV2.parse_name(path.stem)
+        stat = path.stat()
+        with ZipFile(path) as zip_file:
+            customer_request_csv = next(info for info in zip_file.filelist
+                                        if info.filename.endswith("customer_request.csv"))
+            request_lines = zip_file.read(customer_request_csv).decode().splitlines()[1:]
+            result_digest = hashlib.sha256()
+            for suffix in RESULT_FILES:
+                result_digest.update(zip_file.read(next(info for info in zip_file.filelist
+                                                        if info.filename.endswith(suffix))))
+        return Recording(path=str(path),
+                         mtime_ns=stat.st_mtime_ns,
+                         size=stat.st_size,
+                         request_key=replay_key(num_customer_requests, num_robots, num_operators, seed,
+                                                request_lines),
+                         generated_key=replay_key(num_customer_requests, num_robots, num_operators, seed, None)
+                         if sim_name == "original" else None,
+                         result_digest=result_digest.hexdigest())
+
+    def load_index(self):
+        known = {}
+        if self.index_path.is_file():
+            with open(self.index_path) as index_file:
+                known = {name: Recording(*fields) for name, fields in json.load(index_file).items()}
+        paths = {path.stem: path for corpus_dir in self.corpus_dirs
+                 for path in corpus_dir.glob("*.zip") if path.stem.startswith(("original_", "followup_"))}
+
+        def up_to_date(name: str) -> bool:
+            if name not in known:
+                return False
+            stat = paths[name].stat()
+            return known[name].path == str(paths[name]) and (known[name].mtime_ns, known[name].size) == \
+                (stat.st_mtime_ns, stat.st_size)
+
+        outdated = [name for name in paths if not up_to_date(name)]
+        with ThreadPoolExecutor(max_workers=self.index_threads) as executor:
+            recordings = dict(zip(outdated, executor.map(lambda name: self.record(paths[name]), outdated)))
+        self.by_name = {name: recordings[name] if name in recordings else known[name] for name in paths}
+
+        # Keys whose recordings do not all have the same result cannot be replayed by content
+        self.by_key = {}
+        for recording in self.by_name.values():
+            for key in (recording.request_key, recording.generated_key):
+                if key is None:
+                    continue
+                if key in self.by_key and (self.by_key[key] is None or
+                                           self.by_key[key].result_digest != recording.result_digest):
+                    self.by_key[key] = None
+                else:
+                    self.by_key.setdefault(key, recording)
+
+        if len(outdated) > 0 or len(known) != len(self.by_name):
+            temporary_index_path = self.index_path.with_name(self.index_path.name + f".{os.getpid()}.tmp")
+            with open(temporary_index_path, "w") as index_file:
+                json.dump({name: list(recording) for name, recording in self.by_name.items()}, index_file)
+            os.replace(temporary_index_path, self.index_path)
+        print(f"Indexed {len(self.by_name)} recorded results ({len(outdated)} read)", flush=True)
+
+    def find_recording(self, sim_name: str, sim_id: str, num_customer_requests: int, num_robots: int,
+                       num_operators: int, seed: int, request_lines: Optional[List[str]]) -> Optional[Recording]:
+        key = replay_key(num_customer_requests, num_robots, num_operators, seed, request_lines)
+        recording = self.by_name.get(sim_name + "_" + sim_id)
+        if recording is not None and key in (recording.request_key, recording.generated_key):
+            return recording
+        return self.by_key.get(key)
+
+    def run_simulation(self,
+                       sim_name: str,
+                       sim_id: str,
+                       service_start_time: datetime.datetime,
+                       service_end_time: datetime.datetime,
+                       num_customer_requests: int,
+                       num_robots: int,
+                       robot_speed_kmph: float,
+                       robot_loading_capacity: int,
+                       area_name: str = "FujisawaSST",
+                       seed: int = 0,
+                       demand_mode: Literal["uniform", "distance", "file"] = "uniform",
+                       demand_file: str = None,
+                       utilization_time_period: List[Tuple[datetime.time, datetime.time]] = None,
+                       num_operators: int = 1
+                       ):
+        # Same checks on the arguments as the real simulator
+        command = self._build_command(sim_name, sim_id, service_start_time, service_end_time, num_customer_requests,
+                                      num_robots, robot_speed_kmph, robot_loading_capacity, area_name, seed,
+                                      demand_mode, demand_file, utilization_time_period, num_operators)
+        request_lines = None
+        if demand_mode == "file":
+            with open(demand_file) as requests_file:
+                request_lines = requests_file.readlines()[1:]
+        recording = self.find_recording(sim_name, sim_id, num_customer_requests, num_robots, num_operators, seed,
+                                        request_lines)
+        if recording is None:
+            self.missing += 1
+            if self.on_missing == "crash":
+                raise subprocess.CalledProcessError(1, command, b"", b"No recorded result for this input")
+            raise RuntimeError(f"No recorded result for {sim_name}_{sim_id}")
+
+        started = time.perf_counter()
+        result_zip = self.simulator_dir.joinpath("bin", "result", sim_name + "_" + sim_id + ".zip")
+        if not result_zip.exists() or not os.path.samefile(recording.path, result_zip):
+            link_or_copy(Path(recording.path), result_zip)
+        with ZipFile(result_zip) as zip_file:
+            sim_result = self.zip_to_results_dict(zip_file)
+            sim_result["customer_requests"] = self.zip_to_requests(zip_file)
+        self.replayed += 1
+
+        latency = self.latency_model.seconds(len(sim_result["customer_requests"]), num_robots)
+        if latency > time.perf_counter() - started:
+            time.sleep(latency - (time.perf_counter() - started))
+        return sim_result
@@ -0,0 +1,141 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Iterable
+
+# Arguments of SimulatorV2.run_simulation that only name the run or point to its input, they are not part of a key
+NAMING_KEYS = {"sim_name", "sim_id", "demand_file"}
+DEFAULT_CONFIGURATION = {"area_name": "FujisawaSST",
+                         "seed": 0,
+                         "demand_mode": "uniform",
+                         "utilization_time_period": None,
+                         "num_operators": 1}
+
+_binary_digests = {}
+
+
+def _canonical_value(value):
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_canonical_value(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def canonical_simulation_input(simulator_config: Dict, request_lines: Optional[Iterable[str]] = None) -> str:
+    # request_lines are the rows of the demand file (Request.to_csv), their order does not matter
+    configuration = dict(DEFAULT_CONFIGURATION)
+    configuration.update({k: v for k, v in simulator_config.items() if k not in NAMING_KEYS})
+    if configuration["utilization_time_period"] is not None:
+        configuration["utilization_time_period"] = \
+            configuration["utilization_time_period"][:configuration["num_robots"]]
+    configuration = {k: _canonical_value(v) for k, v in configuration.items()}
+    requests = sorted(line.rstrip("\n") for line in request_lines) if request_lines is not None else None
+    return json.dumps({"configuration": configuration, "requests": requests}, sort_keys=True)
+
+
+def binary_digest(binary_path: Path) -> str:
+    # Hash of the simulator binary, so that results of an older scheduler build are never reused
+    binary_stat = os.stat(binary_path)
+    cache_key = (str(binary_path), binary_stat.st_mtime_ns, binary_stat.st_size)
+    if cache_key not in _binary_digests:
+        digest = hashlib.sha256()
+        with open(binary_path, "rb") as binary:
+            for chunk in iter(lambda: binary.read(1 << 20), b""):
+                digest.update(chunk)
+        _binary_digests[cache_key] = digest.hexdigest()
+    return _binary_digests[cache_key]
+
+
+def simulation_key(simulator_config: Dict, request_lines: Optional[Iterable[str]], simulator_digest: str) -> str:
+    return hashlib.sha256((simulator_digest + "\n" + canonical_simulation_input(simulator_config, request_lines))
+                          .encode()).hexdigest()
+
+
+def link_or_copy(source: Path, destination: Path):
+    # Hard links keep cached results free, copies are only made across file systems
+    temporary_destination = Path(str(destination) + f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(source, temporary_destination)
+    except OSError:
+        shutil.copyfile(source, temporary_destination)
+    os.replace(temporary_destination, destination)
+    # Renaming a hard link onto another link of the same file does nothing and leaves the temporary link behind
+    temporary_destination.unlink(missing_ok=True)
+
+
+# Result zips stored by the content key of their input. Entries are evicted in least recently used order once there
+# are more than max_entries of them. The least recently used order survives restarts through the modification time
+# of the cached zips. Several processes can share one cache directory, the size cap is then only approximate.
+class ResultCache:
+    def __init__(self, cache_dir, max_entries: int = 100000):
+        assert max_entries > 0, "The cache must be able to hold at least one result."
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.inserts = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        for cached_zip in sorted(self.cache_dir.glob("*.zip"), key=lambda path: path.stat().st_mtime_ns):
+            self._entries[cached_zip.stem] = cached_zip
+        self._evict()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return key in self._entries or self._path(key).is_file()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key + ".zip")
+
+    def lookup(self, key: str) -> Optional[Path]:
+        path = self._path(key)
+        with self._lock:
+            if key not in self._entries and not path.is_file():
+                return None
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another process sharing the cache directory
+                self._entries.pop(key, None)
+                return None
+            self._entries[key] = path
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return path
+
+    def insert(self, key: str, result_zip: Path) -> Path:
+        path = self._path(key)
+        link_or_copy(Path(result_zip), path)
+        with self._lock:
+            self._entries[key] = path
+            self._entries.move_to_end(key)
+            self.inserts += 1
+            self._evict()
+        return path
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            _, path = self._entries.popitem(last=False)
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,89 @@
+from collections.abc import MutableMapping
+from typing import Dict, List, Iterator, Any
+
+import numpy as np
+from scipy import stats
+
+# Fields that run_spec adds to the metrics of every simulation
+RUN_FIELDS = [('unique_id', np.int64), ('seed', np.int64), ('requests_per_hour', np.int64),
+              ('execution_time', np.float64)]
+
+
+# Columnar results of Simulator.run: one row per simulation of a NumPy structured array, sorted by sim_id.
+# Means and variances are computed over whole columns. The flat dict that Simulator.run used to return (the mean of
+# each metric, 'simulations', the execution times and a '<field>_<sim_id>' entry per simulation) is still available
+# through the mapping interface, per-simulation entries being read from the columns only when asked for.
+class SimulationResults(MutableMapping):
+
+    def __init__(self, metrics: List[Dict], metric_names: List[str], **summary):
+        self.metric_names = list(metric_names)
+        dtype = [('sim_id', np.int64)] + [(name, np.float64) for name in self.metric_names] + RUN_FIELDS
+        self.records = np.array([tuple(m.get(field, 0) for field, _ in dtype) for m in metrics], dtype=dtype)
+        self.records.sort(order='sim_id')
+        self.summary = summary
+        self._field_names = [field for field, _ in dtype if field != 'sim_id']
+
+    @property
+    def sim_ids(self) -> np.ndarray:
+        return self.records['sim_id']
+
+    def column(self, field: str) -> np.ndarray:
+        return self.records[field]
+
+    def row(self, sim_id: int) -> np.void:
+        index = np.searchsorted(self.records['sim_id'], sim_id)
+        if index == len(self.records) or self.records['sim_id'][index] != sim_id:
+            raise KeyError(sim_id)
+        return self.records[index]
+
+    def _metric_matrix(self) -> np.ndarray:
+        return np.column_stack([self.records[name] for name in self.metric_names]) if len(self.records) \
+            else np.empty((0, len(self.metric_names)))
+
+    def means(self) -> Dict[str, float]:
+        return dict(zip(self.metric_names, self._metric_matrix().mean(axis=0)))
+
+    def variances(self, ddof: int = 1) -> Dict[str, float]:
+        if len(self.records) <= ddof:
+            return {name: np.nan for name in self.metric_names}
+        return dict(zip(self.metric_names, self._metric_matrix().var(axis=0, ddof=ddof)))
+
+    def confidence_half_widths(self, confidence: float = 0.95) -> Dict[str, float]:
+        # Half-width of the Student t confidence interval of the mean of each metric
+        if len(self.records) < 2:
+            return {name: np.inf for name in self.metric_names}
+        t = stats.t.ppf((1 + confidence) / 2, len(self.records) - 1)
+        return {name: t * np.sqrt(variance / len(self.records)) for name, variance in self.variances().items()}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __getitem__(self, key: str):
+        if key in self.summary:
+            return self.summary[key]
+        if key in self.metric_names:
+            return self.records[key].mean()
+        field, _, sim_id = key.rpartition('_')
+        if field in self._field_names and sim_id.isdigit():
+            return self.row(int(sim_id))[field]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        self.summary[key] = value
+
+    def __delitem__(self, key: str):
+        del self.summary[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.metric_names
+        for sim_id in self.records['sim_id']:
+            for field in self._field_names:
+                yield f'{field}_{sim_id}'
+        yield from (key for key in self.summary if key not in self.metric_names)
+
+    def __len__(self) -> int:
+        return len(self.metric_names) + len(self.records) * len(self._field_names) + \
+            sum(1 for key in self.summary if key not in self.metric_names)
+
+    def __repr__(self):
+        return f'SimulationResults({self.to_dict()})'
@@ -1,8 +1,12 @@
+import hashlib
+import os
 import subprocess
+import threading
 import random
 import time
 import logging as log
-from typing import Tuple, List, Dict
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Tuple, List, Dict, NamedTuple
 from itertools import count
 import multiprocessing
 import pandas as pd
@@ -11,6 +15,29 @@ import numpy as np
 import datetime
 from joblib import Parallel, delayed
 
+from simulator.memo import PersistentMemo
+from simulator.results import SimulationResults
+
+
+# Everything a worker needs to run one simulation. Only this is sent to the workers, not the Simulator and its memo.
+class RunSpec(NamedTuple):
+    num_robots: int
+    robot_speed_kmh: float
+    utilization_time_period: str
+    working_hours_per_robot: Tuple[int, ...]
+    sim_id: int
+    unique_id: int
+    seed: int
+    requests_per_hour: int
+    start_time: datetime.datetime
+    simulation_duration: int
+    robot_loading_capacity: int
+    results_folder: str
+
+
+def execute_run_spec(simulator_class, spec: RunSpec) -> Dict:
+    return simulator_class.run_spec(spec)
+
 
 class Simulator:
     NUM_DELIVERED = 'num_delivered'
@@ -18,6 +45,8 @@ class Simulator:
     UTILIZATION_RATE = 'utilization_rate'
     DELIVERY_RATE = 'delivery_rate'
     reconcilation_at_the_end = False # if true, the missing simulations are run at the end. Otherwise, they are run immediatly (but only considered if needed)
+    prefetch_unselected = False # if true (and not reconcilation_at_the_end), only the selected simulations are waited for, the others are run in the background
+    prefetch_niceness = 19
 
     METRICS = [NUM_RISKS, NUM_DELIVERED, UTILIZATION_RATE, DELIVERY_RATE]
 
@@ -26,7 +55,9 @@ class Simulator:
                  robot_loading_capacity: int, simulation_duration: int,
                  threads: int = None, number_of_simulations: int = 1, seed: int = 48979683312,
                  results_folder: str = 'default',
-                 year: int = 2021, month: int = 1, day: int = 1, hour: int = 9, minutes: int = 0):
+                 year: int = 2021, month: int = 1, day: int = 1, hour: int = 9, minutes: int = 0,
+                 memo_path: str = None, memo_cache_size: int = 10000, memo_max_entries: int = None,
+                 memo_max_age: float = None):
         assert 0 < min_customer_requests_per_hour <= max_customer_requests_per_hour, 'Upper bound should be more than equal than lower bound.'
         self.robot_loading_capacity = robot_loading_capacity
         self.start_time = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minutes)
@@ -41,7 +72,89 @@ class Simulator:
                                                      number_of_simulations)))
         self.selected_simulations = set()
         self.sim_counter = count()
-        self.memo = {}
+        # Without a memo_path results are only memoised for the lifetime of this object
+        self.memo = {} if memo_path is None else PersistentMemo(memo_path,
+                                                                namespace=self.memo_namespace(),
+                                                                cache_size=memo_cache_size,
+                                                                max_entries=memo_max_entries,
+                                                                max_age=memo_max_age)
+        self._parallel = None
+        self._prefetch_executor = None
+        self._prefetches: Dict[Tuple, Future] = {}
+        self._memo_lock = threading.Lock()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.simulated_hours = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_parallel"] = None
+        state["_prefetch_executor"] = None
+        state["_prefetches"] = {}
+        state["_memo_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memo_lock = threading.Lock()
+
+    @property
+    def parallel(self) -> Parallel:
+        # One pool of workers reused by every call to run, see close
+        if self._parallel is None:
+            self._parallel = Parallel(n_jobs=self.threads)
+            self._parallel.__enter__()
+        return self._parallel
+
+    @property
+    def prefetch_executor(self) -> ProcessPoolExecutor:
+        # Separate workers for the prefetched simulations, at a lower priority than the ones of parallel
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ProcessPoolExecutor(max_workers=self.threads,
+                                                          initializer=os.nice,
+                                                          initargs=(self.prefetch_niceness,))
+        return self._prefetch_executor
+
+    def close(self):
+        if self._parallel is not None:
+            self._parallel.__exit__(None, None, None)
+            self._parallel = None
+        if self._prefetch_executor is not None:
+            self.cancel_prefetch()
+            self._prefetch_executor.shutdown(wait=True)
+            self._prefetch_executor = None
+
+    def cancel_prefetch(self, keep=()):
+        # Prefetches that have not started yet are dropped, the running ones still end up in the memo
+        for key, future in list(self._prefetches.items()):
+            if key not in keep:
+                future.cancel()
+
+    def _store_prefetched(self, key, future: Future):
+        # The future leaves _prefetches and its result enters the memo under the same lock, so that _fetch always finds
+        # a finished prefetch in one of them
+        if future.cancelled():
+            self._prefetches.pop(key, None)
+            return
+        if future.exception() is not None:
+            self._prefetches.pop(key, None)
+            log.getLogger().warning(f'Prefetched simulation {key} failed: {future.exception()}')
+            return
+        with self._memo_lock:
+            self._prefetches.pop(key, None)
+            self.memo[key] = future.result()
+
+    def _prefetch(self, key, spec: RunSpec):
+        future = self.prefetch_executor.submit(execute_run_spec, type(self), spec)
+        self._prefetches[key] = future
+        future.add_done_callback(lambda done: self._store_prefetched(key, done))
+
+    def memo_namespace(self):
+        # Memoised results can only be shared by simulators whose sim_ids run the same seeds and request rates
+        return hashlib.sha256(repr((self.seeds,
+                                    self.request_per_hour,
+                                    self.robot_loading_capacity,
+                                    self.start_time.isoformat())).encode()).hexdigest()
 
     def get_unique_id(self):
         return self.sim_counter.__next__()
@@ -91,143 +204,212 @@ class Simulator:
         return set(range(len(self.seeds)))
 
     def run(self, num_robots: int, robot_speed_kmh: float, utilization_time_period: List[Tuple[int, int]] = None):
-        assert type(num_robots) == int and num_robots > 0, "The number of robots must be a positive integer."
-        assert type(robot_speed_kmh) == float and robot_speed_kmh > 0.0, "The speed must be a positive value."
-        start = time.time()
-        formatted_utilization_time_period = self.format_utilization_time_period(utilization_time_period)
-        working_hours_per_robot = self.calculate_working_hours(num_robots, utilization_time_period)
+        return self.run_many([(num_robots, robot_speed_kmh, utilization_time_period)])[0]
 
-        if self.reconcilation_at_the_end:
-            selected_simulations = self.get_current_simulations()
-            number_of_simulations = len(selected_simulations)
-            log.getLogger().info(
-                f'Number of simulations for this generation: {number_of_simulations} ({self.selected_simulations})')
-            simulations = [(num_robots,
-                            robot_speed_kmh,
-                            formatted_utilization_time_period,
-                            sim_id) for sim_id in selected_simulations]
-
-            metrics = []
-
-            # Getting previous results from cache and checking which simulations are missing
-            missing_simulations = []
-            for (num_robots, robot_speed_kmh, utilization_time_period, sim_id) in simulations:
+    def run_many(self, candidates: List[Tuple]) -> List[SimulationResults]:
+        # Evaluates a whole population: every (candidate, sim_id) missing from the memo is sent to the workers at once,
+        # so the batch waits on one barrier instead of one per candidate. candidates are (num_robots, robot_speed_kmh)
+        # or (num_robots, robot_speed_kmh, utilization_time_period) tuples, one result is returned per candidate.
+        start = time.time()
+        selected_simulations = self.get_current_simulations()
+        all_simulations = self.get_all_simulations()
+        if self.reconcilation_at_the_end or self.prefetch_unselected:
+            simulations_to_run = selected_simulations
+        else:
+            simulations_to_run = all_simulations
+        log.getLogger().info(
+            f'Number of simulations for this generation: {len(candidates)} x {len(simulations_to_run)}'
+            f' ({simulations_to_run})')
+
+        candidate_keys = [self._candidate_keys(*candidate) for candidate in candidates]
+        if self.prefetch_unselected:
+            # The optimiser moved on, the prefetches of other candidates are no longer worth running
+            self.cancel_prefetch(keep={key for keys, _ in candidate_keys for key in keys.values()})
+
+        found = self._fetch([(keys, working_hours_per_robot, simulations_to_run)
+                             for keys, working_hours_per_robot in candidate_keys])
+
+        if self.prefetch_unselected:
+            for keys, working_hours_per_robot in candidate_keys:
+                for sim_id in sorted(all_simulations - selected_simulations):
+                    key = keys[sim_id]
+                    if key not in self._prefetches and key not in self.memo:
+                        self._prefetch(key, self.make_run_spec(*key[:3], working_hours_per_robot, sim_id,
+                                                               self.get_unique_id()))
+
+        execution_time = time.time() - start
+        responses = []
+        for keys, _ in candidate_keys:
+            metrics = [found[keys[sim_id]] for sim_id in simulations_to_run]
+            if not self.reconcilation_at_the_end:
+                metrics = [metric for metric in metrics if metric['sim_id'] in selected_simulations]
+            responses.append(SimulationResults(metrics, self.METRICS,
+                                               simulations=len(selected_simulations),
+                                               sequential_execution_time=sum(m['execution_time'] for m in metrics),
+                                               execution_time=execution_time))
+        return responses
+
+    def replication_order(self) -> List[int]:
+        # Order in which run_adaptive adds replications: the current selection, then the other sim_ids in an order
+        # that is the same for every candidate so that candidates are compared on the same seeds
+        selected_simulations = sorted(self.get_current_simulations())
+        others = sorted(self.get_all_simulations() - set(selected_simulations))
+        random.Random(self.seeds[0]).shuffle(others)
+        return selected_simulations + others
+
+    def run_adaptive(self, num_robots: int, robot_speed_kmh: float,
+                     utilization_time_period: List[Tuple[int, int]] = None, **options) -> SimulationResults:
+        return self.run_adaptive_many([(num_robots, robot_speed_kmh, utilization_time_period)], **options)[0]
+
+    def run_adaptive_many(self, candidates: List[Tuple], batch_size: int = None, relative_precision: float = 0.05,
+                          absolute_precision: Dict[str, float] = None, confidence: float = 0.95,
+                          min_simulations: int = 2, max_simulations: int = None) -> List[SimulationResults]:
+        # Adds replications to each candidate, batch_size at a time, until the confidence interval half-width of every
+        # metric is within absolute_precision[metric] (relative_precision times the mean for metrics without one) or
+        # max_simulations (all the seeds by default) is reached. The batches of all the candidates that have not
+        # converged yet are dispatched together. The response has 'simulations', 'converged' and a 'ci_<metric>'
+        # half-width per metric.
+        start = time.time()
+        absolute_precision = absolute_precision or {}
+        order = self.replication_order()
+        max_simulations = min(max_simulations or len(order), len(order))
+        batch_size = batch_size or self.threads
+        candidate_keys = [self._candidate_keys(*candidate) for candidate in candidates]
+
+        fetched = [0] * len(candidates)
+        targets = [min(max(min_simulations, batch_size), max_simulations)] * len(candidates)
+        results: List[SimulationResults] = [None] * len(candidates)
+        converged = [False] * len(candidates)
+        found = {}
+        active = list(range(len(candidates)))
+        while active:
+            found.update(self._fetch([(candidate_keys[i][0], candidate_keys[i][1], order[fetched[i]:targets[i]])
+                                      for i in active]))
+            still_active = []
+            for i in active:
+                fetched[i] = targets[i]
+                keys = candidate_keys[i][0]
+                results[i] = SimulationResults([found[keys[sim_id]] for sim_id in order[:fetched[i]]], self.METRICS)
+                means = results[i].means()
+                half_widths = results[i].confidence_half_widths(confidence)
+                converged[i] = all(half_widths[metric] <= absolute_precision.get(metric,
+                                                                                 relative_precision * abs(means[metric]))
+                                   for metric in self.METRICS)
+                if not converged[i] and fetched[i] < max_simulations:
+                    targets[i] = min(fetched[i] + batch_size, max_simulations)
+                    still_active.append(i)
+            active = still_active
+
+        execution_time = time.time() - start
+        for i, result in enumerate(results):
+            result.summary.update({'simulations': fetched[i],
+                                   'converged': converged[i],
+                                   'sequential_execution_time': float(result.column('execution_time').sum()),
+                                   'execution_time': execution_time})
+            result.summary.update({f'ci_{metric}': half_width
+                                   for metric, half_width in result.confidence_half_widths(confidence).items()})
+        return results
+
+    def run_multi_fidelity(self, candidates: List[Tuple], screening_duration: int, promote_fraction: float = 0.2,
+                           rank_by: str = DELIVERY_RATE, maximise: bool = True, promote_threshold: float = None,
+                           min_promoted: int = 1) -> List[SimulationResults]:
+        # Runs every candidate over screening_duration hours, then only the best promote_fraction of them (by the
+        # rank_by metric, and only those reaching promote_threshold when given) over the full simulation_duration.
+        # Memo keys contain the duration, so results of both fidelities are kept apart. The response of each
+        # candidate has 'fidelity', the duration its metrics come from, and 'promoted'.
+        assert 0 < screening_duration <= self.simulation_duration, "The screening must be shorter than the simulation."
+        full_duration = self.simulation_duration
+        self.update_simulation_duration(screening_duration)
+        try:
+            screening_results = self.run_many(candidates)
+        finally:
+            self.update_simulation_duration(full_duration)
+
+        scores = np.array([result[rank_by] for result in screening_results], dtype=float)
+        ranking = np.argsort(-scores if maximise else scores, kind='stable')
+        number_promoted = min(max(math.ceil(promote_fraction * len(candidates)), min_promoted), len(candidates))
+        promoted = [i for i in ranking[:number_promoted]
+                    if promote_threshold is None or
+                    (scores[i] >= promote_threshold if maximise else scores[i] <= promote_threshold)]
+        log.getLogger().info(f'Promoting {len(promoted)} of {len(candidates)} candidates '
+                             f'from {screening_duration}h to {full_duration}h')
+
+        results = list(screening_results)
+        for result in results:
+            result.update(fidelity=screening_duration, promoted=False)
+        for i, result in zip(promoted, self.run_many([candidates[i] for i in promoted])):
+            result.update(fidelity=full_duration, promoted=True)
+            results[i] = result
+        return results
+
+    def _fetch(self, requests: List[Tuple[Dict, List[int], set]]) -> Dict[Tuple, Dict]:
+        # requests are (keys by sim_id, working hours per robot, sim_ids) of candidates. Returns the metrics of every
+        # requested simulation by memo key, the missing ones being sent to the workers in a single dispatch.
+        found = {}
+        missing_simulations = {}
+        prefetched = {}
+        # Getting previous results from cache and checking which simulations are missing
+        for keys, working_hours_per_robot, sim_ids in requests:
+            for sim_id in sim_ids:
                 # the sim_id determines the seed and the requests per hour
-                key = (num_robots, robot_speed_kmh, utilization_time_period, self.simulation_duration, sim_id)
-                if key in self.memo:
-                    metrics.append(self.memo[key])
+                key = keys[sim_id]
+                if key in found or key in missing_simulations or key in prefetched:
+                    continue
+                with self._memo_lock:
+                    metric = self.memo.get(key)
+                    future = self._prefetches.get(key)
+                    if metric is None and future is not None and future.done():
+                        # Finished, but _store_prefetched has not stored it in the memo yet
+                        self._prefetches.pop(key)
+                if metric is not None:
+                    found[key] = metric
+                elif future is not None and future.done() and not future.cancelled() and future.exception() is None:
+                    found[key] = future.result()
+                elif future is not None and not future.done() and not future.cancel():
+                    # Running, or finished since it was looked up
+                    prefetched[key] = future
                 else:
-                    missing_simulations.append((num_robots,
-                                                robot_speed_kmh,
-                                                utilization_time_period,
-                                                working_hours_per_robot,
-                                                sim_id,
-                                                self.get_unique_id()))
-
-            # Adding the missing data to the cache
-            missing_metrics = Parallel(n_jobs=self.threads)(
-                delayed(self.run_single_simulation)(*params) for params in missing_simulations)
-            for metric in missing_metrics:
-                key = (num_robots, robot_speed_kmh, utilization_time_period, self.simulation_duration, metric['sim_id'])
+                    num_robots, robot_speed_kmh, utilization_time_period, _, _ = key
+                    missing_simulations[key] = self.make_run_spec(num_robots,
+                                                                  robot_speed_kmh,
+                                                                  utilization_time_period,
+                                                                  working_hours_per_robot,
+                                                                  sim_id,
+                                                                  self.get_unique_id())
+        self.memo_hits += len(found)
+        self.memo_misses += len(missing_simulations) + len(prefetched)
+        self.simulated_hours += sum(spec.simulation_duration for spec in missing_simulations.values())
+
+        # Adding the missing data to the cache
+        missing_metrics = self.parallel(
+            delayed(execute_run_spec)(type(self), spec) for spec in missing_simulations.values())
+        for key, metric in zip(missing_simulations, missing_metrics):
+            with self._memo_lock:
                 self.memo[key] = metric
-                metrics.append(metric)
+            found[key] = metric
+        for key, future in prefetched.items():
+            found[key] = future.result()
+        return found
 
-            metrics_values = [[m[label] for label in self.METRICS] for m in metrics]
-            labels = self.METRICS
-            response = dict(zip(labels, np.apply_along_axis(np.mean, 0, np.array(metrics_values))))
+    def _candidate_keys(self, num_robots: int, robot_speed_kmh: float,
+                        utilization_time_period: List[Tuple[int, int]] = None):
+        assert type(num_robots) == int and num_robots > 0, "The number of robots must be a positive integer."
+        assert type(robot_speed_kmh) == float and robot_speed_kmh > 0.0, "The speed must be a positive value."
+        formatted_utilization_time_period = self.format_utilization_time_period(utilization_time_period)
+        working_hours_per_robot = self.calculate_working_hours(num_robots, utilization_time_period)
+        keys = {sim_id: (num_robots, robot_speed_kmh, formatted_utilization_time_period, self.simulation_duration,
+                         sim_id) for sim_id in self.get_all_simulations()}
+        return keys, working_hours_per_robot
 
-            sequential_execution_time = 0.0
-            response['simulations'] = number_of_simulations
-            for metrics_single in metrics:
-                i = metrics_single['sim_id']
-                for k, v in metrics_single.items():
-                    if k != 'sim_id':
-                        response[f'{k}_{i}'] = v
-                sequential_execution_time += metrics_single['execution_time']
+    def is_memoised(self, num_robots: int, robot_speed_kmh: float,
+                    utilization_time_period: List[Tuple[int, int]] = None) -> bool:
+        keys, _ = self._candidate_keys(num_robots, robot_speed_kmh, utilization_time_period)
+        return all(keys[sim_id] in self.memo for sim_id in self.get_current_simulations())
 
-            response['sequential_execution_time'] = sequential_execution_time
-            response['execution_time'] = time.time() - start
-
-            return response
-        else:
-            selected_simulations = self.get_current_simulations()
-            all_simulations = self.get_all_simulations()
-            #number_of_simulations = len(selected_simulations)
-            number_of_selected_simulations = len(selected_simulations)
-            number_of_simulations = len(all_simulations)
-            #log.getLogger().info(f'Number of simulations for this generation: {number_of_simulations} ({self.selected_simulations})')
-            log.getLogger().info(
-                f'Number of simulations for this generation: {number_of_simulations} ({all_simulations})')
-            simulations = [(num_robots,
-                            robot_speed_kmh,
-                            formatted_utilization_time_period,
-                            sim_id) for sim_id in
-                           #selected_simulations
-                           all_simulations
-                           ]
-
-            metrics = []
-
-            # Getting previous results from cache and checking which simulations are missing
-            missing_simulations = []
-            for (num_robots, robot_speed_kmh, utilization_time_period, sim_id) in simulations:
-                # the sim_id determines the seed and the requests per hour
-                key = (num_robots, robot_speed_kmh, utilization_time_period, self.simulation_duration, sim_id)
-                if key in self.memo:
-                    print("found in memo")
-                    metrics.append(self.memo[key])
-                else:
-                    missing_simulations.append((num_robots,
-                                                robot_speed_kmh,
-                                                utilization_time_period,
-                                                working_hours_per_robot,
-                                                sim_id,
-                                                self.get_unique_id()))
-
-            # Adding the missing data to the cache
-            missing_metrics = Parallel(n_jobs=self.threads)(
-                delayed(self.run_single_simulation)(*params) for params in missing_simulations)
-            for metric in missing_metrics:
-                key = (num_robots, robot_speed_kmh, utilization_time_period, self.simulation_duration, metric['sim_id'])
-                self.memo[key] = metric
-                metrics.append(metric)
-
-            #print("metrics")
-            #print(metrics)
-            selected_metrics = []
-            for metric in metrics:
-                if metric['sim_id'] in selected_simulations:
-                    selected_metrics.append(metric)
-            #print("selected_metrics")
-            #print(selected_metrics)
-
-            #metrics_values = [[m[label] for label in self.METRICS] for m in metrics]
-            metrics_values = [[m[label] for label in self.METRICS] for m in selected_metrics]
-            labels = self.METRICS
-            response = dict(zip(labels, np.apply_along_axis(np.mean, 0, np.array(metrics_values))))
-
-            #print("response")
-            #print(metrics_values)
-            #print("selected_simulations")
-            #print(selected_simulations)
-            #print("all_simulations")
-            #print(all_simulations)
-
-            sequential_execution_time = 0.0
-            #response['simulations'] = number_of_simulations
-            response['simulations'] = number_of_selected_simulations
-            #for metrics_single in metrics:
-            for metrics_single in selected_metrics:
-                i = metrics_single['sim_id']
-                for k, v in metrics_single.items():
-                    if k != 'sim_id':
-                        response[f'{k}_{i}'] = v
-                sequential_execution_time += metrics_single['execution_time']
-
-            response['sequential_execution_time'] = sequential_execution_time
-            response['execution_time'] = time.time() - start
-
-            return response
+    @property
+    def memo_hit_rate(self) -> float:
+        lookups = self.memo_hits + self.memo_misses
+        return self.memo_hits / lookups if lookups else 0.0
 
     def run_no_robots(self, robot_speed_kmh: float):
         assert type(robot_speed_kmh) == float and robot_speed_kmh > 0.0, "The speed must be a positive value."
@@ -244,27 +426,46 @@ class Simulator:
 
         return response
 
+    def make_run_spec(self, num_robots, robot_speed_kmh, utilization_time_period, working_hours_per_robot, sim_id,
+                      unique_id) -> RunSpec:
+        return RunSpec(num_robots=num_robots,
+                       robot_speed_kmh=robot_speed_kmh,
+                       utilization_time_period=utilization_time_period,
+                       working_hours_per_robot=tuple(working_hours_per_robot),
+                       sim_id=sim_id,
+                       unique_id=unique_id,
+                       seed=self.seeds[sim_id],
+                       requests_per_hour=self.request_per_hour[sim_id],
+                       start_time=self.start_time,
+                       simulation_duration=self.simulation_duration,
+                       robot_loading_capacity=self.robot_loading_capacity,
+                       results_folder=self.results_folder)
+
     def run_single_simulation(self, num_robots, robot_speed_kmh, utilization_time_period, working_hours_per_robot, sim_id, unique_id):
+        return self.run_spec(self.make_run_spec(num_robots, robot_speed_kmh, utilization_time_period,
+                                                working_hours_per_robot, sim_id, unique_id))
+
+    @classmethod
+    def run_spec(cls, spec: RunSpec):
         try:
             start = time.time()
-            requests_per_hour = self.request_per_hour[sim_id]
-            seed = self.seeds[sim_id]
-            command = (f'run/run --seed {seed} --sim_name {self.results_folder} --sim_id {unique_id}'
-                       f' --start_time {self.start_time.isoformat()}'
-                       f' --end_time {self.get_end_time().isoformat()}'
-                       f' --num_customer_requests {requests_per_hour * self.simulation_duration}'
-                       f' --num_robots {num_robots}'
-                       f' --robot_speed_kmph {robot_speed_kmh}'
-                       f' --robot_loading_capacity {self.robot_loading_capacity}')
-
-            if utilization_time_period:
-                command += f' --utilization_time_period {utilization_time_period}'
-
-            result = self.execute_command(command, requests_per_hour, unique_id, working_hours_per_robot)
-            result['sim_id'] = sim_id
-            result['unique_id'] = unique_id
-            result['seed'] = seed
-            result['requests_per_hour'] = requests_per_hour
+            end_time = spec.start_time + datetime.timedelta(hours=spec.simulation_duration)
+            command = (f'run/run --seed {spec.seed} --sim_name {spec.results_folder} --sim_id {spec.unique_id}'
+                       f' --start_time {spec.start_time.isoformat()}'
+                       f' --end_time {end_time.isoformat()}'
+                       f' --num_customer_requests {spec.requests_per_hour * spec.simulation_duration}'
+                       f' --num_robots {spec.num_robots}'
+                       f' --robot_speed_kmph {spec.robot_speed_kmh}'
+                       f' --robot_loading_capacity {spec.robot_loading_capacity}')
+
+            if spec.utilization_time_period:
+                command += f' --utilization_time_period {spec.utilization_time_period}'
+
+            result = cls.execute_spec(command, spec)
+            result['sim_id'] = spec.sim_id
+            result['unique_id'] = spec.unique_id
+            result['seed'] = spec.seed
+            result['requests_per_hour'] = spec.requests_per_hour
             result['execution_time'] = time.time() - start
 
             return result
@@ -275,30 +476,63 @@ class Simulator:
 
     def execute_command(self, command: str, requests_per_hour: int, sim_id: int, working_hours_per_robot: List[int]) -> \
             Dict[str, float]:
+        # Kept for existing callers, the workers run execute_spec on a RunSpec
+        return self.execute_spec(command, self._command_spec(requests_per_hour, sim_id, working_hours_per_robot))
+
+    def _command_spec(self, requests_per_hour: int, sim_id: int, working_hours_per_robot: List[int]) -> RunSpec:
+        # Only the fields read by execute_spec are known to execute_command
+        return RunSpec(num_robots=len(working_hours_per_robot),
+                       robot_speed_kmh=None,
+                       utilization_time_period=None,
+                       working_hours_per_robot=tuple(working_hours_per_robot),
+                       sim_id=sim_id,
+                       unique_id=sim_id,
+                       seed=None,
+                       requests_per_hour=requests_per_hour,
+                       start_time=self.start_time,
+                       simulation_duration=self.simulation_duration,
+                       robot_loading_capacity=self.robot_loading_capacity,
+                       results_folder=self.results_folder)
+
+    @classmethod
+    def execute_spec(cls, command: str, spec: RunSpec) -> Dict[str, float]:
         subprocess.run(command, shell=True, check=True, capture_output=True, cwd="simulator/bin")
         try:
-            df_cost = pd.read_csv(f'simulator/bin/result/{self.results_folder}/{sim_id}/cost.csv')
-            df_risk = pd.read_csv(f'simulator/bin/result/{self.results_folder}/{sim_id}/risk.csv')
+            df_cost = pd.read_csv(f'simulator/bin/result/{spec.results_folder}/{spec.unique_id}/cost.csv')
+            df_risk = pd.read_csv(f'simulator/bin/result/{spec.results_folder}/{spec.unique_id}/risk.csv')
         except:
             print("Error reading files cost.csv or risk.csv from folder "
-                  + f'simulator/bin/result/{self.results_folder}/{sim_id}')
-            return self.worst_response()
+                  + f'simulator/bin/result/{spec.results_folder}/{spec.unique_id}')
+            return cls.worst_response()
 
         num_delivered = df_cost['num_delivered']
         utilization_rate = df_cost['utilization_rate']
         num_risks = df_risk.index.size
 
-        return self.create_response(num_delivered, num_risks, requests_per_hour, utilization_rate,
-                                    working_hours_per_robot)
+        return cls.spec_response(num_delivered, num_risks, spec.requests_per_hour, utilization_rate,
+                                 spec.working_hours_per_robot, spec.simulation_duration)
 
     def create_response(self, num_delivered, num_risks, requests_per_hour, utilization_rate, working_hours_per_robot):
-        working_percentage = pd.Series(working_hours_per_robot) / self.simulation_duration
-        adjusted_utilization_rate = utilization_rate / working_percentage
+        # Kept for existing callers, the workers call spec_response with the duration of the spec
+        return self.spec_response(num_delivered, num_risks, requests_per_hour, utilization_rate,
+                                  working_hours_per_robot, self.simulation_duration)
 
-        return {Simulator.NUM_DELIVERED: num_delivered.sum() / self.simulation_duration,
-                Simulator.UTILIZATION_RATE: adjusted_utilization_rate.mean(),
-                Simulator.DELIVERY_RATE: num_delivered.sum() / (requests_per_hour * self.simulation_duration),
-                Simulator.NUM_RISKS: num_risks / self.simulation_duration}
+    @staticmethod
+    def spec_response(num_delivered, num_risks, requests_per_hour, utilization_rate, working_hours_per_robot,
+                      simulation_duration):
+        # Robots missing from cost.csv, or without working hours, are left out of the utilization rate, as the index
+        # alignment of the Series used to do
+        num_delivered = np.asarray(num_delivered, dtype=float)
+        utilization_rate = np.asarray(utilization_rate, dtype=float)
+        working_percentage = np.asarray(working_hours_per_robot, dtype=float) / simulation_duration
+        number_of_robots = min(len(utilization_rate), len(working_percentage))
+        adjusted_utilization_rate = utilization_rate[:number_of_robots] / working_percentage[:number_of_robots]
+        total_delivered = num_delivered.sum()
+
+        return {Simulator.NUM_DELIVERED: total_delivered / simulation_duration,
+                Simulator.UTILIZATION_RATE: adjusted_utilization_rate.mean() if number_of_robots else np.nan,
+                Simulator.DELIVERY_RATE: total_delivered / (requests_per_hour * simulation_duration),
+                Simulator.NUM_RISKS: num_risks / simulation_duration}
 
     @staticmethod
     def worst_response():
@@ -310,13 +544,14 @@ class Simulator:
 
 class MockSimulator(Simulator):
 
-    def execute_command(self, command, requests_per_hour: int, sim_id: int, working_hours_per_robot: List[int]):
+    @classmethod
+    def execute_spec(cls, command: str, spec: RunSpec):
         log.getLogger().debug(command)
-        log.getLogger().debug(f'simulator/bin/result/{self.results_folder}/{sim_id}/cost.csv')
+        log.getLogger().debug(f'simulator/bin/result/{spec.results_folder}/{spec.unique_id}/cost.csv')
 
-        utilization_rate = pd.Series([random.random() * (wh / self.simulation_duration) for wh in working_hours_per_robot])
-        num_delivered = pd.Series([random.randint(10, 100) for _ in working_hours_per_robot])
+        utilization_rate = [random.random() * (wh / spec.simulation_duration) for wh in spec.working_hours_per_robot]
+        num_delivered = [random.randint(10, 100) for _ in spec.working_hours_per_robot]
         num_risks = random.randint(0, 100)
 
-        return self.create_response(num_delivered, num_risks, requests_per_hour, utilization_rate,
-                                    working_hours_per_robot)
+        return cls.spec_response(num_delivered, num_risks, spec.requests_per_hour, utilization_rate,
+                                 spec.working_hours_per_robot, spec.simulation_duration)
@@ -1,9 +1,10 @@
+import contextvars
 import io
 import subprocess
 import sys
-import zipfile
 from datetime import datetime, time
-from typing import Literal, List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, List, Tuple, Dict, IO, Callable, Optional, Iterable
 import os
 from pathlib import Path
 import pandas
@@ -12,11 +13,64 @@ from simulator import Simulator
 from zipfile import ZipFile
 
 from metamorphic.Request import Request
+from simulator.result_cache import ResultCache, binary_digest, link_or_copy, simulation_key
+from simulator.timing import span
+from simulator.worker_pool import SimulatorWorkerPool
 
 
 class SimulatorV2:
-    def __init__(self, simulator_dir):
+    # Whether run_simulation takes a stop predicate (see StandinSimulatorV2), the simulator binary always runs to the end
+    supports_early_termination = False
+
+    def __init__(self, simulator_dir, pool_size: int = 0, max_runs_per_worker: int = 100,
+                 archive_mode: Literal["sync", "background", "none"] = "sync", archive_threads: int = 1,
+                 result_cache: ResultCache = None):
         self.simulator_dir = Path(simulator_dir)
+        # Results are reused by content of their input when a cache is given. Only archived results are cached.
+        self.result_cache = result_cache
+        # "sync" zips and deletes each result directory before returning, "background" does it in a thread pool
+        # (see wait_for_archives) and "none" leaves the result directory in place
+        assert archive_mode in ("sync", "background", "none"), f"Unknown archive mode {archive_mode}"
+        self.archive_mode = archive_mode
+        self.archive_threads = archive_threads
+        self._archive_executor = None
+        self._pending_archives = []
+        # With pool_size > 0, runs are sent to warm simulator workers instead of one process per run
+        self.pool_size = pool_size
+        self.max_runs_per_worker = max_runs_per_worker
+        self._worker_pool = None
+
+    def __getstate__(self):
+        # Worker processes cannot be shipped to joblib workers, each process starts its own pool
+        state = dict(self.__dict__)
+        state["_worker_pool"] = None
+        state["_archive_executor"] = None
+        state["_pending_archives"] = []
+        return state
+
+    @property
+    def worker_pool(self) -> SimulatorWorkerPool:
+        if self._worker_pool is None and self.pool_size > 0:
+            self._worker_pool = SimulatorWorkerPool(str(self.simulator_dir.joinpath("bin", "run", "run").absolute()),
+                                                    self.simulator_dir.joinpath("bin"),
+                                                    self.pool_size,
+                                                    self.max_runs_per_worker)
+        return self._worker_pool
+
+    @property
+    def archive_executor(self) -> ThreadPoolExecutor:
+        if self._archive_executor is None:
+            self._archive_executor = ThreadPoolExecutor(max_workers=self.archive_threads)
+        return self._archive_executor
+
+    def close(self):
+        if self._worker_pool is not None:
+            self._worker_pool.close()
+            self._worker_pool = None
+        self.wait_for_archives()
+        if self._archive_executor is not None:
+            self._archive_executor.shutdown()
+            self._archive_executor = None
 
     def run_simulation(self,
                        sim_name: str,
@@ -34,11 +88,120 @@ class SimulatorV2:
                        utilization_time_period: List[Tuple[time, time]] = None,
                        num_operators: int = 1
                        ):
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self._simulation_cache_key(service_start_time, service_end_time, num_customer_requests,
+                                                   num_robots, robot_speed_kmph, robot_loading_capacity, area_name,
+                                                   seed, demand_mode, demand_file, utilization_time_period,
+                                                   num_operators)
+            with span("restore_cached_result"):
+                sim_result = self._restore_cached_result(cache_key, sim_name, sim_id)
+            if sim_result is not None:
+                return sim_result
+
+        command = self._build_command(sim_name, sim_id, service_start_time, service_end_time, num_customer_requests,
+                                      num_robots, robot_speed_kmph, robot_loading_capacity, area_name, seed,
+                                      demand_mode, demand_file, utilization_time_period, num_operators)
+        try:
+            with span("simulate"):
+                self._execute(command).check_returncode()
+        except subprocess.CalledProcessError as e:
+            self._print_failure(command, e)
+            raise e
+
+        return self._collect_result(sim_name, sim_id, cache_key)
+
+    def _simulation_cache_key(self,
+                              service_start_time: datetime,
+                              service_end_time: datetime,
+                              num_customer_requests: int,
+                              num_robots: int,
+                              robot_speed_kmph: float,
+                              robot_loading_capacity: int,
+                              area_name: str = "FujisawaSST",
+                              seed: int = 0,
+                              demand_mode: Literal["uniform", "distance", "file"] = "uniform",
+                              demand_file: str = None,
+                              utilization_time_period: List[Tuple[time, time]] = None,
+                              num_operators: int = 1
+                              ) -> str:
+        # Invalid arguments fail as they would when building the command, before the demand file is read
+        self._check_demand(num_customer_requests, demand_mode, demand_file)
+        request_lines = None
+        if demand_mode == "file":
+            with open(demand_file) as requests_file:
+                request_lines = requests_file.readlines()[1:]
+        return self._cache_key({"service_start_time": service_start_time,
+                                "service_end_time": service_end_time,
+                                "num_customer_requests": num_customer_requests,
+                                "num_robots": num_robots,
+                                "robot_speed_kmph": robot_speed_kmph,
+                                "robot_loading_capacity": robot_loading_capacity,
+                                "area_name": area_name,
+                                "seed": seed,
+                                "demand_mode": demand_mode,
+                                "utilization_time_period": utilization_time_period,
+                                "num_operators": num_operators},
+                               request_lines)
+
+    def _execute(self, command: List[str]) -> subprocess.CompletedProcess:
+        if self.worker_pool is not None:
+            return self.worker_pool.run(command)
+        return subprocess.run(command, capture_output=True, cwd=self.simulator_dir.joinpath("bin"))
+
+    def _cache_key(self, simulator_config: Dict, request_lines: Optional[Iterable[str]]) -> str:
+        return simulation_key(simulator_config,
+                              request_lines,
+                              binary_digest(self.simulator_dir.joinpath("bin", "run", "run")))
+
+    def lookup_result(self,
+                      sim_name: str,
+                      sim_id: str,
+                      simulator_config: Dict,
+                      requests: Optional[Iterable[Request]] = None) -> Optional[Dict]:
+        # Returns the cached result of running simulator_config (the keyword arguments of run_simulation) on requests,
+        # stored under sim_name and sim_id as if it had just been run, or None if it was never run
+        if self.result_cache is None:
+            return None
+        request_lines = [request.to_csv() for request in requests] if requests is not None else None
+        return self._restore_cached_result(self._cache_key(simulator_config, request_lines), sim_name, sim_id)
+
+    def _restore_cached_result(self, cache_key: str, sim_name: str, sim_id: str) -> Optional[Dict]:
+        cached_zip = self.result_cache.lookup(cache_key)
+        if cached_zip is None:
+            return None
+        result_zip = self.simulator_dir.joinpath("bin", "result", sim_name + "_" + sim_id + ".zip")
+        link_or_copy(cached_zip, result_zip)
+        with ZipFile(result_zip) as zip_file:
+            sim_result = self.zip_to_results_dict(zip_file)
+            sim_result["customer_requests"] = self.zip_to_requests(zip_file)
+        return sim_result
+
+    @staticmethod
+    def _check_demand(num_customer_requests: int, demand_mode: str, demand_file: Optional[str]):
         if demand_mode != "file" and num_customer_requests is None:
             raise RuntimeError("Number of customer requests needs to be set when not using a requests file")
         if demand_mode == "file" and demand_file is None:
             raise RuntimeError("demand_file must be set when using demand_mode \"file\"")
-        elif demand_file is not None and demand_mode != "file":
+
+    def _build_command(self,
+                       sim_name: str,
+                       sim_id: str,
+                       service_start_time: datetime,
+                       service_end_time: datetime,
+                       num_customer_requests: int,
+                       num_robots: int,
+                       robot_speed_kmph: float,
+                       robot_loading_capacity: int,
+                       area_name: str = "FujisawaSST",
+                       seed: int = 0,
+                       demand_mode: Literal["uniform", "distance", "file"] = "uniform",
+                       demand_file: str = None,
+                       utilization_time_period: List[Tuple[time, time]] = None,
+                       num_operators: int = 1
+                       ) -> List[str]:
+        self._check_demand(num_customer_requests, demand_mode, demand_file)
+        if demand_file is not None and demand_mode != "file":
             print("Warning: Set a demand file but demand mode is not \"file\", demand file will be ignored.")
 
         if utilization_time_period is not None and len(utilization_time_period) > num_robots:
@@ -69,27 +232,50 @@ class SimulatorV2:
                                          utilization_time_period))
                             ])
 
-        try:
-            completed_process = subprocess.run(command, check=True, capture_output=True,
-                                               cwd=self.simulator_dir.joinpath("bin"))
-            completed_process.check_returncode()
-        except subprocess.CalledProcessError as e:
-            print("Command: ", " ".join(command))
-            print("-------------------- stdout --------------------")
-            print(e.stdout)
-            print("-------------------- stderr --------------------")
-            print(e.stderr)
-            raise e
+        return command
+
+    @staticmethod
+    def _print_failure(command: List[str], e: subprocess.CalledProcessError):
+        print("Command: ", " ".join(command))
+        print("-------------------- stdout --------------------")
+        print(e.stdout)
+        print("-------------------- stderr --------------------")
+        print(e.stderr)
+
+    def _collect_result(self, sim_name: str, sim_id: str, cache_key: str = None) -> Dict:
+        # Results are parsed straight from the result directory, archiving it does not delay the next simulation
+        # unless archive_mode is "sync"
+        result_dir = self.simulator_dir.joinpath("bin", "result", sim_name, sim_id)
+        with span("parse_result"):
+            sim_result = self.dir_to_results_dict(result_dir, sim_name + "_" + sim_id)
+        if sim_result["truncated"]:
+            # A run stopped early is only good for the verdict it was stopped for
+            cache_key = None
+        if self.archive_mode == "sync":
+            self._archive(sim_name, sim_id, cache_key)
+        elif self.archive_mode == "background":
+            # The archive is timed under the labels of the run it belongs to, the context of the thread pool has none
+            self._pending_archives.append(self.archive_executor.submit(contextvars.copy_context().run, self._archive,
+                                                                       sim_name, sim_id, cache_key))
+        return sim_result
 
-        shutil.make_archive(str(self.simulator_dir.joinpath("bin", "result", sim_name + "_" + sim_id)),
-                            "zip",
-                            self.simulator_dir.joinpath("bin", "result"),
-                            os.path.join(sim_name, sim_id))
+    def _archive(self, sim_name: str, sim_id: str, cache_key: str = None):
+        with span("archive"):
+            shutil.make_archive(str(self.simulator_dir.joinpath("bin", "result", sim_name + "_" + sim_id)),
+                                "zip",
+                                self.simulator_dir.joinpath("bin", "result"),
+                                os.path.join(sim_name, sim_id))
 
-        shutil.rmtree(self.simulator_dir.joinpath("bin", "result", sim_name, sim_id))
+            shutil.rmtree(self.simulator_dir.joinpath("bin", "result", sim_name, sim_id))
 
-        with zipfile.ZipFile(self.simulator_dir.joinpath("bin", "result", sim_name + "_" + sim_id + ".zip")) as zip_file:
-            return self.zip_to_results_dict(zip_file)
+        if cache_key is not None:
+            self.result_cache.insert(cache_key, self.simulator_dir.joinpath("bin", "result", sim_name + "_" + sim_id
+                                                                            + ".zip"))
+
+    def wait_for_archives(self):
+        pending_archives, self._pending_archives = self._pending_archives, []
+        for pending_archive in pending_archives:
+            pending_archive.result()
 
     @staticmethod
     def zip_to_requests(zip_file: ZipFile) -> List[Request]:
@@ -100,8 +286,25 @@ class SimulatorV2:
 
     @staticmethod
     def zip_to_results_dict(zip_file: ZipFile) -> Dict:
+        def open_result_file(suffix: str) -> IO[bytes]:
+            return zip_file.open(next(filter(lambda fi: fi.filename.endswith(suffix), zip_file.filelist)))
+
+        return SimulatorV2._results_dict(os.path.basename(zip_file.filename), open_result_file, False)
+
+    @staticmethod
+    def dir_to_results_dict(result_dir: Path, file_name: str) -> Dict:
+        # Same as zip_to_results_dict for a result directory that has not been archived, file_name is the name the
+        # archive would have. The customer requests are parsed as well, under "customer_requests".
+        result_files = [path for path in Path(result_dir).rglob("*") if path.is_file()]
+
+        def open_result_file(suffix: str) -> IO[bytes]:
+            return open(next(filter(lambda path: str(path).endswith(suffix), result_files)), "rb")
+
+        return SimulatorV2._results_dict(file_name, open_result_file, True)
+
+    @staticmethod
+    def _results_dict(file_name: str, open_result_file: Callable[[str], IO[bytes]], parse_requests: bool) -> Dict:
         sim_result = dict()
-        file_name = os.path.basename(zip_file.filename)
         sim_result['sim_name'] = file_name.split("_")[0]
         sim_result['sim_id'] = file_name[file_name.find("_") + 1:]
         if sim_result['sim_id'].endswith(".zip"):
@@ -111,7 +314,13 @@ class SimulatorV2:
         sim_result['requests_per_hour'] = file_name.split("_")[2] if sim_result['sim_name'] == "followup" \
             else file_name.split("_")[1]
 
-        with zip_file.open(next(filter(lambda fi: fi.filename.endswith("cost.csv"), zip_file.filelist))) as cost_csv:
+        try:
+            with open_result_file("truncated"):
+                sim_result["truncated"] = True
+        except StopIteration:
+            sim_result["truncated"] = False
+
+        with open_result_file("cost.csv") as cost_csv:
             sim_result["cost"] = pandas.read_csv(cost_csv,
                                                  header=0,
                                                  names=["robot_id", "tripmeter", "total_run_h", "total_load_h",
@@ -119,7 +328,7 @@ class SimulatorV2:
                                                         "utilization_rate"])
         sim_result[Simulator.UTILIZATION_RATE] = sim_result["cost"]["utilization_rate"]
 
-        with zip_file.open(next(filter(lambda fi: fi.filename.endswith("risk.csv"), zip_file.filelist))) as risk_csv:
+        with open_result_file("risk.csv") as risk_csv:
             sim_result["risk"] = pandas.read_csv(risk_csv,
                                                  header=0,
                                                  names=["risk_id", "datetime",
@@ -130,21 +339,23 @@ class SimulatorV2:
                                                         "sensor_type"])
         sim_result[Simulator.NUM_RISKS] = len(sim_result["risk"])
 
-        with zip_file.open(next(filter(lambda fi: fi.filename.endswith("value.csv"), zip_file.filelist))) as value_csv:
+        with open_result_file("value.csv") as value_csv:
             sim_result["value"] = pandas.read_csv(value_csv,
                                                   header=0,
                                                   names=["robot_id", "num_pickedup", "total_pickedup_quantity",
                                                          "num_delivered", "total_delivered_quantity"])
         sim_result[Simulator.NUM_DELIVERED] = sim_result["value"]["total_delivered_quantity"].sum()
 
-        with zip_file.open(next(filter(lambda fi: fi.filename.endswith("customer_request.csv"),
-                                       zip_file.filelist))
-                           ) as customer_request_csv:
-            number_of_requests = sum(1 for _ in customer_request_csv) - 1
+        with open_result_file("customer_request.csv") as customer_request_csv:
+            if parse_requests:
+                sim_result["customer_requests"] = \
+                    Request.read_test_from_csv_file(io.TextIOWrapper(customer_request_csv))
+                number_of_requests = len(sim_result["customer_requests"])
+            else:
+                number_of_requests = sum(1 for _ in customer_request_csv) - 1
         sim_result[Simulator.DELIVERY_RATE] = sim_result[Simulator.NUM_DELIVERED] / number_of_requests
 
-        with zip_file.open(next(filter(lambda fi: fi.filename.endswith("robot_requests_db.csv"), zip_file.filelist))) \
-                as robot_requests_db_csv:
+        with open_result_file("robot_requests_db.csv") as robot_requests_db_csv:
             sim_result["robot_requests_db"] = pandas.read_csv(robot_requests_db_csv,
                                                               header=0,
                                                               names=["robot_request_id", "customer_request_id",
@@ -0,0 +1,368 @@
+import datetime
+import functools
+import heapq
+import random
+from pathlib import Path
+from typing import List, Tuple, Optional, NamedTuple, Callable
+
+import numpy as np
+
+from metamorphic.Request import Request
+
+# Layout of the stand-in area: targets and the crossings where robots meet pedestrians are placed at fixed,
+# pseudo-random points of an AREA_SIZE_KM square derived from their names, with the depot in its centre
+AREA_SIZE_KM = 1.5
+NUMBER_OF_CROSSINGS = 12
+CROSSING_RADIUS_KM = 0.05
+# Minutes an operator needs to load one piece of baggage at the depot, and minutes spent at each pickup or delivery
+LOAD_MINUTES = 2.0
+STOP_MINUTES = 1.0
+RISK_COLUMNS = ["risk_id", "datetime",
+                "id0", "type0", "speed0", "lat0", "lng0", "x0", "y0", "velocity_x0", "velocity_y0",
+                "id1", "type1", "speed1", "lat1", "lng1", "x1", "y1", "velocity_x1", "velocity_y1",
+                "sensor_type"]
+# Reference point used to write the coordinates of the stand-in area as latitudes and longitudes
+ORIGIN_LAT_LNG = (35.3300, 139.4900)
+KM_PER_DEGREE = 111.0
+
+
+# Cached, as every scenario of a campaign places the same few targets again
+@functools.lru_cache(maxsize=None)
+def point(name: str) -> Tuple[float, float]:
+    generator = random.Random(name)
+    return generator.uniform(0.0, AREA_SIZE_KM), generator.uniform(0.0, AREA_SIZE_KM)
+
+
+def crossings(area_name: str) -> np.ndarray:
+    return np.array([point(f"{area_name}:crossing:{i}") for i in range(NUMBER_OF_CROSSINGS)])
+
+
+# Input of one simulation. Times are datetimes, windows has the (start, end) of each robot's shift.
+class Scenario(NamedTuple):
+    requests: List[Request]
+    service_start_time: datetime.datetime
+    service_end_time: datetime.datetime
+    num_robots: int
+    robot_speed_kmph: float
+    robot_loading_capacity: int
+    num_operators: int
+    windows: List[Tuple[datetime.datetime, datetime.datetime]]
+    area_name: str = "FujisawaSST"
+
+
+# Orders the requests a free robot may take on its next trip, the engine then loads the longest prefix of that order
+# that fits in the robot and can be served in time. Subclasses change the dispatching policy.
+class Scheduler:
+
+    def order(self, engine: "StandinEngine", robot: int, now: float, candidates: np.ndarray) -> np.ndarray:
+        # Earliest delivery deadline first, ties broken by request id
+        return candidates[np.lexsort((engine.ids[candidates], engine.delivery_end[candidates]))]
+
+
+class FirstComeFirstServedScheduler(Scheduler):
+
+    def order(self, engine: "StandinEngine", robot: int, now: float, candidates: np.ndarray) -> np.ndarray:
+        return candidates[np.lexsort((engine.ids[candidates], engine.order_time[candidates]))]
+
+
+class Trip(NamedTuple):
+    robot: int
+    requests: Tuple[int, ...]
+    ready: float
+    load_start: float
+    depart: float
+    pickups: Tuple[float, ...]
+    deliveries: Tuple[float, ...]
+    back: float
+    km: float
+
+
+# What an epoch compared its inputs with, kept when tracing to tell from which epoch a follow-up may differ. upcoming
+# is the next order time a robot with nothing to serve waited for (inf if none), horizon the latest time compared with
+# the end of the robot's shift.
+class EpochTrace(NamedTuple):
+    now: float
+    robot: int
+    idle: bool
+    upcoming: float
+    horizon: float
+
+
+# Mutable part of a simulation, kept apart from the inputs so that it can be copied at any epoch
+class EngineState:
+
+    def __init__(self, num_robots: int, num_requests: int):
+        self.robots: List[Tuple[float, int]] = []
+        self.operators: List[float] = []
+        self.pending = np.ones(num_requests, dtype=bool)
+        self.robot_by_request = np.full(num_requests, -1)
+        self.pickup_time = np.full(num_requests, np.nan)
+        self.delivery_time = np.full(num_requests, np.nan)
+        self.tripmeter = np.zeros(num_robots)
+        self.run_seconds = np.zeros(num_robots)
+        self.load_seconds = np.zeros(num_robots)
+        self.operator_shortage_seconds = np.zeros(num_robots)
+        self.trips: List[Trip] = []
+        self.risks: List[Tuple[float, int, int, float, float]] = []
+        self.epoch = 0
+        self.now = 0.0
+
+    def copy(self) -> "EngineState":
+        state = EngineState.__new__(EngineState)
+        state.__dict__.update({k: (v.copy() if isinstance(v, (np.ndarray, list)) else v)
+                               for k, v in self.__dict__.items()})
+        return state
+
+    @property
+    def delivered(self) -> int:
+        return int((self.robot_by_request >= 0).sum())
+
+
+# Discrete-event stand-in for the delivery simulator. Robots are kept in a heap by the time they are next free. At each
+# epoch the robot free the earliest asks the scheduler for an order of the pending requests it could serve on its own,
+# and takes the longest prefix that fits its loading capacity and can be picked up and delivered within every time
+# window and its shift. Baggage is loaded at the depot by the first free operator. A robot with nothing to serve waits
+# for the next order, or retires. Travel is in straight lines and a risk is recorded whenever a robot passes near a
+# crossing, so a run is fully determined by its scenario.
+class StandinEngine:
+
+    def __init__(self, scenario: Scenario, scheduler: Scheduler = None):
+        self.scenario = scenario
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.speed = scenario.robot_speed_kmph / 3600.0
+        start = scenario.service_start_time
+
+        def seconds(value: datetime.datetime) -> float:
+            return (value - start).total_seconds()
+
+        requests = scenario.requests
+        self.ids = np.array([r.customer_request_id for r in requests], dtype=np.int64)
+        self.order_time = np.array([seconds(r.order_time) for r in requests], dtype=float).reshape(-1)
+        self.pickup_start = np.array([seconds(r.pickup_desired_start_time) for r in requests]).reshape(-1)
+        self.pickup_end = np.array([seconds(r.pickup_desired_end_time) for r in requests]).reshape(-1)
+        self.delivery_start = np.array([seconds(r.delivery_desired_start_time) for r in requests]).reshape(-1)
+        self.delivery_end = np.array([seconds(r.delivery_desired_end_time) for r in requests]).reshape(-1)
+        self.quantity = np.array([r.baggage_quantity for r in requests], dtype=np.int64).reshape(-1)
+        self.pickup_xy = np.array([point(f"{scenario.area_name}:{r.pickup_target}") for r in requests]).reshape(-1, 2)
+        self.delivery_xy = np.array([point(f"{scenario.area_name}:{r.delivery_target}") for r in requests]) \
+            .reshape(-1, 2)
+        self.depot = np.array([AREA_SIZE_KM / 2, AREA_SIZE_KM / 2])
+        self.crossings = crossings(scenario.area_name)
+        # Legs that do not depend on the trip: depot to pickup, pickup to delivery and delivery to depot
+        self.depot_to_pickup = np.hypot(*(self.pickup_xy - self.depot).T)
+        self.pickup_to_delivery = np.hypot(*(self.delivery_xy - self.pickup_xy).T)
+        self.delivery_to_depot = np.hypot(*(self.depot - self.delivery_xy).T)
+
+        service_end = seconds(scenario.service_end_time)
+        self.shift_start = np.array([max(seconds(s), 0.0) for s, _ in scenario.windows])
+        self.shift_end = np.array([min(seconds(e), service_end) for _, e in scenario.windows])
+        self.working_seconds = np.maximum(self.shift_end - self.shift_start, 0.0)
+        self.state = self.initial_state()
+        # Set when a stop predicate ended the run before every robot was done
+        self.truncated = False
+        # One EpochTrace per epoch when not None
+        self.trace: Optional[List[EpochTrace]] = None
+        self._horizon = -np.inf
+
+    def initial_state(self) -> EngineState:
+        state = EngineState(self.scenario.num_robots, len(self.ids))
+        state.robots = [(self.shift_start[robot], robot) for robot in range(self.scenario.num_robots)
+                        if self.shift_start[robot] < self.shift_end[robot]]
+        heapq.heapify(state.robots)
+        state.operators = [0.0] * self.scenario.num_operators
+        return state
+
+    @property
+    def finished(self) -> bool:
+        return len(self.state.robots) == 0 or not self.state.pending.any()
+
+    def feasible_alone(self, now: float, robot: int) -> np.ndarray:
+        # Pending requests this robot could serve on a trip of its own leaving the depot after loading one piece
+        depart = now + LOAD_MINUTES * 60
+        pickup = np.maximum(depart + self.depot_to_pickup / self.speed, self.pickup_start)
+        delivery = np.maximum(pickup + STOP_MINUTES * 60 + self.pickup_to_delivery / self.speed, self.delivery_start)
+        back = delivery + STOP_MINUTES * 60 + self.delivery_to_depot / self.speed
+        reachable = self.state.pending & (self.order_time <= now) & (pickup <= self.pickup_end) & \
+            (delivery <= self.delivery_end)
+        if self.trace is not None and reachable.any():
+            self._horizon = max(self._horizon, float(back[reachable].max()))
+        return np.flatnonzero(reachable & (back <= self.shift_end[robot]))
+
+    def plan_trip(self, robot: int, ready: float, load_start: float, requests: np.ndarray) -> Optional[Trip]:
+        depart = load_start + LOAD_MINUTES * 60 * self.quantity[requests].sum()
+        stops = np.vstack([self.depot, self.pickup_xy[requests], self.delivery_xy[requests], self.depot])
+        legs = np.hypot(*np.diff(stops, axis=0).T)
+        opens = np.concatenate([self.pickup_start[requests], self.delivery_start[requests]])
+        closes = np.concatenate([self.pickup_end[requests], self.delivery_end[requests]])
+        times = []
+        now = depart
+        for leg, opening, closing in zip(legs, opens, closes):
+            now = max(now + leg / self.speed, opening)
+            if now > closing:
+                return None
+            times.append(now)
+            now += STOP_MINUTES * 60
+        back = now + legs[-1] / self.speed
+        if self.trace is not None:
+            self._horizon = max(self._horizon, back)
+        if back > self.shift_end[robot]:
+            return None
+        return Trip(robot, tuple(int(r) for r in requests), ready, load_start, depart,
+                    tuple(times[:len(requests)]), tuple(times[len(requests):]), back, float(legs.sum()))
+
+    def step(self) -> bool:
+        # Runs one epoch, returns False once no robot can serve anything any more
+        if self.finished:
+            return False
+        state = self.state
+        ready, robot = heapq.heappop(state.robots)
+        state.now = ready
+        state.epoch += 1
+        self._horizon = -np.inf
+        candidates = self.feasible_alone(ready, robot)
+        if len(candidates) == 0:
+            upcoming = self.order_time[state.pending & (self.order_time > ready)]
+            if len(upcoming) > 0 and upcoming.min() < self.shift_end[robot]:
+                heapq.heappush(state.robots, (float(upcoming.min()), robot))
+            if self.trace is not None:
+                next_order = float(upcoming.min()) if len(upcoming) > 0 else np.inf
+                self.trace.append(EpochTrace(ready, robot, True, next_order,
+                                             max(self._horizon, next_order if len(upcoming) > 0 else -np.inf)))
+            return True
+
+        ordered = self.scheduler.order(self, robot, ready, candidates)
+        ordered = ordered[np.cumsum(self.quantity[ordered]) <= self.scenario.robot_loading_capacity]
+        load_start = max(ready, state.operators[0])
+        trip = None
+        for length in range(len(ordered), 0, -1):
+            trip = self.plan_trip(robot, ready, load_start, ordered[:length])
+            if trip is not None:
+                break
+        if self.trace is not None:
+            self.trace.append(EpochTrace(ready, robot, False, np.inf, self._horizon))
+        if trip is None:
+            # Only the wait for an operator made it late, try again once the operator is free
+            if load_start > ready:
+                heapq.heappush(state.robots, (load_start, robot))
+            return True
+
+        heapq.heapreplace(state.operators, trip.depart)
+        requests = np.array(trip.requests)
+        state.pending[requests] = False
+        state.robot_by_request[requests] = robot
+        state.pickup_time[requests] = trip.pickups
+        state.delivery_time[requests] = trip.deliveries
+        state.tripmeter[robot] += trip.km
+        state.run_seconds[robot] += trip.back - trip.depart
+        state.load_seconds[robot] += trip.depart - trip.load_start
+        state.operator_shortage_seconds[robot] += trip.load_start - trip.ready
+        state.trips.append(trip)
+        self.record_risks(trip, requests)
+        heapq.heappush(state.robots, (trip.back, robot))
+        return True
+
+    def record_risks(self, trip: Trip, requests: np.ndarray):
+        stops = np.vstack([self.depot, self.pickup_xy[requests], self.delivery_xy[requests], self.depot])
+        # Times at which each leg starts and ends
+        arrivals = np.array(trip.pickups + trip.deliveries + (trip.back,))
+        starts = np.concatenate([[trip.depart], arrivals[:-1] + STOP_MINUTES * 60])
+        a, b = stops[:-1], stops[1:]
+        direction = b - a
+        length = np.maximum((direction ** 2).sum(axis=1), 1e-12)
+        # Closest point of every leg to every crossing
+        fraction = np.clip(((self.crossings[None, :, :] - a[:, None, :]) * direction[:, None, :]).sum(axis=2)
+                           / length[:, None], 0.0, 1.0)
+        closest = a[:, None, :] + fraction[:, :, None] * direction[:, None, :]
+        near = np.hypot(*(closest - self.crossings[None, :, :]).transpose(2, 0, 1)) <= CROSSING_RADIUS_KM
+        for leg, crossing in zip(*np.nonzero(near)):
+            when = starts[leg] + fraction[leg, crossing] * (arrivals[leg] - starts[leg])
+            self.state.risks.append((float(when), trip.robot, int(crossing),
+                                     float(closest[leg, crossing, 0]), float(closest[leg, crossing, 1])))
+
+    def run(self, stop: Callable[["StandinEngine"], bool] = None) -> "StandinEngine":
+        # stop is asked after every epoch whether the rest of the run can be skipped
+        while self.step():
+            if stop is not None and stop(self):
+                self.truncated = not self.finished
+                break
+        return self
+
+    @property
+    def delivered(self) -> int:
+        return self.state.delivered
+
+    @property
+    def delivered_quantity(self) -> int:
+        return int(self.quantity[self.state.robot_by_request >= 0].sum())
+
+    @property
+    def deliverable_quantity(self) -> int:
+        # Most baggage the run can end up delivering: every later delivery happens after the current epoch
+        if len(self.state.robots) == 0:
+            return self.delivered_quantity
+        return self.delivered_quantity + int(self.quantity[self.state.pending &
+                                                           (self.delivery_end >= self.state.now)].sum())
+
+    def write_results(self, result_dir: Path):
+        scenario = self.scenario
+        state = self.state
+        result_dir.mkdir(parents=True, exist_ok=True)
+        start = scenario.service_start_time
+        if self.truncated:
+            # The result files only cover the epochs run before the stop predicate held
+            result_dir.joinpath("truncated").write_text(f"{state.epoch}\n")
+
+        def timestamp(seconds: float) -> str:
+            return (start + datetime.timedelta(seconds=float(seconds))).isoformat()
+
+        requests = sorted(scenario.requests, key=lambda r: (r.order_time.replace(tzinfo=None), r.customer_request_id))
+        Request.write_test_to_csv(str(result_dir.joinpath("customer_request.csv")), requests)
+
+        with open(result_dir.joinpath("cost.csv"), "w") as cost_csv:
+            cost_csv.write("robot_id,tripmeter,total_run_h,total_load_h,total_rc_h,total_ems_h,total_op_shortage_h,"
+                           "utilization_rate\n")
+            for robot in range(scenario.num_robots):
+                busy = state.run_seconds[robot] + state.load_seconds[robot]
+                utilization_rate = busy / self.working_seconds[robot] if self.working_seconds[robot] > 0 else 0.0
+                cost_csv.write(f"{robot},{state.tripmeter[robot]},{state.run_seconds[robot] / 3600},"
+                               f"{state.load_seconds[robot] / 3600},0.0,0.0,"
+                               f"{state.operator_shortage_seconds[robot] / 3600},{utilization_rate}\n")
+
+        with open(result_dir.joinpath("risk.csv"), "w") as risk_csv:
+            risk_csv.write(",".join(RISK_COLUMNS) + "\n")
+            velocity = scenario.robot_speed_kmph
+            for risk_id, (when, robot, crossing, x, y) in enumerate(sorted(state.risks)):
+                lat = ORIGIN_LAT_LNG[0] + y / KM_PER_DEGREE
+                lng = ORIGIN_LAT_LNG[1] + x / KM_PER_DEGREE
+                risk_csv.write(f"{risk_id},{timestamp(when)},"
+                               f"{robot},robot,{velocity},{lat},{lng},{x},{y},0.0,0.0,"
+                               f"{crossing},pedestrian,4.0,{lat},{lng},{x},{y},0.0,0.0,"
+                               f"camera\n")
+
+        with open(result_dir.joinpath("value.csv"), "w") as value_csv:
+            value_csv.write("robot_id,num_pickedup,total_pickedup_quantity,num_delivered,total_delivered_quantity\n")
+            for robot in range(scenario.num_robots):
+                served = state.robot_by_request == robot
+                quantity = int(self.quantity[served].sum())
+                value_csv.write(f"{robot},{int(served.sum())},{quantity},{int(served.sum())},{quantity}\n")
+
+        with open(result_dir.joinpath("robot_requests_db.csv"), "w") as robot_requests_csv:
+            robot_requests_csv.write("robot_request_id,customer_request_id,order_time,request_type,target,latitude,"
+                                     "longitude,baggage_quantity,desired_start_time,desired_end_time,status\n")
+            index_by_id = {request_id: i for i, request_id in enumerate(self.ids)}
+            robot_request_id = 0
+            for request in requests:
+                i = index_by_id[request.customer_request_id]
+                status = "COMPLETED" if state.robot_by_request[i] >= 0 else "NEW"
+                for request_type, target, (x, y), window_start, window_end in [
+                        ("PICKUP", request.pickup_target, self.pickup_xy[i],
+                         request.pickup_desired_start_time, request.pickup_desired_end_time),
+                        ("DELIVERY", request.delivery_target, self.delivery_xy[i],
+                         request.delivery_desired_start_time, request.delivery_desired_end_time)]:
+                    robot_requests_csv.write(f"{robot_request_id},{request.customer_request_id},"
+                                             f"{request.order_time.isoformat()},{request_type},{target},"
+                                             f"{ORIGIN_LAT_LNG[0] + y / KM_PER_DEGREE},"
+                                             f"{ORIGIN_LAT_LNG[1] + x / KM_PER_DEGREE},"
+                                             f"{request.baggage_quantity},{window_start.isoformat()},"
+                                             f"{window_end.isoformat()},{status}\n")
+                    robot_request_id += 1
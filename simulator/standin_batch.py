@@ -0,0 +1,238 @@
+import heapq
+from typing import List, Optional, Callable
+
+import numpy as np
+
+from simulator.standin import Scenario, StandinEngine, Trip, CROSSING_RADIUS_KM, LOAD_MINUTES, STOP_MINUTES
+
+
+def _padded(engines: List[StandinEngine], attribute: str, length: int, fill) -> np.ndarray:
+    values = [getattr(engine, attribute) for engine in engines]
+    shape = (len(values), length) + values[0].shape[1:]
+    padded = np.full(shape, fill, dtype=np.result_type(values[0].dtype, np.asarray(fill).dtype))
+    for b, value in enumerate(values):
+        padded[b, :len(value)] = value
+    return padded
+
+
+# Runs the epochs of StandinEngine (with the default earliest deadline first Scheduler) for a batch of scenarios at
+# once. Requests, robots and operators of all the scenarios are padded into (scenario, ...) arrays, and each epoch
+# advances every scenario that is not finished yet by one robot decision, so the Python overhead is paid per epoch
+# rather than per scenario and epoch. Scenarios may differ in their requests, shifts, speed, capacity, number of
+# robots and number of operators. The results are the same as running each scenario on its own: results() returns
+# one StandinEngine per scenario with the final state, ready for write_results. stops has an optional predicate per
+# scenario on the fewest and the most baggage it can still end up delivering, a scenario stops once it holds.
+class BatchedStandinEngine:
+
+    def __init__(self, scenarios: List[Scenario], stops: List[Optional[Callable[[int, int], bool]]] = None):
+        self.engines = [StandinEngine(scenario) for scenario in scenarios]
+        engines = self.engines
+        batch = len(engines)
+        requests = max(max(len(engine.ids) for engine in engines), 1)
+        robots = max(scenario.num_robots for scenario in scenarios)
+        operators = max(scenario.num_operators for scenario in scenarios)
+
+        self.valid = _padded(engines, "quantity", requests, -1) >= 0
+        self.ids = _padded(engines, "ids", requests, 0)
+        self.order_time = _padded(engines, "order_time", requests, np.inf)
+        self.pickup_start = _padded(engines, "pickup_start", requests, np.inf)
+        self.pickup_end = _padded(engines, "pickup_end", requests, -np.inf)
+        self.delivery_start = _padded(engines, "delivery_start", requests, np.inf)
+        self.delivery_end = _padded(engines, "delivery_end", requests, -np.inf)
+        self.quantity = _padded(engines, "quantity", requests, 0)
+        self.pickup_xy = _padded(engines, "pickup_xy", requests, 0.0)
+        self.delivery_xy = _padded(engines, "delivery_xy", requests, 0.0)
+        self.depot_to_pickup = _padded(engines, "depot_to_pickup", requests, 0.0)
+        self.pickup_to_delivery = _padded(engines, "pickup_to_delivery", requests, 0.0)
+        self.delivery_to_depot = _padded(engines, "delivery_to_depot", requests, 0.0)
+        self.depot = np.array([engine.depot for engine in engines])
+        self.crossings = np.array([engine.crossings for engine in engines])
+        self.speed = np.array([engine.speed for engine in engines])
+        self.capacity = np.array([scenario.robot_loading_capacity for scenario in scenarios])
+        self.shift_start = _padded(engines, "shift_start", robots, 0.0)
+        self.shift_end = _padded(engines, "shift_end", robots, 0.0)
+
+        self.pending = self.valid.copy()
+        self.robot_by_request = np.full((batch, requests), -1)
+        self.pickup_time = np.full((batch, requests), np.nan)
+        self.delivery_time = np.full((batch, requests), np.nan)
+        self.free = self.shift_start.copy()
+        self.active = np.zeros((batch, robots), dtype=bool)
+        for b, scenario in enumerate(scenarios):
+            self.active[b, :scenario.num_robots] = self.shift_start[b, :scenario.num_robots] < \
+                self.shift_end[b, :scenario.num_robots]
+        # Missing operators are never free
+        self.operators = np.full((batch, operators), np.inf)
+        for b, scenario in enumerate(scenarios):
+            self.operators[b, :scenario.num_operators] = 0.0
+        self.tripmeter = np.zeros((batch, robots))
+        self.run_seconds = np.zeros((batch, robots))
+        self.load_seconds = np.zeros((batch, robots))
+        self.operator_shortage_seconds = np.zeros((batch, robots))
+        self.stops = stops if stops is not None else [None] * batch
+        self.stopped = np.zeros(batch, dtype=bool)
+        self.epoch = np.zeros(batch, dtype=int)
+        self.now = np.zeros(batch)
+
+    @property
+    def running(self) -> np.ndarray:
+        return self.active.any(axis=1) & self.pending.any(axis=1) & ~self.stopped
+
+    def step(self) -> bool:
+        running = np.flatnonzero(self.running)
+        if len(running) == 0:
+            return False
+        # The robot of each scenario that is free the earliest, lowest index first as in the heap of StandinEngine
+        free = np.where(self.active[running], self.free[running], np.inf)
+        robot = free.argmin(axis=1)
+        ready = free[np.arange(len(running)), robot]
+        shift_end = self.shift_end[running, robot]
+        self.epoch[running] += 1
+        self.now[running] = ready
+        speed = self.speed[running, None]
+
+        depart = ready[:, None] + LOAD_MINUTES * 60
+        pickup = np.maximum(depart + self.depot_to_pickup[running] / speed, self.pickup_start[running])
+        delivery = np.maximum(pickup + STOP_MINUTES * 60 + self.pickup_to_delivery[running] / speed,
+                              self.delivery_start[running])
+        back = delivery + STOP_MINUTES * 60 + self.delivery_to_depot[running] / speed
+        candidate = self.pending[running] & (self.order_time[running] <= ready[:, None]) & \
+            (pickup <= self.pickup_end[running]) & (delivery <= self.delivery_end[running]) & \
+            (back <= shift_end[:, None])
+        has_candidates = candidate.any(axis=1)
+
+        # Nothing to serve: wait for the next order during the shift, or retire
+        idle = ~has_candidates
+        upcoming = np.where(self.pending[running] & (self.order_time[running] > ready[:, None]),
+                            self.order_time[running], np.inf).min(axis=1)
+        waits = idle & (upcoming < shift_end)
+        self.free[running[waits], robot[waits]] = upcoming[waits]
+        retires = idle & ~waits
+        self.active[running[retires], robot[retires]] = False
+
+        # Earliest deadline first, then the longest prefix that fits in the robot
+        order = np.lexsort((self.ids[running], np.where(candidate, self.delivery_end[running], np.inf)), axis=-1)
+        ordered_candidate = np.take_along_axis(candidate, order, axis=1)
+        loaded = np.cumsum(np.where(ordered_candidate, np.take_along_axis(self.quantity[running], order, axis=1), 0),
+                           axis=1)
+        fits = (ordered_candidate & (loaded <= self.capacity[running, None])).sum(axis=1)
+        load_start = np.maximum(ready, self.operators[running].min(axis=1))
+
+        length = np.where(has_candidates, fits, 0)
+        planned = np.zeros(len(running), dtype=bool)
+        for k in range(int(length.max(initial=0)), 0, -1):
+            trying = np.flatnonzero(~planned & (length >= k))
+            if len(trying) == 0:
+                continue
+            feasible = self.plan_trips(running[trying], robot[trying], ready[trying], load_start[trying],
+                                       order[trying, :k])
+            planned[trying[feasible]] = True
+
+        # Only the wait for an operator made it late, try again once the operator is free
+        unplanned = has_candidates & ~planned
+        delayed = unplanned & (load_start > ready)
+        self.free[running[delayed], robot[delayed]] = load_start[delayed]
+        dropped = unplanned & ~delayed
+        self.active[running[dropped], robot[dropped]] = False
+
+        stopping = [b for b in running if self.stops[b] is not None]
+        if len(stopping) > 0:
+            delivered = np.where(self.robot_by_request[stopping] >= 0, self.quantity[stopping], 0).sum(axis=1)
+            deliverable = np.where(self.pending[stopping] & (self.delivery_end[stopping] >= self.now[stopping, None]),
+                                   self.quantity[stopping], 0).sum(axis=1)
+            deliverable = np.where(self.active[stopping].any(axis=1), delivered + deliverable, delivered)
+            for b, lo, hi in zip(stopping, delivered.tolist(), deliverable.tolist()):
+                self.stopped[b] = self.stops[b](lo, hi)
+        return True
+
+    def plan_trips(self, scenarios: np.ndarray, robots: np.ndarray, ready: np.ndarray, load_start: np.ndarray,
+                   requests: np.ndarray) -> np.ndarray:
+        # Same as StandinEngine.plan_trip for a trip of the k requests of each row, and the update of the state for the
+        # trips that are feasible. Returns which rows got a trip.
+        k = requests.shape[1]
+        rows = scenarios[:, None]
+        depart = load_start + LOAD_MINUTES * 60 * self.quantity[rows, requests].sum(axis=1)
+        depot = self.depot[scenarios][:, None, :]
+        stops = np.concatenate([depot, self.pickup_xy[rows, requests], self.delivery_xy[rows, requests], depot], axis=1)
+        legs = np.hypot(*np.diff(stops, axis=1).transpose(2, 0, 1))
+        opens = np.concatenate([self.pickup_start[rows, requests], self.delivery_start[rows, requests]], axis=1)
+        closes = np.concatenate([self.pickup_end[rows, requests], self.delivery_end[rows, requests]], axis=1)
+        speed = self.speed[scenarios]
+        times = np.empty((len(scenarios), 2 * k))
+        feasible = np.ones(len(scenarios), dtype=bool)
+        now = depart
+        for stop in range(2 * k):
+            now = np.maximum(now + legs[:, stop] / speed, opens[:, stop])
+            feasible &= now <= closes[:, stop]
+            times[:, stop] = now
+            now = now + STOP_MINUTES * 60
+        back = now + legs[:, -1] / speed
+        feasible &= back <= self.shift_end[scenarios, robots]
+
+        # A scenario plans at most one trip per epoch, so the rows index distinct scenarios
+        f = np.flatnonzero(feasible)
+        b, r, trip_requests, depart, back = scenarios[f], robots[f], requests[f], depart[f], back[f]
+        km = legs[f].sum(axis=1)
+        self.operators[b, self.operators[b].argmin(axis=1)] = depart
+        self.pending[b[:, None], trip_requests] = False
+        self.robot_by_request[b[:, None], trip_requests] = r[:, None]
+        self.pickup_time[b[:, None], trip_requests] = times[f, :k]
+        self.delivery_time[b[:, None], trip_requests] = times[f, k:]
+        self.tripmeter[b, r] += km
+        self.run_seconds[b, r] += back - depart
+        self.load_seconds[b, r] += depart - load_start[f]
+        self.operator_shortage_seconds[b, r] += load_start[f] - ready[f]
+        self.free[b, r] = back
+        for i in range(len(f)):
+            self.engines[b[i]].state.trips.append(
+                Trip(int(r[i]), tuple(trip_requests[i].tolist()), float(ready[f[i]]), float(load_start[f[i]]),
+                     float(depart[i]), tuple(times[f[i], :k].tolist()), tuple(times[f[i], k:].tolist()),
+                     float(back[i]), float(km[i])))
+        self.record_risks(b, r, stops[f], depart, times[f], back)
+        return feasible
+
+    def record_risks(self, scenarios: np.ndarray, robots: np.ndarray, stops: np.ndarray, depart: np.ndarray,
+                     times: np.ndarray, back: np.ndarray):
+        # Same as StandinEngine.record_risks for trips with the same number of stops
+        arrivals = np.concatenate([times, back[:, None]], axis=1)
+        starts = np.concatenate([depart[:, None], arrivals[:, :-1] + STOP_MINUTES * 60], axis=1)
+        crossings = self.crossings[scenarios][:, None, :, :]
+        a, b = stops[:, :-1], stops[:, 1:]
+        direction = b - a
+        length = np.maximum((direction ** 2).sum(axis=2), 1e-12)
+        fraction = np.clip(((crossings - a[:, :, None, :]) * direction[:, :, None, :]).sum(axis=3)
+                           / length[:, :, None], 0.0, 1.0)
+        closest = a[:, :, None, :] + fraction[:, :, :, None] * direction[:, :, None, :]
+        near = np.hypot(*(closest - crossings).transpose(3, 0, 1, 2)) <= CROSSING_RADIUS_KM
+        trip, leg, crossing = np.nonzero(near)
+        when = starts[trip, leg] + fraction[trip, leg, crossing] * (arrivals[trip, leg] - starts[trip, leg])
+        x, y = closest[trip, leg, crossing].T
+        for t, w, c, xc, yc in zip(trip.tolist(), when.tolist(), crossing.tolist(), x.tolist(), y.tolist()):
+            self.engines[scenarios[t]].state.risks.append((w, int(robots[t]), c, xc, yc))
+
+    def run(self) -> "BatchedStandinEngine":
+        while self.step():
+            pass
+        return self
+
+    def results(self) -> List[StandinEngine]:
+        # One engine per scenario holding the final state of its simulation
+        for b, engine in enumerate(self.engines):
+            state = engine.state
+            requests = len(engine.ids)
+            robots = engine.scenario.num_robots
+            state.pending = self.pending[b, :requests].copy()
+            state.robot_by_request = self.robot_by_request[b, :requests].copy()
+            state.pickup_time = self.pickup_time[b, :requests].copy()
+            state.delivery_time = self.delivery_time[b, :requests].copy()
+            state.tripmeter = self.tripmeter[b, :robots].copy()
+            state.run_seconds = self.run_seconds[b, :robots].copy()
+            state.load_seconds = self.load_seconds[b, :robots].copy()
+            state.operator_shortage_seconds = self.operator_shortage_seconds[b, :robots].copy()
+            state.robots = [(float(self.free[b, r]), r) for r in range(robots) if self.active[b, r]]
+            heapq.heapify(state.robots)
+            state.operators = sorted(float(t) for t in self.operators[b, :engine.scenario.num_operators])
+            state.epoch = int(self.epoch[b])
+            state.now = float(self.now[b])
+            engine.truncated = bool(self.stopped[b]) and not engine.finished
+        return self.engines
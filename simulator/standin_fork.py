@@ -0,0 +1,142 @@
+import heapq
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+from simulator.standin import Scenario, Scheduler, StandinEngine, EngineState
+
+# Fields of the scenario that are read at every epoch, a follow-up changing any of them shares nothing
+SHARED_FIELDS = ["service_start_time", "num_robots", "robot_speed_kmph", "robot_loading_capacity", "num_operators",
+                 "area_name"]
+REQUEST_FIELDS = ["order_time", "pickup_start", "pickup_end", "delivery_start", "delivery_end", "quantity"]
+
+
+# Maps the position of every original request to its position in the follow-up (-1 if removed), matching requests by
+# customer_request_id. Returns None when the ids do not identify the requests.
+def request_mapping(original: StandinEngine, followup: StandinEngine) -> Optional[np.ndarray]:
+    if len(np.unique(original.ids)) != len(original.ids) or len(np.unique(followup.ids)) != len(followup.ids):
+        return None
+    position = {request_id: i for i, request_id in enumerate(followup.ids.tolist())}
+    return np.array([position.get(request_id, -1) for request_id in original.ids.tolist()], dtype=np.int64)
+
+
+# Number of epochs of the traced original run that the follow-up is sure to share. An epoch may differ when:
+# - it reaches the order time of a request the follow-up adds, removes or changes, or a robot waiting for the next
+#   order may wait for it instead,
+# - it reaches the start of a robot whose shift starts at another time,
+# - the robot whose shift ends at another time compared a time at or after the earlier of both ends.
+def shared_epochs(original: StandinEngine, followup: StandinEngine, mapping: np.ndarray = None) -> int:
+    assert original.trace is not None, "The original run must be traced"
+    if type(original.scheduler) is not type(followup.scheduler) or \
+            any(getattr(original.scenario, field) != getattr(followup.scenario, field) for field in SHARED_FIELDS):
+        return 0
+    if mapping is None:
+        mapping = request_mapping(original, followup)
+    if mapping is None:
+        return 0
+
+    kept = mapping >= 0
+    changed = ~kept
+    changed[kept] = np.any([getattr(original, field)[kept] != getattr(followup, field)[mapping[kept]]
+                            for field in REQUEST_FIELDS], axis=0) | \
+        (original.pickup_xy[kept] != followup.pickup_xy[mapping[kept]]).any(axis=1) | \
+        (original.delivery_xy[kept] != followup.delivery_xy[mapping[kept]]).any(axis=1)
+    added = np.ones(len(followup.ids), dtype=bool)
+    added[mapping[kept]] = False
+    request_time = min(original.order_time[changed].min(initial=np.inf),
+                       followup.order_time[mapping[kept & changed]].min(initial=np.inf),
+                       followup.order_time[added].min(initial=np.inf))
+
+    start_time = np.inf
+    end_time: Dict[int, float] = {}
+    for robot in range(original.scenario.num_robots):
+        old = original.shift_start[robot], original.shift_end[robot]
+        new = followup.shift_start[robot], followup.shift_end[robot]
+        if old[0] != new[0] or (old[0] < old[1]) != (new[0] < new[1]):
+            start_time = min(start_time, old[0], new[0])
+        elif old[1] != new[1]:
+            end_time[robot] = min(old[1], new[1])
+
+    for epoch, trace in enumerate(original.trace):
+        if trace.now >= request_time or trace.now >= start_time or \
+                (trace.idle and trace.upcoming >= request_time) or \
+                (trace.robot in end_time and trace.horizon >= end_time[trace.robot]):
+            return epoch
+    return len(original.trace)
+
+
+# Runs a scenario with a trace, keeping a copy of the state whenever the simulated time passes a multiple of
+# checkpoint_seconds, so that follow-ups can be forked from the latest checkpoint before they first differ instead of
+# being simulated from the start of service.
+class CheckpointedRun:
+
+    def __init__(self, scenario: Scenario, scheduler: Scheduler = None, checkpoint_seconds: float = 900.0):
+        self.engine = StandinEngine(scenario, scheduler)
+        self.engine.trace = []
+        self.checkpoint_seconds = checkpoint_seconds
+        # (epochs run, state before the next epoch), by increasing number of epochs
+        self.checkpoints: List[Tuple[int, EngineState]] = [(0, self.engine.state.copy())]
+
+    def run(self) -> "CheckpointedRun":
+        engine = self.engine
+        next_checkpoint = self.checkpoint_seconds
+        while not engine.finished:
+            # Robots are taken by time, the earliest one is the time of the next epoch
+            if engine.state.robots[0][0] >= next_checkpoint:
+                self.checkpoints.append((engine.state.epoch, engine.state.copy()))
+                next_checkpoint = (engine.state.robots[0][0] // self.checkpoint_seconds + 1) * self.checkpoint_seconds
+            engine.step()
+        self.checkpoints.append((engine.state.epoch, engine.state.copy()))
+        return self
+
+    def fork(self, followup: StandinEngine) -> int:
+        # Moves a follow-up engine that has not run yet to the latest checkpoint it shares with this run, returns the
+        # number of epochs it skips
+        mapping = request_mapping(self.engine, followup)
+        shared = shared_epochs(self.engine, followup, mapping)
+        epochs, checkpoint = max((c for c in self.checkpoints if c[0] <= shared), key=lambda c: c[0])
+        if epochs > 0:
+            followup.state = self.translate(checkpoint, followup, mapping)
+        return epochs
+
+    def translate(self, checkpoint: EngineState, followup: StandinEngine, mapping: np.ndarray) -> EngineState:
+        # State of the follow-up at a checkpoint shared with the original, requests are moved to their follow-up
+        # position and robots whose shift starts later are put back to their start
+        state = followup.initial_state()
+        kept = mapping >= 0
+        for field in ["pending", "robot_by_request", "pickup_time", "delivery_time"]:
+            getattr(state, field)[mapping[kept]] = getattr(checkpoint, field)[kept]
+        for field in ["tripmeter", "run_seconds", "load_seconds", "operator_shortage_seconds"]:
+            setattr(state, field, getattr(checkpoint, field).copy())
+        original = self.engine
+        restarted = [robot for robot in range(followup.scenario.num_robots)
+                     if original.shift_start[robot] != followup.shift_start[robot] or
+                     (original.shift_start[robot] < original.shift_end[robot]) !=
+                     (followup.shift_start[robot] < followup.shift_end[robot])]
+        state.robots = [(time, robot) for time, robot in checkpoint.robots if robot not in restarted] + \
+                       [(followup.shift_start[robot], robot) for robot in restarted
+                        if followup.shift_start[robot] < followup.shift_end[robot]]
+        heapq.heapify(state.robots)
+        state.operators = list(checkpoint.operators)
+        state.trips = [trip._replace(requests=tuple(int(mapping[r]) for r in trip.requests))
+                       for trip in checkpoint.trips]
+        state.risks = list(checkpoint.risks)
+        state.epoch = checkpoint.epoch
+        state.now = checkpoint.now
+        return state
+
+
+def same_state(a: EngineState, b: EngineState) -> bool:
+    return all(np.array_equal(getattr(a, field), getattr(b, field), equal_nan=True)
+               for field in ["pickup_time", "delivery_time", "tripmeter", "run_seconds", "load_seconds",
+                             "operator_shortage_seconds"]) and \
+        np.array_equal(a.pending, b.pending) and np.array_equal(a.robot_by_request, b.robot_by_request) and \
+        a.trips == b.trips and sorted(a.risks) == sorted(b.risks) and sorted(a.robots) == sorted(b.robots) and \
+        sorted(a.operators) == sorted(b.operators) and a.epoch == b.epoch and a.now == b.now
+
+
+def fork_matches_full_run(run: CheckpointedRun, scenario: Scenario, scheduler: Scheduler = None) -> bool:
+    # Equivalence check: the forked follow-up ends in the same state as the follow-up simulated from the start
+    forked = StandinEngine(scenario, scheduler)
+    run.fork(forked)
+    return same_state(forked.run().state, StandinEngine(scenario, scheduler).run().state)
@@ -0,0 +1,142 @@
+import contextlib
+import io
+import subprocess
+import traceback
+from pathlib import Path
+from typing import List, Dict, Optional, Iterable, Callable
+
+from simulator import fake_simulator, standin
+from simulator.result_cache import binary_digest, simulation_key
+from simulator.simulator_v2 import SimulatorV2
+from simulator.standin import Scheduler, StandinEngine
+from simulator.standin_batch import BatchedStandinEngine
+from simulator.standin_fork import CheckpointedRun, shared_epochs
+from simulator.timing import span
+
+
+# SimulatorV2 that runs the open stand-in engine in-process instead of bin/run/run, writing the same result files
+# under simulator_dir/bin/result. Cached results are keyed by the source of the engine instead of the binary.
+# run_all advances all the simulations that are not cached in one BatchedStandinEngine.
+# With fork_followups, original runs keep checkpoints of their state and follow-up runs are forked from the latest
+# checkpoint of the kept original they share the most epochs with (see simulator/standin_fork.py).
+# run_simulation takes a stop predicate on the fewest and the most baggage the run can still end up delivering, a run
+# stopped by it writes a truncated marker with its result files.
+class StandinSimulatorV2(SimulatorV2):
+    supports_early_termination = True
+
+    def __init__(self, simulator_dir, scheduler: Scheduler = None, fork_followups: bool = False,
+                 checkpoint_seconds: float = 900.0, max_checkpointed_runs: int = 16, **kwargs):
+        super().__init__(simulator_dir, **kwargs)
+        self.scheduler = scheduler
+        self.fork_followups = fork_followups
+        self.checkpoint_seconds = checkpoint_seconds
+        self.max_checkpointed_runs = max_checkpointed_runs
+        self._checkpointed_runs: Dict[str, CheckpointedRun] = {}
+        self.skipped_epochs = 0
+        self.simulated_epochs = 0
+        self._stop: Optional[Callable[[int, int], bool]] = None
+        self.simulator_dir.joinpath("bin", "result").mkdir(parents=True, exist_ok=True)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_checkpointed_runs"] = {}
+        state["_stop"] = None
+        return state
+
+    def run_simulation(self, *args, stop: Callable[[int, int], bool] = None, **kwargs):
+        self._stop = stop
+        try:
+            return super().run_simulation(*args, **kwargs)
+        finally:
+            self._stop = None
+
+    def _engine_stop(self) -> Optional[Callable[[StandinEngine], bool]]:
+        if self._stop is None:
+            return None
+        stop = self._stop
+        return lambda engine: stop(engine.delivered_quantity, engine.deliverable_quantity)
+
+    def _execute(self, command: List[str]) -> subprocess.CompletedProcess:
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                if self.fork_followups:
+                    returncode = self._run_forked(command[1:])
+                else:
+                    returncode = fake_simulator.run(command[1:], self.simulator_dir.joinpath("bin", "result"),
+                                                    self.scheduler, self._engine_stop())
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+        return subprocess.CompletedProcess(command, returncode, stdout.getvalue().encode(),
+                                           stderr.getvalue().encode())
+
+    def _run_forked(self, argv: List[str]) -> int:
+        args = fake_simulator.parse_args(argv)
+        scenario = fake_simulator.scenario(args)
+        if args.sim_name == "original":
+            run = CheckpointedRun(scenario, self.scheduler, self.checkpoint_seconds).run()
+            self._checkpointed_runs.pop(args.sim_id, None)
+            self._checkpointed_runs[args.sim_id] = run
+            while len(self._checkpointed_runs) > self.max_checkpointed_runs:
+                self._checkpointed_runs.pop(next(iter(self._checkpointed_runs)))
+            engine, skipped = run.engine, 0
+        else:
+            engine = StandinEngine(scenario, self.scheduler)
+            shared = [(shared_epochs(run.engine, engine), run) for run in self._checkpointed_runs.values()]
+            skipped = 0
+            if len(shared) > 0 and max(epochs for epochs, _ in shared) > 0:
+                skipped = max(shared, key=lambda s: s[0])[1].fork(engine)
+            engine.run(self._engine_stop())
+        self.skipped_epochs += skipped
+        self.simulated_epochs += engine.state.epoch - skipped
+        engine.write_results(self.simulator_dir.joinpath("bin", "result", args.sim_name, args.sim_id))
+        return 0
+
+    def _cache_key(self, simulator_config: Dict, request_lines: Optional[Iterable[str]]) -> str:
+        return simulation_key(simulator_config, request_lines, binary_digest(Path(standin.__file__)))
+
+    def run_all(self, simulations: Iterable[Dict]) -> List[Optional[Dict]]:
+        # Runs every simulation (keyword arguments of run_simulation) and returns the results in the input order, with
+        # None for simulations that failed. Only the default scheduler is batched, other schedulers and forked
+        # follow-ups run one by one.
+        simulations = list(simulations)
+        if self.fork_followups or (self.scheduler is not None and type(self.scheduler) is not Scheduler):
+            return [self._run_or_none(simulation) for simulation in simulations]
+
+        results: List[Optional[Dict]] = [None] * len(simulations)
+        batch = []
+        for i, simulation in enumerate(simulations):
+            simulation = dict(simulation)
+            stop = simulation.pop("stop", None)
+            cache_key = None
+            if self.result_cache is not None:
+                cache_key = self._simulation_cache_key(**{k: v for k, v in simulation.items()
+                                                          if k not in ("sim_name", "sim_id")})
+                results[i] = self._restore_cached_result(cache_key, simulation["sim_name"], simulation["sim_id"])
+                if results[i] is not None:
+                    continue
+            try:
+                args = fake_simulator.parse_args(self._build_command(**simulation)[1:])
+                batch.append((i, args, fake_simulator.scenario(args), cache_key, stop))
+            except (SystemExit, Exception):
+                traceback.print_exc()
+
+        if len(batch) == 0:
+            return results
+        with span("simulate_batch"):
+            engines = BatchedStandinEngine([scenario for _, _, scenario, _, _ in batch],
+                                           [stop for _, _, _, _, stop in batch]).run().results()
+        for (i, args, _, cache_key, _), engine in zip(batch, engines):
+            with span("write_results"):
+                engine.write_results(self.simulator_dir.joinpath("bin", "result", args.sim_name, args.sim_id))
+            results[i] = self._collect_result(args.sim_name, args.sim_id, cache_key)
+        return results
+
+    def _run_or_none(self, simulation: Dict) -> Optional[Dict]:
+        try:
+            return self.run_simulation(**simulation)
+        except subprocess.CalledProcessError:
+            return None
@@ -0,0 +1,121 @@
+from typing import List, Tuple, Dict
+
+import numpy as np
+from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial import cKDTree
+
+from simulator.candidates import CandidateEncoding, NUM_ROBOTS
+from simulator.simulator import Simulator
+
+
+# RBF interpolation of Simulator.METRICS over the simulated candidates, used to screen candidates before they reach
+# the simulator. A candidate is simulated when it is uncertain (far from every simulated candidate) or promising (its
+# predicted objectives, improved by error_margin times the mean absolute error of past predictions, are not dominated
+# by the simulated front), the others get the predicted objectives. New results are added with update, the interpolator
+# and the front are computed again at the next screening.
+class SurrogateScreen:
+
+    def __init__(self, encoding: CandidateEncoding, min_samples: int = 20, uncertainty_radius: float = 0.1,
+                 error_margin: float = 1.0, min_simulated_fraction: float = 0.1, neighbors: int = 50,
+                 smoothing: float = 1e-3, seed: int = 0):
+        self.encoding = encoding
+        self.min_samples = min_samples
+        self.uncertainty_radius = uncertainty_radius
+        self.error_margin = error_margin
+        self.min_simulated_fraction = min_simulated_fraction
+        self.neighbors = neighbors
+        self.smoothing = smoothing
+        self.random = np.random.default_rng(seed)
+        self._features: Dict[str, np.ndarray] = {}
+        self._metrics: Dict[str, np.ndarray] = {}
+        self._objectives: Dict[str, np.ndarray] = {}
+        self._model = None
+        self._tree = None
+        self._front = None
+        self._absolute_errors = []
+        self.screened = 0
+
+    def features(self, candidate: Tuple) -> np.ndarray:
+        # Normalised to [0, 1]: number of robots, speed and, when the encoding has windows, total working hours and mean
+        # start hour. Without windows these would be a copy of the number of robots and a constant, which leave the
+        # polynomial term of the interpolator without full rank.
+        num_robots, robot_speed_kmh, utilization_time_period = candidate
+        low, high = self.encoding.speed_bounds
+        features = [num_robots / self.encoding.max_robots,
+                    (robot_speed_kmh - low) / (high - low) if high > low else 0.0]
+        if self.encoding.windows:
+            span = self.encoding.last_hour - self.encoding.first_hour
+            if utilization_time_period:
+                hours = sum(end - start for start, end in utilization_time_period)
+                start = np.mean([start for start, _ in utilization_time_period]) - self.encoding.first_hour
+            else:
+                hours, start = num_robots * span, 0.0
+            features += [hours / (self.encoding.max_robots * span), start / span]
+        return np.array(features)
+
+    def __len__(self):
+        return len(self._features)
+
+    @property
+    def trained(self) -> bool:
+        return len(self) >= self.min_samples
+
+    def update(self, candidates: List[Tuple], results: List):
+        if self.trained and len(candidates) > 0:
+            predictions, _ = self.predict(candidates)
+            self._absolute_errors.extend(np.abs([prediction[metric] - result[metric] for metric in Simulator.METRICS])
+                                         for prediction, result in zip(predictions, results))
+        for candidate, result in zip(candidates, results):
+            key = repr(candidate)
+            self._features[key] = self.features(candidate)
+            self._metrics[key] = np.array([result[metric] for metric in Simulator.METRICS], dtype=float)
+            self._objectives[key] = np.array(self.encoding.objective_values(candidate, result))
+        self._model = None
+        self._front = None
+
+    def _fit(self):
+        if self._model is None:
+            features = np.array(list(self._features.values()))
+            self._model = RBFInterpolator(features, np.array(list(self._metrics.values())),
+                                          neighbors=min(self.neighbors, len(features)),
+                                          smoothing=self.smoothing, kernel='thin_plate_spline')
+            self._tree = cKDTree(features)
+
+    def predict(self, candidates: List[Tuple]) -> Tuple[List[Dict[str, float]], np.ndarray]:
+        # Predicted metrics and distance to the closest simulated candidate
+        self._fit()
+        features = np.array([self.features(candidate) for candidate in candidates])
+        distances, _ = self._tree.query(features)
+        return [dict(zip(Simulator.METRICS, metrics)) for metrics in self._model(features)], distances
+
+    @property
+    def front(self) -> np.ndarray:
+        # Objectives of the non-dominated simulated candidates
+        if self._front is None:
+            simulated = np.array(list(self._objectives.values()))
+            self._front = simulated[NonDominatedSorting().do(simulated, only_non_dominated_front=True)]
+        return self._front
+
+    def mean_absolute_error(self, names) -> np.ndarray:
+        # Of the predictions made for candidates that were simulated afterwards, the number of robots is exact
+        errors = np.mean(self._absolute_errors, axis=0) if self._absolute_errors else np.zeros(len(Simulator.METRICS))
+        return np.array([0.0 if name == NUM_ROBOTS else errors[Simulator.METRICS.index(name)] for name in names])
+
+    def select(self, candidates: List[Tuple]) -> Tuple[np.ndarray, List[Dict[str, float]]]:
+        # Mask of the candidates to simulate, and the predicted metrics of all of them
+        if not self.trained:
+            return np.ones(len(candidates), dtype=bool), [None] * len(candidates)
+        predictions, distances = self.predict(candidates)
+        predicted = np.array([self.encoding.objective_values(candidate, prediction)
+                              for candidate, prediction in zip(candidates, predictions)])
+        improved = (predicted - self.error_margin * self.mean_absolute_error(self.encoding.objectives))[:, None, :]
+        # A candidate is dominated by a front member that is no worse in every objective and better in one
+        dominated = np.any(np.all(self.front <= improved, axis=2) & np.any(self.front < improved, axis=2), axis=1)
+        promising = ~dominated
+        mask = promising | (distances > self.uncertainty_radius)
+        minimum = int(np.ceil(self.min_simulated_fraction * len(candidates)))
+        if mask.sum() < minimum:
+            mask[self.random.choice(np.flatnonzero(~mask), minimum - mask.sum(), replace=False)] = True
+        self.screened += int((~mask).sum())
+        return mask, predictions
@@ -0,0 +1,190 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import math
+import os
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+# Spans are only recorded when this variable names a directory, every process then writes its histograms there. It is
+# read once per process, joblib workers inherit it from the campaign.
+TIMING_DIR_ENV = "METAMORPHIC_TIMING_DIR"
+MERGED_FILE = "merged.json"
+
+_timing_dir = os.environ.get(TIMING_DIR_ENV)
+# Labels of the enclosing spans (rule, follow-up, ...), inherited by the spans nested in them
+_labels: contextvars.ContextVar = contextvars.ContextVar("timing_labels", default=())
+_lock = threading.Lock()
+_no_span = contextlib.nullcontext()
+
+
+# Wall and CPU time of the spans of one stage with the same labels. Durations are counted in buckets of powers of two
+# microseconds: bucket b holds the durations in [2^(b-1), 2^b) microseconds.
+class Histogram:
+
+    def __init__(self):
+        self.count = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.max_wall_seconds = 0.0
+        self.wall_buckets: Dict[int, int] = {}
+        self.cpu_buckets: Dict[int, int] = {}
+
+    @staticmethod
+    def bucket(seconds: float) -> int:
+        return max(0, math.frexp(seconds * 1e6)[1])
+
+    def add(self, wall_seconds: float, cpu_seconds: float):
+        self.count += 1
+        self.wall_seconds += wall_seconds
+        self.cpu_seconds += cpu_seconds
+        self.max_wall_seconds = max(self.max_wall_seconds, wall_seconds)
+        wall_bucket = self.bucket(wall_seconds)
+        self.wall_buckets[wall_bucket] = self.wall_buckets.get(wall_bucket, 0) + 1
+        cpu_bucket = self.bucket(cpu_seconds)
+        self.cpu_buckets[cpu_bucket] = self.cpu_buckets.get(cpu_bucket, 0) + 1
+
+    def merge(self, other: "Histogram"):
+        self.count += other.count
+        self.wall_seconds += other.wall_seconds
+        self.cpu_seconds += other.cpu_seconds
+        self.max_wall_seconds = max(self.max_wall_seconds, other.max_wall_seconds)
+        for buckets, other_buckets in [(self.wall_buckets, other.wall_buckets), (self.cpu_buckets, other.cpu_buckets)]:
+            for bucket, count in other_buckets.items():
+                buckets[bucket] = buckets.get(bucket, 0) + count
+
+    def wall_quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the quantile, in seconds
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.wall_buckets):
+            seen += self.wall_buckets[bucket]
+            if seen >= rank:
+                return 2 ** bucket / 1e6
+        return self.max_wall_seconds
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "wall_seconds": self.wall_seconds, "cpu_seconds": self.cpu_seconds,
+                "max_wall_seconds": self.max_wall_seconds,
+                "wall_buckets": {str(b): c for b, c in self.wall_buckets.items()},
+                "cpu_buckets": {str(b): c for b, c in self.cpu_buckets.items()}}
+
+    @staticmethod
+    def from_dict(histogram_dict: Dict) -> "Histogram":
+        histogram = Histogram()
+        histogram.count = histogram_dict["count"]
+        histogram.wall_seconds = histogram_dict["wall_seconds"]
+        histogram.cpu_seconds = histogram_dict["cpu_seconds"]
+        histogram.max_wall_seconds = histogram_dict["max_wall_seconds"]
+        histogram.wall_buckets = {int(b): c for b, c in histogram_dict["wall_buckets"].items()}
+        histogram.cpu_buckets = {int(b): c for b, c in histogram_dict["cpu_buckets"].items()}
+        return histogram
+
+
+# Histograms of this process, by stage and labels
+_histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+
+
+class _Span:
+
+    def __init__(self, stage: str, labels: Dict):
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        labels = dict(_labels.get())
+        labels.update((k, str(v)) for k, v in self.labels.items())
+        self.token = _labels.set(tuple(labels.items()))
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_seconds = time.perf_counter() - self.wall_start
+        cpu_seconds = time.thread_time() - self.cpu_start
+        key = (self.stage, _labels.get())
+        _labels.reset(self.token)
+        with _lock:
+            if key not in _histograms:
+                _histograms[key] = Histogram()
+            _histograms[key].add(wall_seconds, cpu_seconds)
+        return False
+
+
+def enabled() -> bool:
+    return _timing_dir is not None
+
+
+def timing_dir() -> Optional[str]:
+    return _timing_dir
+
+
+def enable(timing_dir: str):
+    # Records the spans of this process and of the processes it starts from now on
+    global _timing_dir
+    _timing_dir = str(Path(timing_dir).absolute())
+    Path(_timing_dir).mkdir(parents=True, exist_ok=True)
+    os.environ[TIMING_DIR_ENV] = _timing_dir
+
+
+def span(stage: str, **labels):
+    # Context manager recording the wall and CPU time of a stage, under the labels of the enclosing spans and its own.
+    # Does nothing unless timing is enabled.
+    if _timing_dir is None:
+        return _no_span
+    return _Span(stage, labels)
+
+
+def flush():
+    # Writes the histograms of this process to its file in the timing directory. Each process has its own file, which
+    # is replaced as a whole, so that a worker killed halfway never leaves a partial file.
+    if _timing_dir is None:
+        return
+    with _lock:
+        histograms = [{"stage": stage, "labels": dict(labels), "histogram": histogram.to_dict()}
+                      for (stage, labels), histogram in _histograms.items()]
+    Path(_timing_dir).mkdir(parents=True, exist_ok=True)
+    worker_path = Path(_timing_dir, f"worker_{socket.gethostname()}_{os.getpid()}.json")
+    temporary_path = worker_path.with_suffix(".tmp")
+    temporary_path.write_text(json.dumps(histograms))
+    os.replace(temporary_path, worker_path)
+
+
+atexit.register(flush)
+
+
+def merge(timing_dir: str) -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram]:
+    # Histograms of every worker of a campaign, added up by stage and labels, and written to MERGED_FILE
+    merged: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+    for worker_path in sorted(Path(timing_dir).glob("worker_*.json")):
+        for entry in json.loads(worker_path.read_text()):
+            key = (entry["stage"], tuple(entry["labels"].items()))
+            if key not in merged:
+                merged[key] = Histogram()
+            merged[key].merge(Histogram.from_dict(entry["histogram"]))
+    Path(timing_dir, MERGED_FILE).write_text(json.dumps(
+        [{"stage": stage, "labels": dict(labels), "histogram": histogram.to_dict()}
+         for (stage, labels), histogram in merged.items()]))
+    return merged
+
+
+def print_summary(histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram], file=sys.stdout):
+    print("stage,labels,count,wall_seconds,cpu_seconds,mean_wall_seconds,p50_wall_seconds,p90_wall_seconds,"
+          "max_wall_seconds", file=file)
+    for (stage, labels), histogram in sorted(histograms.items(), key=lambda item: -item[1].wall_seconds):
+        print(f"{stage},{' '.join(k + '=' + v for k, v in labels)},{histogram.count},"
+              f"{histogram.wall_seconds:.6f},{histogram.cpu_seconds:.6f},"
+              f"{histogram.wall_seconds / histogram.count:.6f},{histogram.wall_quantile(0.5):.6f},"
+              f"{histogram.wall_quantile(0.9):.6f},{histogram.max_wall_seconds:.6f}", file=file)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Need to provide the timing directory of a campaign")
+        exit(1)
+    print_summary(merge(sys.argv[1]))
@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import queue
+import selectors
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+
+# Environment variable giving a serving simulator the file descriptor it answers on
+SERVE_FD_ENV = "SIMULATOR_SERVE_FD"
+
+
+class WorkerCrashedError(RuntimeError):
+    pass
+
+
+# A long-lived simulator process started with --serve. It reads one {"args": [...]} line per run on stdin. It answers
+# on the file descriptor named by SIMULATOR_SERVE_FD, never on stdout, so the log output of the simulator cannot break
+# the protocol: first {"ready": true} once loaded, then {"returncode": ..., "stdout": ..., "stderr": ...} per run. A
+# worker that does not answer within startup_timeout (run_timeout for a run) is killed.
+class SimulatorWorker:
+
+    def __init__(self,
+                 command: List[str],
+                 cwd: Path,
+                 serve_flag: str = "--serve",
+                 startup_timeout: float = 30.0,
+                 run_timeout: Optional[float] = 3600.0):
+        self.runs = 0
+        self.run_timeout = run_timeout
+        self._buffer = b""
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(command + [serve_flag],
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL,
+                                            cwd=cwd,
+                                            env=dict(os.environ, **{SERVE_FD_ENV: str(write_fd)}),
+                                            pass_fds=(write_fd,),
+                                            text=True,
+                                            bufsize=1)
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        self._response_fd = read_fd
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(read_fd, selectors.EVENT_READ)
+        handshake = self._read_message(startup_timeout)
+        if handshake is None or not handshake.get("ready", False):
+            self.close(timeout=0)
+            raise WorkerCrashedError("Simulator worker did not start in serve mode")
+
+    def _read_message(self, timeout: Optional[float]) -> Optional[dict]:
+        # The next line written on the response descriptor, None if the worker exits, answers something else or does
+        # not answer in time, in which case it is killed
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while b"\n" not in self._buffer:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None and remaining <= 0) or not self._selector.select(remaining):
+                self.process.kill()
+                return None
+            chunk = os.read(self._response_fd, 65536)
+            if not chunk:
+                return None
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+    def submit(self, args: List[str]) -> subprocess.CompletedProcess:
+        try:
+            self.process.stdin.write(json.dumps({"args": args}) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerCrashedError("Simulator worker exited before accepting a run") from e
+        response = self._read_message(self.run_timeout)
+        if response is None or "returncode" not in response:
+            raise WorkerCrashedError("Simulator worker exited, hung or answered garbage during a run")
+        self.runs += 1
+        return subprocess.CompletedProcess(args,
+                                           response["returncode"],
+                                           response.get("stdout", "").encode(),
+                                           response.get("stderr", "").encode())
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self, timeout: float = 5.0):
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        if self._response_fd is not None:
+            self._selector.close()
+            os.close(self._response_fd)
+            self._response_fd = None
+
+
+# Keeps up to num_workers warm simulator processes. A worker is recycled after max_runs_per_worker runs or when it
+# crashes. Runs whose worker crashed, and all runs if the binary has no serve mode, fall back to one-shot subprocesses.
+class SimulatorWorkerPool:
+
+    def __init__(self,
+                 executable: str,
+                 cwd: Path,
+                 num_workers: int,
+                 max_runs_per_worker: int = 100,
+                 serve_flag: str = "--serve",
+                 startup_timeout: float = 30.0,
+                 run_timeout: Optional[float] = 3600.0):
+        assert num_workers > 0, "The pool needs at least one worker."
+        assert max_runs_per_worker > 0, "Workers must be allowed at least one run."
+        self.executable = executable
+        self.cwd = Path(cwd)
+        self.num_workers = num_workers
+        self.max_runs_per_worker = max_runs_per_worker
+        self.serve_flag = serve_flag
+        self.startup_timeout = startup_timeout
+        self.run_timeout = run_timeout
+        self.serve_supported = True
+        self.started_workers = 0
+        self.recycled_workers = 0
+        self.crashed_workers = 0
+        self.fallback_runs = 0
+        self._slots = threading.BoundedSemaphore(num_workers)
+        self._idle_workers = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._closed = False
+        atexit.register(self.close)
+
+    def run(self, command: List[str]) -> subprocess.CompletedProcess:
+        with self._slots:
+            worker = self._acquire_worker()
+            if worker is None:
+                return self._run_once(command)
+            try:
+                completed_process = worker.submit(command[1:])
+            except WorkerCrashedError:
+                with self._lock:
+                    self.crashed_workers += 1
+                worker.close()
+                return self._run_once(command)
+            if worker.runs >= self.max_runs_per_worker or not worker.is_alive():
+                with self._lock:
+                    self.recycled_workers += 1
+                worker.close()
+            else:
+                self._idle_workers.put(worker)
+            completed_process.args = command
+            return completed_process
+
+    def _acquire_worker(self) -> Optional[SimulatorWorker]:
+        while True:
+            try:
+                worker = self._idle_workers.get_nowait()
+            except queue.Empty:
+                break
+            if worker.is_alive():
+                return worker
+            worker.close()
+        if not self.serve_supported or self._closed:
+            return None
+        try:
+            worker = SimulatorWorker([self.executable], self.cwd, self.serve_flag, self.startup_timeout,
+                                     self.run_timeout)
+        except (WorkerCrashedError, OSError):
+            # The binary cannot run as a worker, every following run goes through one-shot subprocesses
+            self.serve_supported = False
+            return None
+        with self._lock:
+            self.started_workers += 1
+        return worker
+
+    def _run_once(self, command: List[str]) -> subprocess.CompletedProcess:
+        with self._lock:
+            self.fallback_runs += 1
+        return subprocess.run(command, capture_output=True, cwd=self.cwd)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                worker = self._idle_workers.get_nowait()
+            except queue.Empty:
+                break
+            worker.close()
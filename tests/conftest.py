@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The rules import Request from the metamorphic directory, as when experiments.py is run from there
+repository_dir = Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(repository_dir), str(repository_dir.joinpath("metamorphic"))]
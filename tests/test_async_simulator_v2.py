@@ -0,0 +1,35 @@
+import asyncio
+from datetime import datetime
+
+from simulator import Simulator, fake_simulator
+from simulator.async_simulator_v2 import AsyncSimulatorV2
+from simulator.result_cache import ResultCache
+
+CONFIG = {"service_start_time": datetime.fromisoformat("2021-01-01T09:00:00"),
+          "service_end_time": datetime.fromisoformat("2021-01-01T12:00:00"),
+          "num_customer_requests": 20,
+          "num_robots": 2,
+          "robot_speed_kmph": 5,
+          "robot_loading_capacity": 5,
+          "num_operators": 1,
+          "seed": 1}
+
+
+def test_run_simulation_stays_synchronous(tmp_path):
+    fake_simulator.install(str(tmp_path))
+    simulator = AsyncSimulatorV2(tmp_path, 1)
+    assert simulator.run_simulation("original", "20_2_1_1", **CONFIG)[Simulator.NUM_DELIVERED] is not None
+
+
+def test_cached_result_is_not_simulated_again(tmp_path, monkeypatch):
+    fake_simulator.install(str(tmp_path / "simulator"))
+    simulator = AsyncSimulatorV2(tmp_path / "simulator", 1, result_cache=ResultCache(tmp_path / "cache"))
+    result = asyncio.run(simulator.run_simulation_async("original", "20_2_1_1", **CONFIG))
+
+    async def no_subprocess(*args, **kwargs):
+        raise AssertionError("the simulator was started for a cached input")
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", no_subprocess)
+    cached_result = asyncio.run(simulator.run_simulation_async("original", "20_2_1_2", **CONFIG))
+    assert cached_result[Simulator.NUM_DELIVERED] == result[Simulator.NUM_DELIVERED]
+    assert tmp_path.joinpath("simulator", "bin", "result", "original_20_2_1_2.zip").is_file()
@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from metamorphic.AddRequestRule import AddRequestRule
+from metamorphic.RemoveRequestRule import RemoveRequestRule
+from metamorphic.experiments_zip_to_csv import followup_to_dict
+from simulator.standin_simulator_v2 import StandinSimulatorV2
+
+CONFIG = {"service_start_time": datetime.fromisoformat("2021-01-01T09:00:00"),
+          "service_end_time": datetime.fromisoformat("2021-01-01T12:00:00"),
+          "num_customer_requests": 30,
+          "num_robots": 2,
+          "robot_speed_kmph": 5,
+          "robot_loading_capacity": 5,
+          "num_operators": 1}
+
+
+def verdicts(simulator, seed):
+    # Verdict and truncated flag of every follow-up of two rules
+    config = dict(CONFIG, seed=seed)
+    original_result = simulator.run_simulation("original", f"30_2_1_{seed}", **config)
+    results = []
+    for rule in [RemoveRequestRule(simulator, 5),
+                 AddRequestRule(simulator, CONFIG["service_start_time"], CONFIG["service_end_time"], 5)]:
+        rule.is_followed(config, original_result["customer_requests"], original_result,
+                         on_result=lambda rule, followup_idx, result, followed:
+                         results.append((rule.name, followup_idx, followed, result["truncated"])))
+    return results
+
+
+def test_stopped_runs_give_the_verdicts_of_full_runs(tmp_path):
+    stopped = StandinSimulatorV2(tmp_path / "stopped")
+    full = StandinSimulatorV2(tmp_path / "full")
+    full.supports_early_termination = False
+    truncated = 0
+    for seed in range(1, 4):
+        stopped_verdicts, full_verdicts = verdicts(stopped, seed), verdicts(full, seed)
+        assert [verdict[:3] for verdict in stopped_verdicts] == [verdict[:3] for verdict in full_verdicts]
+        assert not any(verdict[3] for verdict in full_verdicts)
+        truncated += sum(verdict[3] for verdict in stopped_verdicts)
+    assert truncated > 0
+
+
+def test_truncated_followups_are_flagged_in_the_csv(tmp_path):
+    simulator = StandinSimulatorV2(tmp_path)
+    verdicts(simulator, 1)
+    rows = [followup_to_dict(path) for path in tmp_path.joinpath("bin", "result").glob("followup_*.zip")]
+    assert len(rows) == 10
+    assert any(row["truncated"] for row in rows) and not all(row["truncated"] for row in rows)
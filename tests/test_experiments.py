@@ -0,0 +1,152 @@
+import time
+from datetime import datetime
+from subprocess import CalledProcessError
+
+import pandas
+
+from metamorphic.CampaignManifest import CRASHED, DONE, CampaignManifest
+from metamorphic.RemoveRequestRule import RemoveRequestRule
+from metamorphic.ResultSink import ResultSink
+from metamorphic.experiments import run_seed
+from simulator import fake_simulator, timing
+from simulator.simulator_v2 import SimulatorV2
+
+CONFIG = {"service_start_time": datetime.fromisoformat("2021-01-01T09:00:00"),
+          "service_end_time": datetime.fromisoformat("2021-01-01T12:00:00"),
+          "num_customer_requests": 20,
+          "num_robots": 2,
+          "robot_speed_kmph": 5,
+          "robot_loading_capacity": 5,
+          "num_operators": 1}
+
+
+def test_zips_exist_when_run_seed_returns_with_background_archiving(tmp_path, monkeypatch):
+    fake_simulator.install(str(tmp_path))
+    archive = SimulatorV2._archive
+
+    def slow_archive(self, *args):
+        time.sleep(0.5)
+        archive(self, *args)
+
+    monkeypatch.setattr(SimulatorV2, "_archive", slow_archive)
+    simulator = SimulatorV2(tmp_path, archive_mode="background")
+    run_seed(simulator, CONFIG, 1, [RemoveRequestRule(simulator, 3)])
+    result_dir = tmp_path.joinpath("bin", "result")
+    assert result_dir.joinpath("original_20_2_1_1.zip").is_file()
+    for followup_idx in range(3):
+        assert result_dir.joinpath(f"followup_RemoveRandomRequest_20_2_1_1_{followup_idx}.zip").is_file()
+    # No result directory is left to archive
+    assert not any(result_dir.joinpath("original").iterdir()) and not any(result_dir.joinpath("followup").iterdir())
+
+
+class UnchangedRequestsRule(RemoveRequestRule):
+    # A rule whose follow-ups have the same content as the original run
+    def __init__(self, simulator, number_followups):
+        super().__init__(simulator, number_followups)
+        self.name = "UnchangedRequests"
+
+    def _generate_followup_inputs(self, original_input, original_result, simulator_configuration):
+        return [(None, list(original_input)) for _ in range(self.number_followups)]
+
+
+def test_followups_identical_to_the_original_get_its_zip(tmp_path):
+    fake_simulator.install(str(tmp_path))
+    simulator = SimulatorV2(tmp_path)
+    manifest = CampaignManifest(str(tmp_path.joinpath("manifest.sqlite")))
+    run_seed(simulator, CONFIG, 1, [UnchangedRequestsRule(simulator, 2)], deduplicate_followups=True, manifest=manifest)
+    result_dir = tmp_path.joinpath("bin", "result")
+    for followup_idx in range(2):
+        followup_zip_name = f"followup_UnchangedRequests_20_2_1_1_{followup_idx}.zip"
+        assert result_dir.joinpath(followup_zip_name).read_bytes() == \
+            result_dir.joinpath("original_20_2_1_1.zip").read_bytes()
+        assert manifest.has_zip(followup_zip_name)
+
+
+def test_background_archives_are_timed_under_the_labels_of_their_run(tmp_path, monkeypatch):
+    fake_simulator.install(str(tmp_path))
+    monkeypatch.setattr(timing, "_histograms", {})
+    monkeypatch.setattr(timing, "_timing_dir", str(tmp_path.joinpath("timing")))
+    simulator = SimulatorV2(tmp_path, archive_mode="background")
+    run_seed(simulator, CONFIG, 1, [RemoveRequestRule(simulator, 2)])
+    archive_labels = [dict(labels) for stage, labels in timing._histograms if stage == "archive"]
+    assert {"rule": "RemoveRandomRequest", "followup": "1"} in archive_labels
+
+
+def test_rows_of_a_seed_are_written_when_run_seed_returns(tmp_path):
+    fake_simulator.install(str(tmp_path))
+    simulator = SimulatorV2(tmp_path)
+    result_sink = ResultSink(str(tmp_path.joinpath("results")))
+    run_seed(simulator, CONFIG, 1, [RemoveRequestRule(simulator, 3)], result_sink=result_sink)
+    ResultSink.collect(result_sink.sink_dir, result_sink.sink_dir)
+    assert len(pandas.read_csv(tmp_path.joinpath("results", "original_results.csv"))) == 1
+    assert len(pandas.read_csv(tmp_path.joinpath("results", "followup_results.csv"))) == 3
+
+
+def test_seed_is_complete_in_the_manifest_only_once_its_rows_are_written(tmp_path, monkeypatch):
+    fake_simulator.install(str(tmp_path))
+    simulator = SimulatorV2(tmp_path)
+    result_sink = ResultSink(str(tmp_path.joinpath("results")))
+    manifest = CampaignManifest(str(tmp_path.joinpath("manifest.sqlite")))
+    outstanding_at_flush = []
+    flush = ResultSink.flush
+
+    def recording_flush(self):
+        outstanding_at_flush.append(manifest.outstanding())
+        flush(self)
+
+    monkeypatch.setattr(ResultSink, "flush", recording_flush)
+    run_seed(simulator, CONFIG, 1, [RemoveRequestRule(simulator, 3)], result_sink=result_sink, manifest=manifest)
+    assert outstanding_at_flush == [[("1", CampaignManifest.config_key(CONFIG))]]
+    assert manifest.outstanding() == []
+    assert len(list(tmp_path.joinpath("results").glob("followup_segment_*.csv"))) == 1
+
+
+def test_resumed_campaign_gives_up_on_runs_that_keep_crashing(tmp_path, monkeypatch):
+    fake_simulator.install(str(tmp_path))
+    run_simulation = SimulatorV2.run_simulation
+    simulated = []
+
+    def crashing_run_simulation(self, sim_name, sim_id, **kwargs):
+        # The original run of seed 2 and the second follow-up of seed 1 crash every time
+        simulated.append(sim_id)
+        if sim_id in ["20_2_1_2", "RemoveRandomRequest_20_2_1_1_1"]:
+            raise CalledProcessError(1, sim_id)
+        return run_simulation(self, sim_name, sim_id, **kwargs)
+
+    monkeypatch.setattr(SimulatorV2, "run_simulation", crashing_run_simulation)
+    simulator = SimulatorV2(tmp_path)
+    manifest = CampaignManifest(str(tmp_path.joinpath("manifest.sqlite")), max_attempts=3)
+    rule = RemoveRequestRule(simulator, 2)
+    rule.manifest = manifest
+    config = CampaignManifest.config_key(CONFIG)
+    for _ in range(5):
+        # Every resume plans the campaign again and runs the outstanding seeds
+        manifest.plan([("1", config), ("2", config), ("3", config)])
+        for seed, _config in manifest.outstanding():
+            run_seed(simulator, CONFIG, int(seed), [rule], manifest=manifest)
+    assert manifest.outstanding() == []
+    assert manifest.given_up() == [("1", config), ("2", config)]
+    assert simulated.count("20_2_1_2") == 3 and simulated.count("RemoveRandomRequest_20_2_1_1_1") == 3
+    # Done runs are not simulated again on a resume
+    assert simulated.count("20_2_1_1") == 1 and simulated.count("RemoveRandomRequest_20_2_1_1_0") == 1
+    assert simulated.count("20_2_1_3") == 1
+    assert manifest.counts() == {DONE: 5, CRASHED: 2}
+
+
+def test_followups_are_only_deduplicated_when_asked(tmp_path, monkeypatch):
+    fake_simulator.install(str(tmp_path))
+    run_simulation = SimulatorV2.run_simulation
+    simulated = []
+
+    def counting_run_simulation(self, sim_name, sim_id, **kwargs):
+        simulated.append(sim_name + "_" + sim_id)
+        return run_simulation(self, sim_name, sim_id, **kwargs)
+
+    monkeypatch.setattr(SimulatorV2, "run_simulation", counting_run_simulation)
+    simulator = SimulatorV2(tmp_path)
+    run_seed(simulator, CONFIG, 1, [UnchangedRequestsRule(simulator, 2)])
+    assert simulated == ["original_20_2_1_1", "followup_UnchangedRequests_20_2_1_1_0",
+                         "followup_UnchangedRequests_20_2_1_1_1"]
+    simulated.clear()
+    run_seed(simulator, CONFIG, 2, [UnchangedRequestsRule(simulator, 2)], deduplicate_followups=True)
+    assert simulated == ["original_20_2_1_2"]
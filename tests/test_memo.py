@@ -0,0 +1,26 @@
+import time
+
+from simulator.memo import PersistentMemo
+
+
+def test_evict_only_drops_evicted_results_from_memory(tmp_path):
+    memo = PersistentMemo(str(tmp_path.joinpath("memo.sqlite")), max_entries=2, eviction_interval=3)
+    for i in range(3):
+        memo[("s", float(i))] = {"value": i}
+    kept_keys = {key for key, in memo._execute("SELECT key FROM memo").fetchall()}
+    assert len(kept_keys) == 2
+    # The kept results are still served from memory, the evicted one is not served at all
+    assert set(memo._cache) == kept_keys
+    memo._execute("DELETE FROM memo")
+    assert sum(memo.get(("s", float(i))) is not None for i in range(3)) == 2
+
+
+def test_results_served_from_memory_expire_after_max_age(tmp_path):
+    memo = PersistentMemo(str(tmp_path.joinpath("memo.sqlite")), max_age=0.2)
+    memo[("s", 1.0)] = {"value": 1}
+    assert memo.get(("s", 1.0)) == {"value": 1}
+    time.sleep(0.3)
+    assert memo.get(("s", 1.0)) is None and not memo._cache
+    # Stored again, it is served again
+    memo[("s", 1.0)] = {"value": 2}
+    assert memo[("s", 1.0)] == {"value": 2}
@@ -0,0 +1,69 @@
+import numpy as np
+from jmetal.algorithm.multiobjective.nsgaii import NSGAII
+from jmetal.operator.crossover import SBXCrossover
+from jmetal.operator.mutation import PolynomialMutation
+from jmetal.util.termination_criterion import StoppingByEvaluations
+from pymoo.algorithms.moo.nsga2 import NSGA2
+from pymoo.optimize import minimize
+
+from simulator.jmetal_problem import SimulatorEvaluator, SimulatorFloatProblem
+from simulator.pymoo_problem import SimulatorProblem
+from simulator.simulator import MockSimulator
+
+
+def counting_run_many(simulator, monkeypatch):
+    # Sizes of the populations passed to run_many
+    calls = []
+    run_many = simulator.run_many
+
+    def recording_run_many(candidates):
+        calls.append(len(candidates))
+        return run_many(candidates)
+
+    monkeypatch.setattr(simulator, "run_many", recording_run_many)
+    return calls
+
+
+def test_pymoo_problem_evaluates_a_generation_with_one_run_many(monkeypatch):
+    simulator = MockSimulator(10, 20, 5, 3, threads=1, number_of_simulations=2)
+    calls = counting_run_many(simulator, monkeypatch)
+    problem = SimulatorProblem(simulator, 4, windows=True)
+    assert problem.n_var == 10 and problem.n_obj == 3
+    result = minimize(problem, NSGA2(pop_size=10), ("n_gen", 3), seed=1)
+    simulator.close()
+
+    history = problem.evaluator.history
+    assert calls == [10, 10, 10] and [stats.candidates for stats in history] == calls
+    assert problem.evaluator.total_simulations == simulator.memo_misses
+    assert sum(stats.memo_hits for stats in history) == simulator.memo_hits
+    # The objectives of the front are those of its decoded candidates, negated when maximised
+    for x, f in zip(np.atleast_2d(result.X), np.atleast_2d(result.F)):
+        candidate = problem.encoding.decode(x)
+        assert len(candidate[2]) == candidate[0]
+        assert list(f) == problem.encoding.objective_values(candidate, simulator.run(*candidate))
+
+
+def test_jmetal_problem_evaluates_a_population_with_one_run_many(monkeypatch):
+    simulator = MockSimulator(10, 20, 5, 3, threads=1, number_of_simulations=2)
+    calls = counting_run_many(simulator, monkeypatch)
+    problem = SimulatorFloatProblem(simulator, 4)
+    assert problem.number_of_variables() == 2 and problem.number_of_objectives() == 3
+    algorithm = NSGAII(problem=problem,
+                       population_size=10,
+                       offspring_population_size=10,
+                       mutation=PolynomialMutation(probability=0.5),
+                       crossover=SBXCrossover(probability=0.9),
+                       termination_criterion=StoppingByEvaluations(max_evaluations=30),
+                       population_evaluator=SimulatorEvaluator())
+    algorithm.run()
+    simulator.close()
+
+    assert calls == [10, 10, 10] and len(problem.evaluator.history) == 3
+    for solution in algorithm.result():
+        candidate = problem.encoding.decode(solution.variables)
+        assert solution.objectives == problem.encoding.objective_values(candidate, simulator.run(*candidate))
+    # evaluate on its own handles a single solution
+    solution = problem.create_solution()
+    number_of_calls = len(calls)
+    assert problem.evaluate(solution) is solution and calls[number_of_calls:] == [1]
+    assert len(solution.objectives) == 3
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pytest
+from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
+
+from simulator import profiling
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    # Profiling state is global to the process, it is reset after each test
+    monkeypatch.setattr(profiling, "_stacks", profiling.Counter())
+    monkeypatch.delenv(profiling.PROFILE_DIR_ENV, raising=False)
+    monkeypatch.delenv(profiling.PROFILE_RATE_ENV, raising=False)
+    yield tmp_path.joinpath("profile")
+    if profiling._sampler is not None:
+        profiling._sampler.stop()
+        profiling._sampler.join()
+    profiling._sampler = None
+    profiling._started_pid = None
+    tracemalloc.stop()
+
+
+def busy_profiled_task(seconds: float) -> int:
+    # A joblib task of a profiled campaign
+    profiling.checkpoint()
+    blocks = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        blocks.append(bytearray(1024))
+    return os.getpid()
+
+
+def test_stacks_and_allocations_of_a_process(profile_dir):
+    profiling.enable(str(profile_dir), rate=200.0)
+    thread = threading.Thread(target=busy_profiled_task, args=(0.5,), name="Busy")
+    thread.start()
+    thread.join()
+    profiling.flush()
+
+    worker = f"{profiling.socket.gethostname()}_{os.getpid()}"
+    stacks = profile_dir.joinpath(f"stacks_{worker}.collapsed").read_text().splitlines()
+    busy = [line for line in stacks if line.startswith("Busy;") and "busy_profiled_task (test_profiling.py:" in line]
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in busy) >= 20
+    # The sampler does not sample itself
+    assert not any(line.startswith("StackSampler;") for line in stacks)
+
+    allocations = json.loads(profile_dir.joinpath(f"allocations_{worker}.json").read_text())
+    assert allocations["peak_bytes"] > 0
+    assert all(allocation["file"] != profiling.__file__ for allocation in allocations["allocations"])
+    # Profiling starts once per process
+    sampler = profiling._sampler
+    profiling.start()
+    assert profiling._sampler is sampler
+
+
+def test_merge_adds_up_the_profiles_of_every_worker(tmp_path):
+    for worker, count, size, peak in [("a_1", 3, 1024, 2 * 1024 * 1024), ("b_2", 4, 2048, 1024 * 1024)]:
+        tmp_path.joinpath(f"stacks_{worker}.collapsed").write_text(f"MainThread;main;run {count}\n"
+                                                                 f"MainThread;main;{worker} 1\n")
+        tmp_path.joinpath(f"allocations_{worker}.json").write_text(json.dumps(
+            {"peak_bytes": peak, "allocations": [{"file": "x.py", "line": 3, "bytes": size, "count": 2}]}))
+    collapsed_path, allocations_path = profiling.merge(str(tmp_path))
+    assert collapsed_path.read_text() == "MainThread;main;a_1 1\nMainThread;main;b_2 1\nMainThread;main;run 7\n"
+    report = allocations_path.read_text().splitlines()
+    assert report[0] == "Live allocations of 2 workers, largest first"
+    assert report[1].split() == ["3.0", "KiB", "4", "blocks", "x.py:3"]
+    # Peaks are listed largest first
+    assert [line.split()[-1] for line in report[-2:]] == ["a_1", "b_2"]
+
+
+def test_joblib_workers_write_their_profile_when_the_run_finishes(profile_dir):
+    # Workers started before profiling was enabled would not inherit it
+    get_reusable_executor().shutdown(wait=True)
+    profiling.enable(str(profile_dir), rate=200.0)
+    pids = set(Parallel(n_jobs=2)(delayed(busy_profiled_task)(0.3) for _ in range(4)))
+    profiling.finish()
+    assert os.getpid() not in pids
+    for pid in pids:
+        assert any(profile_dir.glob(f"stacks_*_{pid}.collapsed"))
+    assert "busy_profiled_task" in profile_dir.joinpath(profiling.COLLAPSED_FILE).read_text()
+    assert profile_dir.joinpath(profiling.ALLOCATIONS_FILE).read_text().startswith(
+        f"Live allocations of {len(pids) + 1} workers")
@@ -0,0 +1,95 @@
+import subprocess
+from datetime import datetime
+
+import pytest
+
+from Request import Request
+from simulator import Simulator, fake_simulator
+from simulator.replay_simulator_v2 import ReplaySimulatorV2
+from simulator.simulator_v2 import SimulatorV2
+
+CONFIG = {"service_start_time": datetime.fromisoformat("2021-01-01T09:00:00"),
+          "service_end_time": datetime.fromisoformat("2021-01-01T12:00:00"),
+          "num_customer_requests": 20,
+          "num_robots": 2,
+          "robot_speed_kmph": 5,
+          "robot_loading_capacity": 5,
+          "num_operators": 1,
+          "seed": 1}
+
+
+def record_corpus(tmp_path, speeds=()):
+    # The original run of seed 1, a follow-up without its first request, and a follow-up per speed that keeps all the
+    # requests, which only the name of a recording tells apart from the original
+    fake_simulator.install(str(tmp_path.joinpath("recorder")))
+    recorder = SimulatorV2(tmp_path.joinpath("recorder"))
+    requests = recorder.run_simulation("original", "20_2_1_1", **CONFIG)["customer_requests"]
+    demand_files = {}
+    for name, followup_requests in [("all", requests), ("removed", requests[1:])]:
+        demand_files[name] = str(tmp_path.joinpath(name + ".csv"))
+        Request.write_test_to_csv(demand_files[name], followup_requests, version=2)
+    recorder.run_simulation("followup", "RemoveRandomRequest_20_2_1_1_0",
+                            **dict(CONFIG, demand_mode="file", demand_file=demand_files["removed"]))
+    for i, speed in enumerate(speeds):
+        recorder.run_simulation("followup", f"ChangeSpeed_20_2_1_1_{i}",
+                                **dict(CONFIG, robot_speed_kmph=speed, demand_mode="file",
+                                       demand_file=demand_files["all"]))
+    return recorder.simulator_dir.joinpath("bin", "result"), demand_files
+
+
+def results(result_dir, zip_name):
+    with open(result_dir.joinpath(zip_name), "rb") as result_zip:
+        return result_zip.read()
+
+
+def test_recordings_are_found_by_name_then_by_content(tmp_path):
+    corpus_dir, demand_files = record_corpus(tmp_path)
+    replay = ReplaySimulatorV2(tmp_path.joinpath("replay"), [corpus_dir])
+    result_dir = replay.simulator_dir.joinpath("bin", "result")
+    result_dir.mkdir(parents=True)
+    replay.run_simulation("original", "20_2_1_1", **CONFIG)
+    assert results(result_dir, "original_20_2_1_1.zip") == results(corpus_dir, "original_20_2_1_1.zip")
+
+    # A run under another name with the requests of a recording
+    sim_result = replay.run_simulation("followup", "RemoveRandomRequest_20_2_1_1_7",
+                                       **dict(CONFIG, demand_mode="file", demand_file=demand_files["removed"]))
+    assert results(result_dir, "followup_RemoveRandomRequest_20_2_1_1_7.zip") == \
+        results(corpus_dir, "followup_RemoveRandomRequest_20_2_1_1_0.zip")
+    assert len(sim_result["customer_requests"]) == 19
+    # A recorded name whose inputs do not match falls back to the recording of those inputs
+    replay.run_simulation("followup", "RemoveRandomRequest_20_2_1_1_0",
+                          **dict(CONFIG, demand_mode="file", demand_file=demand_files["all"]))
+    assert results(result_dir, "followup_RemoveRandomRequest_20_2_1_1_0.zip") == \
+        results(corpus_dir, "original_20_2_1_1.zip")
+    # Inputs without recording
+    with pytest.raises(RuntimeError, match="No recorded result"):
+        replay.run_simulation("original", "20_2_1_2", **dict(CONFIG, seed=2))
+    assert replay.replayed == 3 and replay.missing == 1
+
+
+def test_inputs_recorded_with_different_results_are_only_replayed_by_name(tmp_path):
+    corpus_dir, demand_files = record_corpus(tmp_path, speeds=[2, 9])
+    replay = ReplaySimulatorV2(tmp_path.joinpath("replay"), [corpus_dir], on_missing="crash")
+    result_dir = replay.simulator_dir.joinpath("bin", "result")
+    result_dir.mkdir(parents=True)
+    # The original and both speed changes have the same requests, but not the same results
+    for i, speed in enumerate([2, 9]):
+        zip_name = f"followup_ChangeSpeed_20_2_1_1_{i}.zip"
+        assert results(corpus_dir, zip_name) != results(corpus_dir, "original_20_2_1_1.zip")
+        replay.run_simulation("followup", f"ChangeSpeed_20_2_1_1_{i}",
+                              **dict(CONFIG, robot_speed_kmph=speed, demand_mode="file",
+                                     demand_file=demand_files["all"]))
+        assert results(result_dir, zip_name) == results(corpus_dir, zip_name)
+    config = dict(CONFIG, demand_mode="file", demand_file=demand_files["all"])
+    with pytest.raises(subprocess.CalledProcessError):
+        replay.run_simulation("followup", "ChangeSpeed_20_2_1_1_2", **config)
+    assert replay.missing == 1
+    # The original is still replayed by its name
+    assert replay.run_simulation("original", "20_2_1_1", **CONFIG)[Simulator.NUM_DELIVERED] is not None
+
+    # Once the conflicting recordings leave the corpus, the index is updated and the requests are replayed by content
+    for i in range(2):
+        corpus_dir.joinpath(f"followup_ChangeSpeed_20_2_1_1_{i}.zip").unlink()
+    replay = ReplaySimulatorV2(tmp_path.joinpath("replay"), [corpus_dir])
+    replay.run_simulation("followup", "ChangeSpeed_20_2_1_1_2", **config)
+    assert results(result_dir, "followup_ChangeSpeed_20_2_1_1_2.zip") == results(corpus_dir, "original_20_2_1_1.zip")
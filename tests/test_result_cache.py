@@ -0,0 +1,78 @@
+import os
+from datetime import datetime, time
+
+import pytest
+
+from simulator import fake_simulator
+from simulator.result_cache import ResultCache, binary_digest, simulation_key
+from simulator.simulator_v2 import SimulatorV2
+
+CONFIG = {"service_start_time": datetime.fromisoformat("2021-01-01T09:00:00"),
+          "service_end_time": datetime.fromisoformat("2021-01-01T12:00:00"),
+          "num_customer_requests": 20,
+          "num_robots": 2,
+          "robot_speed_kmph": 5,
+          "robot_loading_capacity": 5,
+          "num_operators": 1}
+REQUEST_LINES = ["1,2021-01-01T09:00:00\n", "2,2021-01-01T09:10:00\n"]
+
+
+def test_key_only_depends_on_the_content_of_the_input():
+    key = simulation_key(CONFIG, REQUEST_LINES, "digest")
+    # Names, defaults, request order and integral floats do not change the key
+    assert simulation_key(dict(CONFIG, sim_name="followup", sim_id="x", demand_file="/tmp/x.csv"),
+                          REQUEST_LINES, "digest") == key
+    assert simulation_key(dict(CONFIG, seed=0, area_name="FujisawaSST"), REQUEST_LINES, "digest") == key
+    assert simulation_key(CONFIG, list(reversed(REQUEST_LINES)), "digest") == key
+    assert simulation_key(dict(CONFIG, robot_speed_kmph=5.0), REQUEST_LINES, "digest") == key
+    # Utilization periods of robots that do not exist are ignored
+    periods = [(time(hour=9), time(hour=10)), (time(hour=10), time(hour=11))]
+    assert simulation_key(dict(CONFIG, utilization_time_period=periods), None, "digest") == \
+        simulation_key(dict(CONFIG, utilization_time_period=periods + [(time(hour=11), time(hour=12))]), None,
+                       "digest")
+
+    assert simulation_key(dict(CONFIG, seed=1), REQUEST_LINES, "digest") != key
+    assert simulation_key(dict(CONFIG, robot_speed_kmph=5.5), REQUEST_LINES, "digest") != key
+    assert simulation_key(CONFIG, REQUEST_LINES[:1], "digest") != key
+    assert simulation_key(CONFIG, None, "digest") != key
+    assert simulation_key(CONFIG, REQUEST_LINES, "other digest") != key
+
+
+def test_rebuilt_simulator_binary_changes_the_key(tmp_path):
+    fake_simulator.install(str(tmp_path))
+    simulator = SimulatorV2(tmp_path)
+    binary_path = tmp_path.joinpath("bin", "run", "run")
+    digest = binary_digest(binary_path)
+    key = simulator._simulation_cache_key(**CONFIG)
+    assert binary_digest(binary_path) == digest and simulator._simulation_cache_key(**CONFIG) == key
+
+    with open(binary_path, "a") as binary:
+        binary.write("# rebuilt\n")
+    assert binary_digest(binary_path) != digest
+    assert simulator._simulation_cache_key(**CONFIG) != key
+
+
+def test_cache_evicts_the_least_recently_used_results(tmp_path):
+    result_zip = tmp_path.joinpath("result.zip")
+    result_zip.write_bytes(b"zip")
+    cache = ResultCache(tmp_path / "cache", max_entries=2)
+    cache.insert("a", result_zip)
+    cache.insert("b", result_zip)
+    # Looking a up makes b the least recently used one
+    assert cache.lookup("a") == tmp_path.joinpath("cache", "a.zip")
+    cache.insert("c", result_zip)
+    assert len(cache) == 2 and "b" not in cache and cache.lookup("b") is None
+    assert not tmp_path.joinpath("cache", "b.zip").exists()
+    assert cache.hits == 1 and cache.inserts == 3
+
+    # The order survives a restart through the modification times of the zips
+    os.utime(tmp_path.joinpath("cache", "a.zip"), ns=(1, 1))
+    cache = ResultCache(tmp_path / "cache", max_entries=1)
+    assert len(cache) == 1 and "c" in cache and "a" not in cache
+
+
+def test_file_demand_without_a_demand_file_is_rejected_before_hashing(tmp_path):
+    fake_simulator.install(str(tmp_path))
+    simulator = SimulatorV2(tmp_path, result_cache=ResultCache(tmp_path / "cache"))
+    with pytest.raises(RuntimeError, match="demand_file must be set"):
+        simulator.run_simulation("original", "20_2_1_1", **CONFIG, demand_mode="file")
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from simulator.simulator import MockSimulator, Simulator
+
+
+def flat_response(metrics, number_of_simulations):
+    # The dict Simulator.run returned before SimulationResults, without its execution_time
+    response = dict(zip(Simulator.METRICS,
+                        np.apply_along_axis(np.mean, 0, np.array([[m[label] for label in Simulator.METRICS]
+                                                                  for m in metrics]))))
+    response['simulations'] = number_of_simulations
+    sequential_execution_time = 0.0
+    for metrics_single in metrics:
+        for k, v in metrics_single.items():
+            if k != 'sim_id':
+                response[f'{k}_{metrics_single["sim_id"]}'] = v
+        sequential_execution_time += metrics_single['execution_time']
+    response['sequential_execution_time'] = sequential_execution_time
+    return response
+
+
+def test_to_dict_matches_the_flat_dict_run_returned():
+    simulator = MockSimulator(10, 20, 5, 3, threads=1, number_of_simulations=5)
+    simulator.set_number_of_simulations(3)
+    result = simulator.run(2, 5.0, [(9, 11)])
+    simulator.close()
+    metrics = [metric for metric in simulator.memo.values() if metric['sim_id'] in simulator.selected_simulations]
+    assert len(metrics) == 3
+
+    expected = flat_response(metrics, 3)
+    actual = result.to_dict()
+    assert actual.pop('execution_time') >= 0
+    assert sorted(actual) == sorted(expected)
+    for key, value in expected.items():
+        assert actual[key] == pytest.approx(value), key
+    # Per-simulation entries are also read one at a time
+    sim_id = metrics[0]['sim_id']
+    assert result[f'seed_{sim_id}'] == metrics[0]['seed']
+    assert result[f'{Simulator.NUM_RISKS}_{sim_id}'] == metrics[0][Simulator.NUM_RISKS]
+    with pytest.raises(KeyError):
+        result[f'seed_{max(simulator.get_all_simulations()) + 1}']
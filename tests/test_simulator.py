@@ -0,0 +1,171 @@
+import pickle
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from simulator.simulator import MockSimulator, RunSpec, Simulator, execute_run_spec
+
+
+def test_finished_prefetch_not_yet_in_the_memo_is_not_simulated_again(monkeypatch):
+    simulator = Simulator(10, 20, 5, 1, threads=1)
+    key = (2, 5.0, "", 1, 0)
+    # A prefetch that finished, whose done callback has not stored the result in the memo yet
+    future = Future()
+    future.set_result({Simulator.NUM_DELIVERED: 7})
+    simulator._prefetches[key] = future
+
+    def make_run_spec(*args):
+        raise AssertionError("the prefetched simulation was run again")
+
+    monkeypatch.setattr(simulator, "make_run_spec", make_run_spec)
+    assert simulator._fetch([({0: key}, [1, 1], {0})]) == {key: {Simulator.NUM_DELIVERED: 7}}
+    assert key not in simulator._prefetches
+    simulator.close()
+
+
+def test_workers_only_receive_run_specs(monkeypatch):
+    simulator = MockSimulator(10, 20, 5, 3, threads=1, number_of_simulations=4)
+    # A large memo must not make the tasks any larger
+    for i in range(1000):
+        simulator.memo[(3, 1000.0 + i, "", 3, 0)] = MockSimulator.worst_response()
+    tasks = []
+
+    def recording_parallel(delayed_tasks):
+        tasks.extend(delayed_tasks)
+        return [function(*args, **kwargs) for function, args, kwargs in tasks]
+
+    monkeypatch.setattr(simulator, "_parallel", recording_parallel)
+    result = simulator.run(2, 5.0, [(9, 11)])
+    assert len(tasks) == 4 and result["simulations"] == 4
+    for function, (simulator_class, spec), _ in tasks:
+        assert function is execute_run_spec and simulator_class is MockSimulator and type(spec) is RunSpec
+        assert spec.working_hours_per_robot == (2, 3) and spec.utilization_time_period == "09:00-11:00"
+        assert spec.seed == simulator.seeds[spec.sim_id]
+        assert len(pickle.dumps((simulator_class, spec))) < 1000
+    assert set(result.column("seed")) == set(simulator.seeds)
+
+
+def test_specs_run_in_worker_processes():
+    simulator = MockSimulator(10, 20, 5, 3, threads=2, number_of_simulations=4)
+    results = simulator.run_many([(2, 5.0), (3, 5.0)])
+    # The second call reuses the pool and finds everything in the memo
+    assert simulator.run(2, 5.0).means() == results[0].means()
+    simulator.close()
+    for result in results:
+        assert list(result.sim_ids) == [0, 1, 2, 3]
+        assert list(result.column("requests_per_hour")) == simulator.request_per_hour
+        assert list(result.column("seed")) == simulator.seeds
+    assert simulator.memo_misses == 8 and simulator.memo_hits == 4
+
+
+def test_former_instance_methods_still_work():
+    simulator = MockSimulator(10, 20, 5, 4)
+    response = simulator.create_response([10, 20], 8, 15, [0.5, 0.25], [4, 2])
+    assert response == Simulator.spec_response([10, 20], 8, 15, [0.5, 0.25], [4, 2], 4)
+    assert response[Simulator.NUM_DELIVERED] == 7.5 and response[Simulator.UTILIZATION_RATE] == 0.5
+    metrics = simulator.execute_command("run/run", 15, 7, [4, 2])
+    assert set(metrics) == set(Simulator.METRICS) and 0 <= metrics[Simulator.NUM_RISKS] <= 25
+
+
+def test_run_many_dispatches_a_population_at_once(monkeypatch):
+    simulator = MockSimulator(10, 20, 5, 3, threads=1, number_of_simulations=3)
+    dispatches = []
+
+    def recording_parallel(delayed_tasks):
+        tasks = list(delayed_tasks)
+        dispatches.append(len(tasks))
+        return [function(*args, **kwargs) for function, args, kwargs in tasks]
+
+    monkeypatch.setattr(simulator, "_parallel", recording_parallel)
+    candidates = [(2, 5.0), (3, 5.0, [(9, 11)]), (2, 5.0), (4, 6.0)]
+    results = simulator.run_many(candidates)
+    # One dispatch for the population, the repeated candidate is only simulated once
+    assert dispatches == [9] and len(results) == 4
+    assert results[2].to_dict() == dict(results[0].to_dict(), execution_time=results[2]["execution_time"])
+    # Every candidate gets the same result as on its own, from the memo
+    for candidate, result in zip(candidates, results):
+        alone = simulator.run(*candidate)
+        assert alone.means() == result.means() and list(alone.column("seed")) == list(result.column("seed"))
+    assert dispatches == [9, 0, 0, 0, 0]
+    assert simulator.memo_misses == 9 and simulator.memo_hits == 12
+
+
+class SeededSimulator(Simulator):
+    # Metrics drawn from the seed of each simulation: constant at 5 km/h, noisy around 10 deliveries at 7 km/h, and
+    # noisy around no risks at all at other speeds, so that their relative precision is never reached
+    @classmethod
+    def execute_spec(cls, command, spec):
+        noise = np.random.default_rng(spec.seed).random()
+        return {Simulator.NUM_DELIVERED: 10.0 + (noise if spec.robot_speed_kmh == 7.0 else 0.0),
+                Simulator.NUM_RISKS: 1.0 if spec.robot_speed_kmh in (5.0, 7.0) else noise - 0.5,
+                Simulator.UTILIZATION_RATE: 0.5,
+                Simulator.DELIVERY_RATE: 0.8}
+
+
+def test_adaptive_replications_stop_once_the_confidence_intervals_are_narrow_enough():
+    simulator = SeededSimulator(10, 20, 5, 3, threads=1, number_of_simulations=20)
+    constant, noisy, never = simulator.run_adaptive_many([(2, 5.0), (2, 7.0), (2, 6.0)], batch_size=2,
+                                                        relative_precision=0.03)
+    simulator.close()
+    assert constant["simulations"] == 2 and constant["converged"] and constant[f"ci_{Simulator.NUM_DELIVERED}"] == 0
+    assert never["simulations"] == 20 and not never["converged"]
+
+    # The noisy candidate stops at the first batch whose Student t half-width is within 3% of the mean
+    order = simulator.replication_order()
+    deliveries = [10.0 + np.random.default_rng(simulator.seeds[sim_id]).random() for sim_id in order]
+    expected = next(n for n in range(2, 21, 2)
+                    if stats.t.ppf(0.975, n - 1) * np.std(deliveries[:n], ddof=1) / np.sqrt(n)
+                    <= 0.03 * np.mean(deliveries[:n]))
+    assert 2 < expected < 20
+    assert noisy["simulations"] == expected and noisy["converged"]
+    assert list(noisy.sim_ids) == sorted(order[:expected])
+    assert noisy[Simulator.NUM_DELIVERED] == pytest.approx(np.mean(deliveries[:expected]))
+    assert noisy[f"ci_{Simulator.NUM_DELIVERED}"] <= 0.03 * noisy[Simulator.NUM_DELIVERED]
+    # Only the replications that were needed were simulated
+    assert simulator.memo_misses == 2 + expected + 20
+
+    # An absolute precision replaces the relative one for its metric
+    simulator = SeededSimulator(10, 20, 5, 3, threads=1, number_of_simulations=20)
+    result = simulator.run_adaptive(2, 6.0, batch_size=4, absolute_precision={Simulator.NUM_RISKS: 10.0})
+    assert result["simulations"] == 4 and result["converged"]
+    simulator.close()
+
+
+class RankedSimulator(Simulator):
+    # Deliveries grow with the number of robots and, a little, with the simulated hours
+    @classmethod
+    def execute_spec(cls, command, spec):
+        return {Simulator.NUM_DELIVERED: 10.0,
+                Simulator.NUM_RISKS: 0.0,
+                Simulator.UTILIZATION_RATE: 0.5,
+                Simulator.DELIVERY_RATE: len(spec.working_hours_per_robot) / 10 + spec.simulation_duration / 100}
+
+
+def test_multi_fidelity_promotes_the_best_screened_candidates():
+    simulator = RankedSimulator(10, 20, 5, 3, threads=1, number_of_simulations=2)
+    candidates = [(num_robots, 5.0) for num_robots in [3, 10, 1, 7, 9, 2, 5, 8, 4, 6]]
+    results = simulator.run_multi_fidelity(candidates, screening_duration=1, promote_fraction=0.2)
+    assert simulator.simulation_duration == 3
+    promoted = [candidate[0] for candidate, result in zip(candidates, results) if result["promoted"]]
+    assert sorted(promoted) == [9, 10]
+    for candidate, result in zip(candidates, results):
+        fidelity = 3 if candidate[0] in promoted else 1
+        assert result["fidelity"] == fidelity
+        assert result[Simulator.DELIVERY_RATE] == pytest.approx(candidate[0] / 10 + fidelity / 100)
+    # Both fidelities are kept apart in the memo
+    assert simulator.memo_misses == 2 * (10 + 2) and len(simulator.memo) == 2 * (10 + 2)
+    assert simulator.simulated_hours == 2 * (10 * 1 + 2 * 3)
+
+    def promoted_robots(**options):
+        results = simulator.run_multi_fidelity(candidates, screening_duration=1, **options)
+        return sorted(candidate[0] for candidate, result in zip(candidates, results) if result["promoted"])
+
+    # Only the candidates reaching the threshold, at least min_promoted of them, or the lowest ones when minimising
+    assert promoted_robots(promote_fraction=0.3, promote_threshold=0.95) == [10]
+    assert promoted_robots(promote_fraction=0.3, promote_threshold=2.0) == []
+    assert promoted_robots(promote_fraction=0.1, min_promoted=3) == [8, 9, 10]
+    assert promoted_robots(promote_fraction=0.2, maximise=False) == [1, 2]
+    assert promoted_robots(promote_fraction=1.0) == list(range(1, 11))
+    simulator.close()
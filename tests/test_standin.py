@@ -0,0 +1,160 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from Request import Request
+from simulator.fake_simulator import TARGETS, TIMEZONE
+from simulator.standin import LOAD_MINUTES, STOP_MINUTES, Scenario, StandinEngine, point
+from simulator.standin_batch import BatchedStandinEngine
+
+START = datetime(2021, 1, 1, 9, tzinfo=TIMEZONE)
+END = datetime(2021, 1, 1, 12, tzinfo=TIMEZONE)
+
+
+def request(request_id, order_minute, pickup_target="T01", delivery_target="T02", quantity=1, pickup_minutes=180,
+            delivery_minutes=180):
+    # Ordered order_minute minutes into the service, with windows opening at the order
+    order_time = START + timedelta(minutes=order_minute)
+    return Request(request_id, order_time, pickup_target, delivery_target, quantity,
+                   order_time, order_time + timedelta(minutes=pickup_minutes),
+                   order_time, order_time + timedelta(minutes=delivery_minutes))
+
+
+def scenario(requests, num_robots=1, robot_speed_kmph=5.0, robot_loading_capacity=5, num_operators=1, windows=None):
+    return Scenario(requests=requests,
+                    service_start_time=START,
+                    service_end_time=END,
+                    num_robots=num_robots,
+                    robot_speed_kmph=robot_speed_kmph,
+                    robot_loading_capacity=robot_loading_capacity,
+                    num_operators=num_operators,
+                    windows=windows if windows is not None else [(START, END)] * num_robots)
+
+
+def km(a, b):
+    return float(np.hypot(*(np.array(point("FujisawaSST:" + b)) - np.array(point("FujisawaSST:" + a)))))
+
+
+def depot_km(target):
+    return float(np.hypot(*(np.array(point("FujisawaSST:" + target)) - 0.75)))
+
+
+def test_single_trip_follows_the_straight_line_timings():
+    engine = StandinEngine(scenario([request(0, 0)])).run()
+    speed = 5.0 / 3600
+    depart = LOAD_MINUTES * 60
+    pickup = depart + depot_km("T01") / speed
+    delivery = pickup + STOP_MINUTES * 60 + km("T01", "T02") / speed
+    back = delivery + STOP_MINUTES * 60 + depot_km("T02") / speed
+    (trip,) = engine.state.trips
+    assert trip.pickups == pytest.approx((pickup,)) and trip.deliveries == pytest.approx((delivery,))
+    assert trip.back == pytest.approx(back)
+    assert trip.km == pytest.approx(depot_km("T01") + km("T01", "T02") + depot_km("T02"))
+    assert engine.delivered == 1 and engine.state.robot_by_request[0] == 0
+    assert engine.state.run_seconds[0] == pytest.approx(back - depart)
+    assert engine.state.load_seconds[0] == depart and engine.state.operator_shortage_seconds[0] == 0
+
+
+def test_requests_that_cannot_be_served_in_time_are_left_pending():
+    # A pickup window closing before the robot can get there, and an order after the end of the shift
+    engine = StandinEngine(scenario([request(0, 0, pickup_minutes=1), request(1, 170), request(2, 10)])).run()
+    assert list(engine.state.robot_by_request) == [-1, -1, 0]
+    assert list(engine.state.pending) == [True, True, False]
+
+
+def test_trips_respect_the_capacity_and_the_earliest_deadline():
+    requests = [request(i, 0, quantity=2, delivery_minutes=180 - 30 * i) for i in range(3)]
+    engine = StandinEngine(scenario(requests, robot_loading_capacity=4)).run()
+    first, second = engine.state.trips
+    # Requests 2 and 1 have the earliest deadlines and fill the robot
+    assert sorted(first.requests) == [1, 2] and second.requests == (0,)
+    assert first.depart - first.load_start == 4 * LOAD_MINUTES * 60
+    assert second.ready == first.back
+
+
+def test_robots_wait_for_a_free_operator():
+    requests = [request(0, 0), request(1, 0, pickup_target="T03")]
+    engine = StandinEngine(scenario(requests, num_robots=2, robot_loading_capacity=1)).run()
+    assert engine.delivered == 2
+    assert list(engine.state.operator_shortage_seconds) == [0.0, LOAD_MINUTES * 60]
+    engine = StandinEngine(scenario(requests, num_robots=2, robot_loading_capacity=1, num_operators=2)).run()
+    assert list(engine.state.operator_shortage_seconds) == [0.0, 0.0]
+
+
+def test_robots_only_work_during_their_shift():
+    windows = [(START + timedelta(hours=1), START + timedelta(hours=2))]
+    engine = StandinEngine(scenario([request(0, 0), request(1, 100)], windows=windows)).run()
+    (trip,) = engine.state.trips
+    assert trip.requests == (0,) and trip.ready == 3600 and trip.back <= 7200
+    assert engine.working_seconds[0] == 3600
+
+
+def random_scenario(generator: random.Random) -> Scenario:
+    requests = [request(request_id, generator.uniform(0, 150), generator.choice(TARGETS), generator.choice(TARGETS),
+                        generator.randint(1, 3), generator.uniform(20, 90), generator.uniform(40, 150))
+                for request_id in range(generator.randint(0, 40))]
+    num_robots = generator.randint(1, 4)
+    windows = []
+    for _ in range(num_robots):
+        start = generator.randint(0, 2)
+        windows.append((START + timedelta(hours=start), START + timedelta(hours=generator.randint(start + 1, 3))))
+    return scenario(requests, num_robots=num_robots,
+                    robot_speed_kmph=generator.uniform(2, 10),
+                    robot_loading_capacity=generator.randint(1, 6),
+                    num_operators=generator.randint(1, 3),
+                    windows=windows)
+
+
+def test_random_scenarios_keep_every_constraint(tmp_path):
+    generator = random.Random(0)
+    for i in range(10):
+        engine = StandinEngine(random_scenario(generator)).run()
+        state = engine.state
+        served = state.robot_by_request >= 0
+        assert np.all(state.pickup_time[served] >= engine.order_time[served])
+        assert np.all(state.pickup_time[served] <= engine.pickup_end[served])
+        assert np.all(state.delivery_time[served] >= state.pickup_time[served])
+        assert np.all(state.delivery_time[served] <= engine.delivery_end[served])
+        for trip in state.trips:
+            assert engine.quantity[list(trip.requests)].sum() <= engine.scenario.robot_loading_capacity
+            assert engine.shift_start[trip.robot] <= trip.ready and trip.back <= engine.shift_end[trip.robot]
+        assert not engine.truncated and engine.delivered == served.sum()
+        # The same scenario always gives the same results
+        engine.write_results(tmp_path.joinpath(str(i), "first"))
+        StandinEngine(engine.scenario).run().write_results(tmp_path.joinpath(str(i), "second"))
+        for result_file in ["cost.csv", "risk.csv", "value.csv", "robot_requests_db.csv"]:
+            assert tmp_path.joinpath(str(i), "first", result_file).read_text() == \
+                tmp_path.joinpath(str(i), "second", result_file).read_text()
+
+
+def test_stopped_run_is_marked_as_truncated(tmp_path):
+    engine = StandinEngine(scenario([request(i, 10 * i) for i in range(10)])).run(lambda engine: engine.delivered >= 2)
+    assert engine.truncated and 2 <= engine.delivered < 10 and engine.state.pending.any()
+    engine.write_results(tmp_path)
+    assert tmp_path.joinpath("truncated").read_text() == f"{engine.state.epoch}\n"
+
+
+def test_batched_engine_gives_the_results_of_the_scalar_engine(tmp_path):
+    generator = random.Random(1)
+    scenarios = [random_scenario(generator) for _ in range(40)]
+    # Some scenarios stop once enough baggage was delivered, or once too little can still be
+    stops = [None] * 20 + [lambda lo, hi: lo >= 6, lambda lo, hi: hi < 20] * 10
+    batched = BatchedStandinEngine(scenarios, stops).run().results()
+    for i, (scenario, stop, engine) in enumerate(zip(scenarios, stops, batched)):
+        expected = StandinEngine(scenario).run(
+            (lambda engine, stop=stop: stop(engine.delivered_quantity, engine.deliverable_quantity))
+            if stop is not None else None)
+        for attribute in ["robot_by_request", "pickup_time", "delivery_time", "tripmeter", "run_seconds",
+                          "load_seconds", "operator_shortage_seconds"]:
+            np.testing.assert_allclose(getattr(engine.state, attribute), getattr(expected.state, attribute),
+                                       err_msg=f"{attribute} of scenario {i}")
+        assert sorted(engine.state.risks) == pytest.approx(sorted(expected.state.risks)), i
+        assert engine.state.epoch == expected.state.epoch and engine.truncated == expected.truncated, i
+        engine.write_results(tmp_path.joinpath(str(i), "batched"))
+        expected.write_results(tmp_path.joinpath(str(i), "scalar"))
+        for result_file in ["cost.csv", "value.csv", "robot_requests_db.csv"]:
+            assert tmp_path.joinpath(str(i), "batched", result_file).read_text() == \
+                tmp_path.joinpath(str(i), "scalar", result_file).read_text(), (i, result_file)
+    assert any(engine.truncated for engine in batched) and any(engine.delivered > 0 for engine in batched)
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+from Request import Request
+from simulator.standin_simulator_v2 import StandinSimulatorV2
+
+CONFIG = {"service_start_time": datetime.fromisoformat("2021-01-01T09:00:00"),
+          "service_end_time": datetime.fromisoformat("2021-01-01T12:00:00"),
+          "num_customer_requests": 40,
+          "num_robots": 3,
+          "robot_speed_kmph": 5,
+          "robot_loading_capacity": 5,
+          "num_operators": 2,
+          "seed": 1}
+
+
+def result_files(simulator, sim_name, sim_id):
+    result_dir = simulator.simulator_dir.joinpath("bin", "result", sim_name, sim_id)
+    return {str(path.relative_to(result_dir)): path.read_bytes() for path in result_dir.rglob("*") if path.is_file()}
+
+
+def requests_ordered_during_service(tmp_path):
+    # Generated requests are all ordered before the service starts, so that any follow-up changing them differs from
+    # the first epoch. These ones are ordered every 4 minutes with windows of 30 and 90 minutes.
+    simulator = StandinSimulatorV2(tmp_path / "generated", archive_mode="none")
+    requests = simulator.run_simulation("original", "40_3_2_1", **CONFIG)["customer_requests"]
+    for i, request in enumerate(sorted(requests, key=lambda request: request.customer_request_id)):
+        request.order_time = request.pickup_desired_start_time = request.delivery_desired_start_time = \
+            CONFIG["service_start_time"].replace(tzinfo=request.order_time.tzinfo) + timedelta(minutes=4 * i)
+        request.pickup_desired_end_time = request.order_time + timedelta(minutes=30)
+        request.delivery_desired_end_time = request.order_time + timedelta(minutes=90)
+    return sorted(requests, key=lambda request: request.order_time)
+
+
+def test_forked_followups_write_the_same_results_as_full_runs(tmp_path):
+    requests = requests_ordered_during_service(tmp_path)
+    demand_file = str(tmp_path.joinpath("original.csv"))
+    Request.write_test_to_csv(demand_file, requests, version=2)
+    forked = StandinSimulatorV2(tmp_path / "forked", fork_followups=True, checkpoint_seconds=300.0,
+                                archive_mode="none")
+    full = StandinSimulatorV2(tmp_path / "full", archive_mode="none")
+    for simulator in [forked, full]:
+        simulator.run_simulation("original", "40_3_2_1", **dict(CONFIG, demand_mode="file", demand_file=demand_file))
+    assert result_files(forked, "original", "40_3_2_1") == result_files(full, "original", "40_3_2_1")
+
+    # Removing the fourth request changes the run from an early epoch on, removing the last one only near its end
+    skipped_epochs = {}
+    for name, removed in [("early", 3), ("late", len(requests) - 1)]:
+        demand_file = str(tmp_path.joinpath(name + ".csv"))
+        Request.write_test_to_csv(demand_file, requests[:removed] + requests[removed + 1:], version=2)
+        sim_id = "RemoveRandomRequest_40_3_2_1_" + name
+        skipped_before = forked.skipped_epochs
+        for simulator in [forked, full]:
+            simulator.run_simulation("followup", sim_id, **dict(CONFIG, demand_mode="file", demand_file=demand_file))
+        skipped_epochs[name] = forked.skipped_epochs - skipped_before
+        assert result_files(forked, "followup", sim_id) == result_files(full, "followup", sim_id)
+    assert full.skipped_epochs == 0
+    assert 0 < skipped_epochs["early"] < skipped_epochs["late"], skipped_epochs
@@ -0,0 +1,27 @@
+import numpy as np
+from pymoo.algorithms.moo.nsga2 import NSGA2
+from pymoo.optimize import minimize
+
+from simulator.pymoo_problem import SimulatorProblem
+from simulator.simulator import MockSimulator
+from simulator.surrogate import SurrogateScreen
+
+
+def test_front_is_the_set_of_non_dominated_objectives():
+    random = np.random.default_rng(0)
+    # Few distinct values, so that there are ties and duplicates
+    objectives = random.integers(0, 6, size=(300, 3)).astype(float)
+    screen = SurrogateScreen(None)
+    screen._objectives = {str(i): values for i, values in enumerate(objectives)}
+    expected = [values for values in objectives
+                if not any(np.all(other <= values) and np.any(other < values) for other in objectives)]
+    assert sorted(map(tuple, screen.front)) == sorted(map(tuple, expected))
+    assert screen.front is screen.front
+
+
+def test_screening_without_windows():
+    simulator = MockSimulator(10, 20, 5, 3, threads=1)
+    problem = SimulatorProblem(simulator, 5, surrogate_options={})
+    minimize(problem, NSGA2(pop_size=20), ("n_gen", 4), seed=1)
+    assert problem.evaluator.surrogate.trained and problem.evaluator.surrogate.screened > 0
+    simulator.close()
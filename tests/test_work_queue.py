@@ -0,0 +1,76 @@
+import time
+
+from metamorphic import experiments
+from metamorphic.WorkQueue import DONE, FAILED, LEASED, QUEUED, Heartbeat, SQLiteWorkQueue
+
+
+def runners(tmp_path, **options):
+    # Two runners of a campaign, each with its own connection to the queue file
+    path = str(tmp_path.joinpath("queue.sqlite"))
+    return SQLiteWorkQueue(path, **options), SQLiteWorkQueue(path, **options)
+
+
+def test_lease_of_a_runner_that_stops_heartbeating_is_reclaimed(tmp_path):
+    queue_a, queue_b = runners(tmp_path, lease_seconds=0.5)
+    queue_a.put([("1", "config")])
+    item = queue_a.lease("a")
+    assert item.attempts == 1 and queue_b.lease("b") is None
+    # a heartbeats for a while, then stops without completing the item
+    heartbeat = Heartbeat(queue_a, "a", item)
+    heartbeat.start()
+    time.sleep(1.0)
+    assert queue_b.lease("b") is None
+    heartbeat.stop()
+    time.sleep(0.6)
+    reclaimed = queue_b.lease("b")
+    assert reclaimed == item._replace(attempts=2)
+    # a finds out it lost the lease, and its failure does not requeue the item b is running
+    assert not queue_a.heartbeat("a", item)
+    queue_a.fail("a", item)
+    assert queue_b.counts() == {LEASED: 1}
+    queue_b.complete("b", reclaimed)
+    assert queue_a.counts() == {DONE: 1} and queue_a.unfinished() == 0
+
+
+def test_item_is_failed_after_max_attempts(tmp_path):
+    queue_a, queue_b = runners(tmp_path, lease_seconds=0.2, max_attempts=3)
+    queue_a.put([("1", "config")])
+    queue_a.fail("a", queue_a.lease("a"))
+    assert queue_a.counts() == {QUEUED: 1}
+    queue_b.fail("b", queue_b.lease("b"))
+    # The third lease expires instead of failing, it is not leased a fourth time
+    assert queue_a.lease("a").attempts == 3
+    time.sleep(0.3)
+    assert queue_b.lease("b") is None
+    assert queue_b.counts() == {FAILED: 1} and queue_b.unfinished() == 0
+
+
+def test_idle_runner_steals_a_slow_lease(tmp_path):
+    queue_a, queue_b = runners(tmp_path, lease_seconds=60.0, steal_after_seconds=0.2)
+    queue_a.put([("1", "config")])
+    item = queue_a.lease("a")
+    assert queue_b.lease("b") is None
+    time.sleep(0.3)
+    stolen = queue_b.lease("b")
+    assert stolen.seed == "1"
+    # An item is only stolen once, and the slow runner may still finish it first
+    assert SQLiteWorkQueue(queue_a.path, steal_after_seconds=0.2).lease("c") is None
+    queue_a.complete("a", item)
+    queue_b.complete("b", stolen)
+    assert queue_a.counts() == {DONE: 1}
+
+
+def test_run_queue_requeues_failed_seeds(tmp_path, monkeypatch):
+    queue = SQLiteWorkQueue(str(tmp_path.joinpath("queue.sqlite")), max_attempts=2)
+    queue.put([("1", "good"), ("2", "good"), ("3", "bad")])
+    runs = []
+
+    def run_seed(simulator, simulator_config, seed, *args):
+        runs.append(seed)
+        if simulator_config == "bad":
+            raise RuntimeError("crashed")
+
+    monkeypatch.setattr(experiments, "run_seed", run_seed)
+    experiments.run_queue(queue, None, {"good": "good", "bad": "bad"}, [], poll_seconds=0.1)
+    assert sorted(runs) == ["1", "2", "3", "3"]
+    assert queue.counts() == {DONE: 2, FAILED: 1}
@@ -0,0 +1,68 @@
+import sys
+import time
+
+from simulator.worker_pool import SimulatorWorkerPool
+
+
+def executable(tmp_path, name, serve_body):
+    # A simulator printing "one-shot" when run normally, and running serve_body (with json, os, sys and time imported
+    # and responses open on the response descriptor) when started with --serve
+    path = tmp_path.joinpath(name)
+    path.write_text(f"#!{sys.executable}\n"
+                    "import json, os, sys, time\n"
+                    "if sys.argv[1:] == ['--serve']:\n"
+                    "    responses = os.fdopen(int(os.environ['SIMULATOR_SERVE_FD']), 'w', buffering=1)\n"
+                    + "".join("    " + line + "\n" for line in serve_body.splitlines()) +
+                    "else:\n"
+                    "    print('one-shot')\n")
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_logs_on_stdout_do_not_break_the_protocol(tmp_path):
+    pool = SimulatorWorkerPool(executable(tmp_path, "chatty", """
+print('loading...', flush=True)
+print(json.dumps({'ready': True}), file=responses)
+for line in sys.stdin:
+    print('{"returncode": 3}', flush=True)
+    print(json.dumps({'returncode': 0, 'stdout': 'served'}), file=responses)
+"""), tmp_path, 1)
+    for _ in range(3):
+        completed_process = pool.run(["run", "arg"])
+        assert completed_process.stdout == b"served" and completed_process.returncode == 0
+    assert pool.started_workers == 1 and pool.fallback_runs == 0
+    pool.close()
+
+
+def test_binary_without_serve_mode_falls_back(tmp_path):
+    # Like bin/run/run, which runs normally and logs to stdout whatever its arguments
+    path = tmp_path.joinpath("no_serve")
+    path.write_text("#!/bin/sh\necho '{\"ready\": true}'\necho one-shot\n")
+    path.chmod(0o755)
+    pool = SimulatorWorkerPool(str(path), tmp_path, 1)
+    assert pool.run([str(path), "arg"]).stdout.strip().endswith(b"one-shot")
+    assert not pool.serve_supported and pool.started_workers == 0
+    pool.close()
+
+
+def test_worker_hung_at_startup_is_killed(tmp_path):
+    pool = SimulatorWorkerPool(executable(tmp_path, "hung_at_startup", "time.sleep(60)"), tmp_path, 1,
+                               startup_timeout=0.5)
+    start = time.monotonic()
+    assert pool.run([pool.executable, "arg"]).stdout == b"one-shot\n"
+    assert time.monotonic() - start < 10
+    assert not pool.serve_supported
+    pool.close()
+
+
+def test_worker_hung_during_a_run_is_killed_and_recycled(tmp_path):
+    pool = SimulatorWorkerPool(executable(tmp_path, "hung_in_run", """
+print(json.dumps({'ready': True}), file=responses)
+sys.stdin.readline()
+time.sleep(60)
+"""), tmp_path, 1, run_timeout=0.5)
+    start = time.monotonic()
+    assert pool.run([pool.executable, "arg"]).stdout == b"one-shot\n"
+    assert time.monotonic() - start < 10
+    assert pool.crashed_workers == 1 and pool.serve_supported
+    pool.close()